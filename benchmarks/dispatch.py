@@ -0,0 +1,139 @@
+"""Benchmarks the message dispatch path under each available event loop
+
+Runs MessagePipeline.dispatch against a fake client with stages like the
+ones the core and the default cogs add, and waits for the stages to run.
+
+    python benchmarks/dispatch.py [messages] [rounds]
+"""
+
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from cogs.utils import eventloop
+from cogs.utils.dispatch import MessagePipeline
+from cogs.utils.metrics import Metrics
+from cogs.utils.settings import PrefixMatcher
+
+
+class FakeUser:
+    def __init__(self, id, bot=False):
+        self.id = id
+        self.bot = bot
+        self.roles = []
+
+
+class FakeChannel:
+    def __init__(self, id, is_private=False):
+        self.id = id
+        self.is_private = is_private
+
+
+class FakeServer:
+    def __init__(self, id):
+        self.id = id
+
+
+class FakeMessage:
+    def __init__(self, n):
+        self.id = str(n)
+        self.server = FakeServer(str(n % 50))
+        self.channel = FakeChannel(str(n % 200))
+        self.author = FakeUser(str(n % 1000), bot=n % 20 == 0)
+        self.content = ("!ping" if n % 4 == 0 else
+                        "just chatting about message {}".format(n))
+
+
+class FakeSettings:
+    def __init__(self):
+        self.matcher = PrefixMatcher(["!", "red "])
+
+    def match_prefix(self, server, content):
+        return self.matcher.match(content)
+
+
+class FakeClient:
+    def __init__(self, loop):
+        self.loop = loop
+        self.user = FakeUser("0", bot=True)
+        self.settings = FakeSettings()
+        self.metrics = Metrics()
+        self.pipeline = MessagePipeline(self)
+        self.handled = 0
+        self.expected = 0
+        self.done = None
+
+    def user_allowed(self, message):
+        return True
+
+
+async def handle(info):
+    await asyncio.sleep(0)
+    client = info.message.client
+    client.handled += 1
+    if client.handled == client.expected:
+        client.done.set_result(None)
+
+
+def build(loop):
+    client = FakeClient(loop)
+    moderated = {str(n) for n in range(0, 50, 2)}
+    trivia = {str(n) for n in range(0, 200, 40)}
+    client.pipeline.add_stage("commands", handle, prefixed=True,
+                              ignore_self=False, allowed_only=True)
+    client.pipeline.add_stage("mod", handle, server_only=True,
+                              ignore_bots=True, servers=moderated)
+    client.pipeline.add_stage("alias", handle, prefixed=True,
+                              server_only=True, servers=moderated)
+    client.pipeline.add_stage("trivia", handle, channels=trivia)
+    client.pipeline.add_stage("poll", handle, channels=set())
+    return client
+
+
+def run(name, messages, rounds):
+    loop = eventloop.new_event_loop(name)
+    asyncio.set_event_loop(loop)
+    client = build(loop)
+    batch = [FakeMessage(n) for n in range(messages)]
+    for message in batch:
+        message.client = client
+
+    async def once():
+        client.handled = client.expected = 0
+        client.done = loop.create_future()
+        for message in batch:
+            client.expected += client.pipeline.dispatch(message)
+        await client.done  # Until every stage has run
+
+    best = None
+    try:
+        for _ in range(rounds):
+            start = time.perf_counter()
+            loop.run_until_complete(once())
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+    finally:
+        loop.close()
+    return best
+
+
+def main():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    results = {}
+    for name in eventloop.available():
+        results[name] = run(name, messages, rounds)
+        print("{:<8} {:>8.3f}s  {:>9.0f} messages/s"
+              "".format(name, results[name], messages / results[name]))
+    if "uvloop" in results:
+        print("uvloop is {:.2f}x asyncio"
+              "".format(results["asyncio"] / results["uvloop"]))
+    else:
+        print("uvloop is not installed, only asyncio's loop was run")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,7 +2,7 @@ from discord.ext import commands
 from .utils.chat_formatting import box
 from .utils.dataIO import dataIO
 from .utils import checks
-from __main__ import user_allowed, send_cmd_help
+from __main__ import send_cmd_help
 from copy import copy
 import os
 import discord
@@ -110,25 +110,24 @@ class Alias:
             else:
                 await self.bot.say("Nici un pseudonim aici.")
 
-    async def on_message(self, message):
-        if len(message.content) < 2 or message.channel.is_private:
+    async def run_alias(self, info):
+        """Message stage: prefixed messages in servers with aliases"""
+        message = info.message
+        if len(message.content) < 2:
             return
 
-        msg = message.content
         server = message.server
-        prefix = self.get_prefix(server, msg)
-
-        if not prefix:
-            return
-
-        if server.id in self.aliases and user_allowed(message):
-            alias = self.first_word(msg[len(prefix):]).lower()
-            if alias in self.aliases[server.id]:
-                new_command = self.aliases[server.id][alias]
-                args = message.content[len(prefix + alias):]
-                new_message = copy(message)
-                new_message.content = prefix + new_command + args
-                await self.bot.process_commands(new_message)
+        prefix = info.prefix
+        alias = self.first_word(info.rest).lower()
+        if alias in self.aliases[server.id]:
+            new_command = self.aliases[server.id][alias]
+            args = message.content[len(prefix + alias):]
+            new_message = copy(message)
+            new_message.content = prefix + new_command + args
+            await self.bot.process_commands(new_message)
+
+    def __unload(self):
+        self.bot.pipeline.remove_stage("alias")
 
     def part_of_existing_command(self, alias, server):
         '''Command or alias'''
@@ -163,11 +162,7 @@ class Alias:
         return msg.split(" ")[0]
 
     def get_prefix(self, server, msg):
-        prefixes = self.bot.settings.get_prefixes(server)
-        for p in prefixes:
-            if msg.startswith(p):
-                return p
-        return None
+        return self.bot.settings.match_prefix(server, msg)[0]
 
 
 def check_folder():
@@ -187,5 +182,10 @@ def check_file():
 
 def setup(bot):
     check_folder()
+    dataIO.use_shards("data/alias/aliases.json")
     check_file()
-    bot.add_cog(Alias(bot))
+    n = Alias(bot)
+    bot.add_cog(n)
+    bot.pipeline.add_stage("alias", n.run_alias, prefixed=True,
+                           server_only=True, allowed_only=True,
+                           servers=n.aliases)
@@ -1,11 +1,14 @@
 import discord
 from discord.ext import commands
-import threading
 import os
 from random import shuffle, choice
 from cogs.utils.dataIO import dataIO
 from cogs.utils import checks
 from cogs.utils.chat_formatting import pagify, escape
+from cogs.utils.downloads import (MaximumLength, YouTubeDlError,
+                                  DownloadTimeout, DownloadCancelled, Song,
+                                  duration_check, MetadataCache,
+                                  DownloadService)
 from urllib.parse import urlparse
 from __main__ import send_cmd_help, settings
 from json import JSONDecodeError
@@ -15,6 +18,8 @@ import collections
 import copy
 import asyncio
 import math
+import functools
+import itertools
 import time
 import inspect
 import subprocess
@@ -42,36 +47,6 @@ except:  # Missing opus
 else:
     opus = True
 
-youtube_dl_options = {
-    'source_address': '0.0.0.0',
-    'format': 'best',
-    'extractaudio': True,
-    'audioformat': "mp3",
-    'nocheckcertificate': True,
-    'ignoreerrors': False,
-    'quiet': True,
-    'no_warnings': True,
-    'outtmpl': "data/audio/cache/%(id)s",
-    'default_search': 'auto',
-    'encoding': 'utf-8'
-}
-
-
-class MaximumLength(Exception):
-    def __init__(self, m):
-        self.message = m
-
-    def __str__(self):
-        return self.message
-    
-
-class YouTubeDlError(Exception):
-    def __init__(self, m):
-        self.message = m
-
-    def __str__(self):
-        return self.message
-    
 
 class NotConnected(Exception):
     pass
@@ -139,20 +114,6 @@ class QueueKey(Enum):
 	NOW_PLAYING = 6
 	NOW_PLAYING_CHANNEL = 7
 
-class Song:
-    def __init__(self, **kwargs):
-        self.__dict__ = kwargs
-        self.title = kwargs.pop('title', None)
-        self.id = kwargs.pop('id', None)
-        self.url = kwargs.pop('url', None)
-        self.webpage_url = kwargs.pop('webpage_url', "")
-        self.duration = kwargs.pop('duration', 60)
-        self.start_time = kwargs.pop('start_time', None)
-        self.end_time = kwargs.pop('end_time', None)
-        self.thumbnail = kwargs.pop('thumbnail', None)
-        self.view_count = kwargs.pop('view_count', None)
-        self.rating = kwargs.pop('average_rating', None)
-        self.song_start_time = None
 
 class QueuedSong:
     def __init__(self, url, channel):
@@ -247,64 +208,105 @@ class Playlist:
             return None
 
 
-class Downloader(threading.Thread):
-    def __init__(self, url, max_duration=None, download=False,
-                 cache_path="data/audio/cache", *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.url = url
-        self.max_duration = max_duration
-        self.done = threading.Event()
-        self.song = None
-        self._download = download
-        self.hit_max_length = threading.Event()
-        self._yt = None
-        self.error = None
-
-    def run(self):
+
+class Prefetch:
+    """Lookahead downloads of a server's queue"""
+
+    def __init__(self):
+        self.task = None
+        self.current = None  # URL being prefetched
+        self.ready = {}  # URL: song id, downloaded ahead
+        self.failed = set()
+
+
+class CacheIndex:
+    """Size, last use and pins of the files in the audio cache
+
+    Built from the folder once, then kept up to date as songs get
+    downloaded and played, so nothing has to list the folder again.
+    Eviction removes the least recently used files first and never the
+    pinned ones: what's playing and what's queued next."""
+
+    def __init__(self, path):
+        self.path = path
+        self.files = collections.OrderedDict()  # name: size, oldest first
+        self.size = 0  # Bytes
+        self.pins = {}  # (sid, role): names
+        self.hits = 0
+        self.misses = 0
+        self.rebuild()
+
+    @property
+    def size_mb(self):
+        return self.size / 10**6
+
+    def rebuild(self):
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.is_file():
+                stat = entry.stat()
+                entries.append((max(stat.st_atime, stat.st_mtime),
+                                entry.name, stat.st_size))
+        self.files.clear()
+        for _, name, size in sorted(entries):
+            self.files[name] = size
+        self.size = sum(self.files.values())
+
+    def __contains__(self, name):
+        return name in self.files
+
+    def add(self, name):
+        """Indexes a file that's just been downloaded"""
         try:
-            self.get_info()
-            if self._download:
-                self.download()
-        except youtube_dl.utils.DownloadError as e:
-            self.error = str(e)
-        except MaximumLength:
-            self.hit_max_length.set()
-        except OSError as e:
-            log.warning("An operating system error occurred while downloading URL '{}':\n'{}'".format(self.url, str(e)))
-        self.done.set()
-
-    def download(self):
-        self.duration_check()
-
-        if not os.path.isfile('data/audio/cache' + self.song.id):
-            video = self._yt.extract_info(self.url)
-            self.song = Song(**video)
-
-    def duration_check(self):
-        log.debug("duration {} for songid {}".format(self.song.duration,
-                                                     self.song.id))
-        if self.max_duration and self.song.duration > self.max_duration:
-            log.debug("songid {} too long".format(self.song.id))
-            raise MaximumLength("songid {} has duration {} > {}".format(
-                self.song.id, self.song.duration, self.max_duration))
-
-    def get_info(self):
-        if self._yt is None:
-            self._yt = youtube_dl.YoutubeDL(youtube_dl_options)
-        if "[SEARCH:]" not in self.url:
-            video = self._yt.extract_info(self.url, download=False,
-                                          process=False)
+            size = os.path.getsize(os.path.join(self.path, name))
+        except OSError:
+            return
+        self.size += size - self.files.get(name, 0)
+        self.files[name] = size
+        self.files.move_to_end(name)
+
+    def touch(self, name):
+        """Marks a file as just used"""
+        if name in self.files:
+            self.files.move_to_end(name)
+
+    def record(self, hit):
+        if hit:
+            self.hits += 1
         else:
-            self.url = self.url[9:]
-            yt_id = self._yt.extract_info(
-                self.url, download=False)["entries"][0]["id"]
-            # Should handle errors here ^
-            self.url = "https://youtube.com/watch?v={}".format(yt_id)
-            video = self._yt.extract_info(self.url, download=False,
-                                          process=False)
-
-        if(video is not None):
-            self.song = Song(**video)
+            self.misses += 1
+
+    def pin(self, sid, role, names):
+        self.pins[(sid, role)] = frozenset(n for n in names if n)
+
+    def unpin(self, sid, role=None):
+        for key in list(self.pins):
+            if key[0] == sid and (role is None or key[1] == role):
+                del self.pins[key]
+
+    def pinned(self):
+        return set().union(*self.pins.values())
+
+    def evict(self, max_size):
+        """Removes unpinned files, least recently used first, until the
+        cache is at most max_size bytes. Returns the bytes freed"""
+        pinned = self.pinned()
+        freed = 0
+        for name in list(self.files):
+            if self.size <= max_size:
+                break
+            if name in pinned:
+                continue
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+            except OSError:  # A folder, or in use on Windows
+                continue
+            size = self.files.pop(name)
+            self.size -= size
+            freed += size
+        return freed
 
 
 class Audio:
@@ -313,12 +315,24 @@ class Audio:
     def __init__(self, bot, player):
         self.bot = bot
         self.queue = {}  # add deque's, repeat
-        self.downloaders = {}  # sid: object
+        self.downloaders = {}  # sid: DownloadJob
         self.settings = dataIO.load_json("data/audio/settings.json")
+        self.metadata = MetadataCache(
+            bot.loop, "data/audio/metadata.sqlite3",
+            ttl=self.settings["METADATA_TTL"])
+        self.cache_index = CacheIndex("data/audio/cache")
+        self.prefetches = {}  # sid: Prefetch
+        self.prefetch_hits = 0
+        self.prefetch_misses = 0
+        self.download_service = DownloadService(
+            bot.loop, workers=self.settings["DOWNLOAD_WORKERS"],
+            per_server=self.settings["SERVER_DOWNLOADS"],
+            metadata=self.metadata, index=self.cache_index)
         self.settings_path = "data/audio/settings.json"
         self.server_specific_setting_keys = ["VOLUME", "VOTE_ENABLED",
                                              "VOTE_THRESHOLD", "NOPPL_DISCONNECT",
-                                             "NOTIFY", "NOTIFY_CHANNEL", "TIMER_DISCONNECT"]
+                                             "NOTIFY", "NOTIFY_CHANNEL", "TIMER_DISCONNECT",
+                                             "PREFETCH"]
         self.cache_path = "data/audio/cache"
         self.local_playlist_path = "data/audio/localtracks"
         self._old_game = False
@@ -359,17 +373,6 @@ class Audio:
         queued_song = QueuedSong(url, channel)
         self.queue[server.id][QueueKey.QUEUE].appendleft(queued_song)
 
-    def _cache_desired_files(self):
-        filelist = []
-        for server in self.downloaders:
-            song = self.downloaders[server].song
-            try:
-                filelist.append(song.id)
-            except AttributeError:
-                pass
-        shuffle(filelist)
-        return filelist
-
     def _cache_max(self):
         setting_max = self.settings["MAX_CACHE"]
         return max([setting_max, self._cache_min()])  # enforcing hard limit
@@ -378,22 +381,8 @@ class Audio:
         x = self._server_count()
         return max([60, 48 * math.log(x) * x**0.3])  # log is not log10
 
-    def _cache_required_files(self):
-        queue = copy.deepcopy(self.queue)
-        filelist = []
-        for server in queue:
-            now_playing = queue[server].get(QueueKey.NOW_PLAYING)
-            try:
-                filelist.append(now_playing.id)
-            except AttributeError:
-                pass
-        return filelist
-
     def _cache_size(self):
-        songs = os.listdir(self.cache_path)
-        size = sum(map(lambda s: os.path.getsize(
-            os.path.join(self.cache_path, s)) / 10**6, songs))
-        return size
+        return self.cache_index.size_mb
 
     def _cache_too_large(self):
         if self._cache_size() > self._cache_max():
@@ -401,6 +390,7 @@ class Audio:
         return False
 
     def _clear_queue(self, server):
+        self._cancel_prefetch(server)
         if server.id not in self.queue:
             return
         self.queue[server.id][QueueKey.QUEUE] = deque()
@@ -436,6 +426,7 @@ class Audio:
             song_filename = os.path.join(self.local_playlist_path, filename)
         else:
             song_filename = os.path.join(self.cache_path, filename)
+            self.cache_index.touch(filename)
 
         use_avconv = self.settings["AVCONV"]
         options = '-b:a 64k -bufsize 64k'
@@ -489,89 +480,137 @@ class Audio:
 
         await voice_client.disconnect()
 
-    async def _download_all(self, queued_song_list, channel):
+    async def _download_all(self, queued_song_list, channel, server=None):
         """
         Doesn't actually download, just get's info for uses like queue_list
         """
-        downloaders = []
-        for queued_song in queued_song_list:
-            d = Downloader(queued_song.url)
-            d.start()
-            downloaders.append(d)
-
-        while any([d.is_alive() for d in downloaders]):
-            await asyncio.sleep(0.1)
-            
-        songs = [d.song for d in downloaders if d.song is not None and d.error is None]
-           
-        invalid_downloads = [d for d in downloaders if d.error is not None]
-        invalid_number = len(invalid_downloads)
+        sid = server.id if server is not None else None
+        jobs = [self.download_service.info(q.url, sid)
+                for q in queued_song_list]
+        timeout = self.settings["INFO_TIMEOUT"]
+        results = await asyncio.gather(*[j.wait(timeout) for j in jobs],
+                                       return_exceptions=True)
+
+        songs = [r for r in results if isinstance(r, Song)]
+
+        invalid_number = len([r for r in results
+                              if isinstance(r, YouTubeDlError)])
         if(invalid_number > 0):
             await self.bot.send_message(channel, "The queue contains {} item(s)"
                                             " that can not be played.".format(invalid_number))
 
         return songs
 
-    async def _download_next(self, server, curr_dl, next_dl):
-        """Checks to see if we need to download the next, and does.
-
-        Both curr_dl and next_dl should already be started."""
-        if curr_dl.song is None:
-            # Only happens when the downloader thread hasn't initialized fully
-            #   There's no reason to wait if we can't compare
-            return
-
+    def _upcoming(self, server, depth=None):
+        """The next songs to play that can be downloaded, up to the
+        server's prefetch depth"""
+        if server.id not in self.queue:
+            return []
+        if depth is None:
+            depth = self.get_server_settings(server)["PREFETCH"]
+        queues = self.queue[server.id]
+        upcoming = itertools.chain(queues[QueueKey.TEMP_QUEUE],
+                                   queues[QueueKey.QUEUE])
+        return [s for s in itertools.islice(upcoming, depth)
+                if self._valid_playable_url(s.url) or "[SEARCH:]" in s.url]
+
+    def _schedule_prefetch(self, server):
+        """Starts downloading the next songs, and cancels the download of
+        one that isn't coming up anymore"""
+        prefetch = self.prefetches.setdefault(server.id, Prefetch())
+        urls = [s.url for s in self._upcoming(server)]
+        prefetch.ready = {u: i for u, i in prefetch.ready.items() if u in urls}
+        prefetch.failed.intersection_update(urls)
+        self.cache_index.pin(server.id, "next", prefetch.ready.values())
+
+        running = prefetch.task is not None and not prefetch.task.done()
+        if running and prefetch.current not in urls:
+            prefetch.task.cancel()
+            running = False
+        todo = [u for u in urls
+                if u not in prefetch.ready and u not in prefetch.failed]
+        if todo and not running:
+            prefetch.task = self.bot.loop.create_task(
+                self._prefetch(server, prefetch))
+
+    def _cancel_prefetch(self, server):
+        prefetch = self.prefetches.pop(server.id, None)
+        if prefetch is not None and prefetch.task is not None:
+            prefetch.task.cancel()
+        self.cache_index.unpin(server.id, "next")
+
+    async def _prefetch(self, server, prefetch):
+        """Downloads the upcoming songs one at a time, in queue order"""
         max_length = self.settings["MAX_LENGTH"]
-
-        while next_dl.is_alive():
-            await asyncio.sleep(0.5)
-            
-        error = next_dl.error
-        if(error is not None):
-            raise YouTubeDlError(error)
-
-        if curr_dl.song.id != next_dl.song.id:
-            log.debug("downloader ID's mismatch on sid {}".format(server.id) +
-                      " gonna start dl-ing the next thing on the queue"
-                      " id {}".format(next_dl.song.id))
-            try:
-                next_dl.duration_check()
-            except MaximumLength:
-                return
-            self.downloaders[server.id] = Downloader(next_dl.url, max_length,
-                                                     download=True)
-            self.downloaders[server.id].start()
-
-    def _dump_cache(self, ignore_desired=False):
-        reqd = self._cache_required_files()
-        log.debug("required cache files:\n\t{}".format(reqd))
-
-        opt = self._cache_desired_files()
-        log.debug("desired cache files:\n\t{}".format(opt))
-
-        prev_size = self._cache_size()
-
-        for file in os.listdir(self.cache_path):
-            if file not in reqd:
-                if ignore_desired or file not in opt:
+        try:
+            while True:
+                upcoming = self._upcoming(server)
+                todo = [s for s in upcoming if s.url not in prefetch.ready
+                        and s.url not in prefetch.failed]
+                if not todo:
+                    break
+                queued = todo[0]
+                if queued is not upcoming[0] and self._cache_too_large():
+                    break  # Over MAX_CACHE, the rest will wait their turn
+                prefetch.current = queued.url
+                try:
+                    song = await self._prefetch_song(server, queued.url,
+                                                     max_length)
+                except DownloadTimeout:
+                    prefetch.failed.add(queued.url)  # _play will retry
+                except YouTubeDlError as e:
+                    prefetch.failed.add(queued.url)
+                    # queue_manager may have taken it out to play it in
+                    # the meantime. Then _play reports the error itself
+                    queues = self.queue.get(server.id, {})
+                    removed = False
+                    for key in (QueueKey.TEMP_QUEUE, QueueKey.QUEUE):
+                        if queued in queues.get(key, ()):
+                            queues[key].remove(queued)
+                            removed = True
+                    if not removed:
+                        continue
+                    clean_url = self._clean_url(queued.url)
+                    message = ("I'm unable to play '{}' because of an "
+                              "error:\n'{}'".format(clean_url, str(e)))
+                    message = escape(message, mass_mentions=True)
                     try:
-                        os.remove(os.path.join(self.cache_path, file))
-                    except OSError:
-                        # A directory got in the cache?
-                        pass
-                    except WindowsError:
-                        # Removing a file in use, reqd failed
-                        pass
-
-        post_size = self._cache_size()
-        dumped = prev_size - post_size
-
-        if not ignore_desired and self._cache_too_large():
-            log.debug("must dump desired files")
-            return dumped + self._dump_cache(ignore_desired=True)
-
+                        await self.bot.send_message(queued.channel, message)
+                    except discord.DiscordException as e:
+                        log.warning("Couldn't report the failed download "
+                                    "of {} on sid {}: {}".format(
+                                        clean_url, server.id, e))
+                except MaximumLength:
+                    prefetch.failed.add(queued.url)
+                except DownloadCancelled:
+                    break
+                else:
+                    prefetch.ready[queued.url] = song.id
+                    self.cache_index.pin(server.id, "next",
+                                         prefetch.ready.values())
+        finally:
+            prefetch.current = None
+
+    async def _prefetch_song(self, server, url, max_length):
+        job = self.download_service.info(url, server.id)
+        try:
+            song = await job.wait(self.settings["INFO_TIMEOUT"])
+            duration_check(song, max_length)
+            if song.id in self.cache_index:
+                return song
+            log.debug("prefetching songid {} on sid {}".format(song.id,
+                                                               server.id))
+            job = self.download_service.download(url, server.id, max_length)
+            return await job.wait(self.settings["DOWNLOAD_TIMEOUT"])
+        except asyncio.CancelledError:
+            self.download_service.release(job, server.id)
+            raise
+
+    def _dump_cache(self, max_size=0):
+        """Evicts songs until the cache is at most max_size MB, except
+        for the ones playing and queued next. Returns the MB freed"""
+        dumped = self.cache_index.evict(max_size * 10**6) / 10**6
         log.debug("dumped {} MB of audio files".format(dumped))
-
         return dumped
 
     # TODO: _enable_controls()
@@ -637,51 +676,37 @@ class Audio:
 
     async def _guarantee_downloaded(self, server, url):
         max_length = self.settings["MAX_LENGTH"]
-        if server.id not in self.downloaders:  # We don't have a downloader
-            log.debug("sid {} not in downloaders, making one".format(
-                server.id))
-            self.downloaders[server.id] = Downloader(url, max_length)
-
-        if self.downloaders[server.id].url != url:  # Our downloader is old
-            # I'm praying to Jeezus that we don't accidentally lose a running
-            #   Downloader
-            log.debug("sid {} in downloaders but wrong url".format(server.id))
-            self.downloaders[server.id] = Downloader(url, max_length)
+        job = self.downloaders.get(server.id)
+        if job is None or job.url != url:
+            # The queue manager may have started it for us already, in that
+            #   case we get the job in progress
+            log.debug("sid {} starting a lookup".format(server.id))
+            job = self.download_service.info(url, server.id)
+            self.downloaders[server.id] = job
 
-        try:
-            # We're assuming we have the right thing in our downloader object
-            self.downloaders[server.id].start()
-            log.debug("starting our downloader for sid {}".format(server.id))
-        except RuntimeError:
-            # Queue manager already started it for us, isn't that nice?
-            pass
-
-        # Getting info w/o download
-        self.downloaders[server.id].done.wait()
-        
-        # Youtube-DL threw an exception.
-        error = self.downloaders[server.id].error
-        if(error is not None):
-            raise YouTubeDlError(error)
+        # Getting info w/o download, raises YouTubeDlError
+        song = await job.wait(self.settings["INFO_TIMEOUT"])
 
         # This will throw a maxlength exception if required
-        self.downloaders[server.id].duration_check()
-        song = self.downloaders[server.id].song
+        duration_check(song, max_length)
 
         log.debug("sid {} wants to play songid {}".format(server.id, song.id))
+        self.cache_index.pin(server.id, "playing", [song.id])
 
         # Now we check to see if we have a cache hit
-        cache_location = os.path.join(self.cache_path, song.id)
-        if not os.path.exists(cache_location):
+        hit = song.id in self.cache_index
+        self.cache_index.record(hit)
+        prefetch = self.prefetches.get(server.id)
+        if prefetch is not None:
+            if prefetch.ready.pop(url, None) is not None:
+                self.prefetch_hits += 1
+            elif prefetch.current == url:  # Still downloading it
+                self.prefetch_misses += 1
+        if not hit:
             log.debug("cache miss on song id {}".format(song.id))
-            self.downloaders[server.id] = Downloader(url, max_length,
-                                                     download=True)
-            self.downloaders[server.id].start()
-
-            while self.downloaders[server.id].is_alive():
-                await asyncio.sleep(0.5)
-
-            song = self.downloaders[server.id].song
+            job = self.download_service.download(url, server.id, max_length)
+            self.downloaders[server.id] = job
+            song = await job.wait(self.settings["DOWNLOAD_TIMEOUT"])
         else:
             log.debug("cache hit on song id {}".format(song.id))
 
@@ -810,27 +835,21 @@ class Audio:
 
     # TODO: _next_songs_in_queue
 
-    async def _parse_playlist(self, url):
+    async def _parse_playlist(self, url, server=None):
+        sid = server.id if server is not None else None
         if self._match_sc_playlist(url):
-            return await self._parse_sc_playlist(url)
+            return await self._parse_sc_playlist(url, sid)
         elif self._match_yt_playlist(url):
-            return await self._parse_yt_playlist(url)
+            return await self._parse_yt_playlist(url, sid)
         raise InvalidPlaylist("The given URL is neither a Soundcloud or"
                               " YouTube playlist.")
 
-    async def _parse_sc_playlist(self, url):
+    async def _parse_sc_playlist(self, url, sid=None):
         playlist = []
-        d = Downloader(url)
-        d.start()
-
-        while d.is_alive():
-            await asyncio.sleep(0.5)
-
-        error = d.error
-        if(error is not None):
-            raise YouTubeDlError(error)
+        song = await self.download_service.info(url, sid).wait(
+            self.settings["INFO_TIMEOUT"])
 
-        for entry in d.song.entries:
+        for entry in song.entries:
             if entry["url"][4] != "s":
                 song_url = "https{}".format(entry["url"][4:])
                 playlist.append(song_url)
@@ -839,19 +858,12 @@ class Audio:
 
         return playlist
 
-    async def _parse_yt_playlist(self, url):
-        d = Downloader(url)
-        d.start()
+    async def _parse_yt_playlist(self, url, sid=None):
+        song = await self.download_service.info(url, sid).wait(
+            self.settings["INFO_TIMEOUT"])
         playlist = []
 
-        while d.is_alive():
-            await asyncio.sleep(0.5)
-
-        error = d.error
-        if(error is not None):
-            raise YouTubeDlError(error)
-
-        for entry in d.song.entries:
+        for entry in song.entries:
             try:
                 song_url = "https://www.youtube.com/watch?v={}".format(
                     entry['id'])
@@ -891,6 +903,10 @@ class Audio:
                 message = escape(message, mass_mentions=True)
                 await self.bot.send_message(channel, message)
                 return
+            except DownloadCancelled:
+                log.debug("download of {} cancelled on sid {}".format(
+                    clean_url, server.id))
+                return
             local = False
         else:  # Assume local
             try:
@@ -1019,9 +1035,11 @@ class Audio:
 
     def _shuffle_queue(self, server):
         shuffle(self.queue[server.id][QueueKey.QUEUE])
+        self._schedule_prefetch(server)
 
     def _shuffle_temp_queue(self, server):
         shuffle(self.queue[server.id][QueueKey.TEMP_QUEUE])
+        self._schedule_prefetch(server)
 
     def _server_count(self):
         return max([1, len(self.bot.servers)])
@@ -1050,6 +1068,8 @@ class Audio:
 
         self.queue[server.id][QueueKey.NOW_PLAYING] = song
         self.queue[server.id][QueueKey.NOW_PLAYING_CHANNEL] = channel
+        self.cache_index.pin(server.id, "playing",
+                             [song.id] if song is not None else [])
 
     def _set_queue_playlist(self, server, name=True):
         if server.id not in self.queue:
@@ -1073,6 +1093,7 @@ class Audio:
         self._setup_queue(server)
         self._stop_player(server)
         self._stop_downloader(server)
+        self.cache_index.unpin(server.id)
         self.bot.loop.create_task(self._update_bot_status())
 
     async def _stop_and_disconnect(self, server):
@@ -1080,6 +1101,8 @@ class Audio:
         await self._disconnect_voice_client(server)
 
     def _stop_downloader(self, server):
+        self._cancel_prefetch(server)
+        self.download_service.cancel(server.id)
         if server.id not in self.downloaders:
             return
 
@@ -1153,7 +1176,44 @@ class Audio:
 
         self.settings["MAX_CACHE"] = size
         await self.bot.say("Max cache size set to {} MB.".format(size))
-        self.save_settings()
+        await self.save_settings_async()
+
+    @audioset.group(name="cache", invoke_without_command=True)
+    @checks.is_owner()
+    async def audioset_cache(self):
+        """Shows the song info cache's stats
+
+        Songs' info is remembered so that playing them again doesn't
+        need to look them up"""
+        stats = await self.metadata.stats()
+        await self.bot.say(
+            "Song info cache:\n"
+            "Entries: {stored} ({memory} in memory)\n"
+            "Hits: {hits} from memory, {disk_hits} from disk\n"
+            "Misses: {misses}\n"
+            "Hit rate: {hit_rate:.1%}\n"
+            "Entries expire after {ttl} seconds.".format(
+                ttl=self.metadata.ttl, **stats))
+
+    @audioset_cache.command(name="clear")
+    @checks.is_owner()
+    async def audioset_cache_clear(self):
+        """Forgets every song's info"""
+        self.metadata.clear()
+        await self.bot.say("Song info cache cleared.")
+
+    @audioset_cache.command(name="ttl")
+    @checks.is_owner()
+    async def audioset_cache_ttl(self, seconds: int):
+        """Sets after how many seconds songs' info is looked up again"""
+        if seconds <= 0:
+            await self.bot.say("The time must be positive.")
+            return
+        self.settings["METADATA_TTL"] = seconds
+        self.metadata.ttl = seconds
+        await self.bot.say("Song info will be looked up again after {} "
+                           "seconds.".format(seconds))
+        await self.save_settings_async()
 
     @audioset.command(name="emptydisconnect", pass_context=True)
     @checks.mod_or_permissions(manage_messages=True)
@@ -1171,7 +1231,7 @@ class Audio:
         else:
             await self.bot.say("The bot will no longer auto disconnect"
                                " if the voice channel is empty.")
-        self.save_settings()
+        await self.save_settings_async()
 
     @audioset.command(name="maxlength")
     @checks.is_owner()
@@ -1183,7 +1243,7 @@ class Audio:
             return
         self.settings["MAX_LENGTH"] = length
         await self.bot.say("Maximum length is now {} seconds.".format(length))
-        self.save_settings()
+        await self.save_settings_async()
 
     @checks.mod_or_permissions(manage_messages=True)
     @audioset.command(name="notifychannel", pass_context=True)
@@ -1194,7 +1254,7 @@ class Audio:
             await self.bot.say("No permissions to speak in that channel.")
             return
         self.set_server_setting(server, "NOTIFY_CHANNEL", channel.id)
-        dataIO.save_json(self.settings_path, self.settings)
+        await dataIO.save_json_async(self.settings_path, self.settings)
         await self.bot.send_message(channel, "I will now announce new songs here.")
 
     @audioset.command(name="notify", pass_context=True)
@@ -1207,12 +1267,12 @@ class Audio:
         self.set_server_setting(server, "NOTIFY", not notify)
         if self.get_server_settings(server)["NOTIFY_CHANNEL"] is None:
             self.set_server_setting(server, "NOTIFY_CHANNEL", ctx.message.channel.id)
-            dataIO.save_json(self.settings_path, self.settings)
+            await dataIO.save_json_async(self.settings_path, self.settings)
         if not notify:
             await self.bot.say("Now notifying when a new track plays.")
         else:
             await self.bot.say("No longer notifying when a new track plays.")
-        self.save_settings()
+        await self.save_settings_async()
 
     @audioset.command(name="player")
     @checks.is_owner()
@@ -1223,7 +1283,7 @@ class Audio:
             await self.bot.say("Player toggled. You're now using avconv.")
         else:
             await self.bot.say("Player toggled. You're now using ffmpeg.")
-        self.save_settings()
+        await self.save_settings_async()
 
     @audioset.command(name="status")
     @checks.is_owner()  # cause effect is cross-server
@@ -1239,7 +1299,7 @@ class Audio:
         else:
             await self.bot.say("Songs' titles will no longer show up as"
                                " status")
-        self.save_settings()
+        await self.save_settings_async()
 
     @audioset.command(name="timerdisconnect", pass_context=True)
     @checks.mod_or_permissions(manage_messages=True)
@@ -1259,7 +1319,27 @@ class Audio:
         else:
             await self.bot.say("The bot will no longer auto disconnect"
                                " while other music cogs are playing.")
-        self.save_settings()
+        await self.save_settings_async()
+
+    @audioset.command(pass_context=True, name="prefetch", no_pm=True)
+    @checks.mod_or_permissions(manage_messages=True)
+    async def audioset_prefetch(self, ctx, songs: int=None):
+        """Sets how many of the next songs are downloaded ahead (0 - 10)
+
+        More makes long queues less likely to wait between songs, but uses
+        more of the cache."""
+        server = ctx.message.server
+        if songs is None:
+            songs = self.get_server_settings(server)["PREFETCH"]
+            msg = "The next {} songs are downloaded ahead.".format(songs)
+        elif 0 <= songs <= 10:
+            self.set_server_setting(server, "PREFETCH", songs)
+            self._schedule_prefetch(server)
+            msg = "The next {} songs will be downloaded ahead.".format(songs)
+            await self.save_settings_async()
+        else:
+            msg = "The number of songs must be between 0 and 10."
+        await self.bot.say(msg)
 
     @audioset.command(pass_context=True, name="volume", no_pm=True)
     @checks.mod_or_permissions(manage_messages=True)
@@ -1282,7 +1362,7 @@ class Audio:
             if vc:
                 vc.audio_player.volume = percent / 100
 
-            self.save_settings()
+            await self.save_settings_async()
         else:
             msg = "Volume must be between 0 and 100."
         await self.bot.say(msg)
@@ -1308,7 +1388,7 @@ class Audio:
 
         self.set_server_setting(server, "VOTE_THRESHOLD", percent)
         self.set_server_setting(server, "VOTE_ENABLED", enabled)
-        self.save_settings()
+        await self.save_settings_async()
 
     @commands.group(pass_context=True)
     async def audiostat(self, ctx):
@@ -1346,13 +1426,25 @@ class Audio:
             - Current size of the cache.
             - Maximum cache size. User setting or minimum, whichever is higher.
             - Minimum cache size. Automatically determined by number of servers Red is running on.
+            - Number of songs, and how often a song to play was already cached.
+            - How often the songs being downloaded ahead were ready in time.
         """
+        index = self.cache_index
+        plays = index.hits + index.misses
+        hit_rate = index.hits / plays if plays else 0
+        prefetched = self.prefetch_hits + self.prefetch_misses
+        prefetch_rate = self.prefetch_hits / prefetched if prefetched else 0
         await self.bot.say("Cache stats:\n"
                            "Current size: {:.2f} MB\n"
                            "Maximum: {:.1f} MB\n"
-                           "Minimum: {:.1f} MB".format(self._cache_size(),
-                                                       self._cache_max(),
-                                                       self._cache_min()))
+                           "Minimum: {:.1f} MB\n"
+                           "Songs: {}\n"
+                           "Hit rate: {:.1%} of {} plays\n"
+                           "Prefetch hit rate: {:.1%} of {} prefetched "
+                           "plays".format(
+                               self._cache_size(), self._cache_max(),
+                               self._cache_min(), len(index.files),
+                               hit_rate, plays, prefetch_rate, prefetched))
 
     @commands.group(pass_context=True, hidden=True, no_pm=True)
     @checks.is_owner()
@@ -1616,7 +1708,7 @@ class Audio:
             try:
                 await self.bot.say("Enumerating song list... This could take"
                                    " a few moments.")
-                songlist = await self._parse_playlist(url)
+                songlist = await self._parse_playlist(url, server)
             except InvalidPlaylist:
                 await self.bot.say("That playlist URL is invalid.")
                 return
@@ -1852,8 +1944,10 @@ class Audio:
 
         await self.bot.say("Gathering information...")
 
-        queue_song_list = await self._download_all(queued_song_list, channel)
-        tempqueue_song_list = await self._download_all(tempqueued_song_list, channel)
+        queue_song_list = await self._download_all(queued_song_list, channel,
+                                                   server)
+        tempqueue_song_list = await self._download_all(tempqueued_song_list,
+                                                       channel, server)
 
         song_info = []
         for num, song in enumerate(tempqueue_song_list, 1):
@@ -2145,7 +2239,7 @@ class Audio:
                 # Our cache is too big, dumping
                 log.debug("cache too large ({} > {}), dumping".format(
                     self._cache_size(), self._cache_max()))
-                self._dump_cache()
+                self._dump_cache(self._cache_max())
             await asyncio.sleep(5)  # No need to run this every half second
 
     async def cache_scheduler(self):
@@ -2155,7 +2249,7 @@ class Audio:
 
     def currently_downloading(self, server):
         if server.id in self.downloaders:
-            if self.downloaders[server.id].is_alive():
+            if not self.downloaders[server.id].done():
                 return True
         return False
 
@@ -2208,6 +2302,7 @@ class Audio:
         if sid not in self.settings["SERVERS"]:
             self.settings["SERVERS"][sid] = {}
         ret = self.settings["SERVERS"][sid]
+        known = len(ret)
 
         # Not the cleanest way. Some refactoring is suggested if more settings
         # have to be added
@@ -2231,7 +2326,8 @@ class Audio:
                     ret[setting] *= 100
         # ^This will make it so that only users with an outdated config will
         # have their volume set * 100. In theory.
-        self.save_settings()
+        if len(ret) != known:  # Only saved when defaults were added
+            dataIO.mark_dirty(self.settings_path, self.settings)
 
         return ret
 
@@ -2314,37 +2410,9 @@ class Audio:
             log.debug("set now_playing for sid {}".format(server.id))
             self.bot.loop.create_task(self._update_bot_status())
 
-        elif server.id in self.downloaders:
-            # We're playing but we might be able to download a new song
-            curr_dl = self.downloaders.get(server.id)
-            if len(temp_queue) > 0:
-                queued_next_song = temp_queue.peekleft()
-                next_url = queued_next_song.url
-                next_channel = queued_next_song.channel
-                next_dl = Downloader(next_url, max_length)
-            elif len(queue) > 0:
-                queued_next_song = queue.peekleft()
-                next_url = queued_next_song.url
-                next_channel = queued_next_song.channel	
-                next_dl = Downloader(next_url, max_length)
-            else:
-                next_dl = None
-
-            if next_dl is not None:
-                try:
-                    # Download next song
-                    next_dl.start()
-                    await self._download_next(server, curr_dl, next_dl)
-                except YouTubeDlError as e:
-                    if len(temp_queue) > 0:
-                        temp_queue.popleft()
-                    elif len(queue) > 0:
-                        queue.popleft()
-                    clean_url = self._clean_url(next_url)
-                    message = ("I'm unable to play '{}' because of an "
-                              "error:\n'{}'".format(clean_url, str(e)))
-                    message = escape(message, mass_mentions=True)
-                    await self.bot.send_message(next_channel, message)
+        else:
+            # We're playing, let's get the next songs ready
+            self._schedule_prefetch(server)
 
     async def display_now_playing(self, server, song, notify_channel:int):
         channel = discord.utils.get(server.channels, id=notify_channel)
@@ -2399,10 +2467,8 @@ class Audio:
                 #           " for sid: {}".format(sid))
                 tasks.append(
                     self.bot.loop.create_task(self.queue_manager(sid)))
-            completed = [t.done() for t in tasks]
-            while not all(completed):
-                completed = [t.done() for t in tasks]
-                await asyncio.sleep(0.5)
+            if tasks:
+                await asyncio.wait(tasks)
             await asyncio.sleep(1)
 
     async def reload_monitor(self):
@@ -2418,6 +2484,9 @@ class Audio:
     def save_settings(self):
         dataIO.save_json('data/audio/settings.json', self.settings)
 
+    async def save_settings_async(self):
+        await dataIO.save_json_async(self.settings_path, self.settings)
+
     def set_server_setting(self, server, key, value):
         if server.id not in self.settings["SERVERS"]:
             self.settings["SERVERS"][server.id] = {}
@@ -2464,6 +2533,8 @@ class Audio:
                 vc.audio_player.resume()
 
     def __unload(self):
+        self.download_service.close()
+        self.metadata.close()
         for vc in self.bot.voice_clients:
             self.bot.loop.create_task(vc.disconnect())
 
@@ -2481,13 +2552,16 @@ def check_files():
     default = {"VOLUME": 50, "MAX_LENGTH": 3700, "VOTE_ENABLED": True,
                "MAX_CACHE": 0, "SOUNDCLOUD_CLIENT_ID": None,
                "TITLE_STATUS": True, "AVCONV": False, "VOTE_THRESHOLD": 50,
-               "SERVERS": {}}
+               "DOWNLOAD_WORKERS": 4, "SERVER_DOWNLOADS": 2,
+               "INFO_TIMEOUT": 60, "DOWNLOAD_TIMEOUT": 300,
+               "METADATA_TTL": 86400, "PREFETCH": 3, "SERVERS": {}}
     settings_path = "data/audio/settings.json"
 
-    if not os.path.isfile(settings_path):
+    # Not isfile: once in the SQLite store there's no json file anymore
+    if not dataIO.is_valid_json(settings_path):
         print("Creating default audio settings.json...")
         dataIO.save_json(settings_path, default)
-    else:  # consistency check
+    else:  # consistency check, on what dataIO loads
         try:
             current = dataIO.load_json(settings_path)
         except JSONDecodeError:
@@ -2504,6 +2578,7 @@ def check_files():
             dataIO.save_json(settings_path, current)
 
 
+@functools.lru_cache(maxsize=1)  # Probed once by prepare, reused by setup
 def verify_ffmpeg_avconv():
     try:
         subprocess.call(["ffmpeg", "-version"], stdout=subprocess.DEVNULL)
@@ -2520,8 +2595,15 @@ def verify_ffmpeg_avconv():
         return "avconv"
 
 
+def prepare():
+    verify_ffmpeg_avconv()
+    dataIO.prefetch("data/audio/settings.json")
+
+
 def setup(bot):
     check_folders()
+    # One row per global setting and per server
+    dataIO.use_sqlite("data/audio/settings.json", depth=2)
     check_files()
 
     if youtube_dl is None:
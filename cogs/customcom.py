@@ -121,33 +121,31 @@ class CustomCommands:
             for page in pagify(commands, delims=[" ", "\n"]):
                 await self.bot.whisper(box(page))
 
-    async def on_message(self, message):
-        if len(message.content) < 2 or message.channel.is_private:
+    async def run_command(self, info):
+        """Message stage: prefixed messages in servers with custom
+        commands"""
+        message = info.message
+        if len(message.content) < 2:
             return
 
-        server = message.server
-        prefix = self.get_prefix(message)
+        cmdlist = self.c_commands[message.server.id]
+        cmd = info.rest
+        if cmd in cmdlist:
+            cmd = cmdlist[cmd]
+            cmd = self.format_cc(cmd, message)
+            await self.bot.send_message(message.channel, cmd)
+        elif cmd.lower() in cmdlist:
+            cmd = cmdlist[cmd.lower()]
+            cmd = self.format_cc(cmd, message)
+            await self.bot.send_message(message.channel, cmd)
 
-        if not prefix:
-            return
-
-        if server.id in self.c_commands and self.bot.user_allowed(message):
-            cmdlist = self.c_commands[server.id]
-            cmd = message.content[len(prefix):]
-            if cmd in cmdlist:
-                cmd = cmdlist[cmd]
-                cmd = self.format_cc(cmd, message)
-                await self.bot.send_message(message.channel, cmd)
-            elif cmd.lower() in cmdlist:
-                cmd = cmdlist[cmd.lower()]
-                cmd = self.format_cc(cmd, message)
-                await self.bot.send_message(message.channel, cmd)
+    def __unload(self):
+        self.bot.pipeline.remove_stage("customcom")
 
     def get_prefix(self, message):
-        for p in self.bot.settings.get_prefixes(message.server):
-            if message.content.startswith(p):
-                return p
-        return False
+        prefix = self.bot.settings.match_prefix(message.server,
+                                                message.content)[0]
+        return prefix if prefix is not None else False
 
     def format_cc(self, command, message):
         results = re.findall("\{([^}]+)\}", command)
@@ -196,5 +194,10 @@ def check_files():
 
 def setup(bot):
     check_folders()
+    dataIO.use_shards("data/customcom/commands.json")
     check_files()
-    bot.add_cog(CustomCommands(bot))
+    n = CustomCommands(bot)
+    bot.add_cog(n)
+    bot.pipeline.add_stage("customcom", n.run_command, prefixed=True,
+                           server_only=True, allowed_only=True,
+                           servers=n.c_commands)
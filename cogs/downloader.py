@@ -702,6 +702,12 @@ def check_files():
         dataIO.save_json(f, {})
 
 
+def prepare():
+    check_folders()
+    check_files()
+    dataIO.prefetch(os.path.join("data", "downloader", "repos.json"))
+
+
 def setup(bot):
     check_folders()
     check_files()
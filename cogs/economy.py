@@ -1,6 +1,6 @@
 import discord
 from discord.ext import commands
-from cogs.utils.dataIO import dataIO
+from cogs.utils.dataIO import dataIO, COMPACT
 from collections import namedtuple, defaultdict, deque
 from datetime import datetime
 from copy import deepcopy
@@ -248,7 +248,7 @@ class Bank:
         return Account(**account)
 
     def _save_bank(self):
-        dataIO.save_json("data/economy/bank.json", self.accounts)
+        dataIO.mark_dirty("data/economy/bank.json", self.accounts)
 
     def _get_account(self, user):
         server = user.server
@@ -632,7 +632,7 @@ class Economy:
         server = ctx.message.server
         self.settings[server.id]["SLOT_MIN"] = bid
         await self.bot.say("Minimul amu este de {} banuti.".format(bid))
-        dataIO.save_json(self.file_path, self.settings)
+        await dataIO.save_json_async(self.file_path, self.settings)
 
     @economyset.command(pass_context=True)
     async def slotmax(self, ctx, bid: int):
@@ -640,7 +640,7 @@ class Economy:
         server = ctx.message.server
         self.settings[server.id]["SLOT_MAX"] = bid
         await self.bot.say("Amu poti baga pana la {} banuti.".format(bid))
-        dataIO.save_json(self.file_path, self.settings)
+        await dataIO.save_json_async(self.file_path, self.settings)
 
     @economyset.command(pass_context=True)
     async def slottime(self, ctx, seconds: int):
@@ -648,7 +648,7 @@ class Economy:
         server = ctx.message.server
         self.settings[server.id]["SLOT_TIME"] = seconds
         await self.bot.say("Cooldown-ul e amu {} secunde.".format(seconds))
-        dataIO.save_json(self.file_path, self.settings)
+        await dataIO.save_json_async(self.file_path, self.settings)
 
     @economyset.command(pass_context=True)
     async def paydaytime(self, ctx, seconds: int):
@@ -657,7 +657,7 @@ class Economy:
         self.settings[server.id]["PAYDAY_TIME"] = seconds
         await self.bot.say("Macar  {} secunde sa treaca"
                            "intre fiecare payday.".format(seconds))
-        dataIO.save_json(self.file_path, self.settings)
+        await dataIO.save_json_async(self.file_path, self.settings)
 
     @economyset.command(pass_context=True)
     async def paydaycredits(self, ctx, credits: int):
@@ -666,7 +666,7 @@ class Economy:
         self.settings[server.id]["PAYDAY_CREDITS"] = credits
         await self.bot.say("un payday va da {} banuti."
                            "".format(credits))
-        dataIO.save_json(self.file_path, self.settings)
+        await dataIO.save_json_async(self.file_path, self.settings)
 
     @economyset.command(pass_context=True)
     async def registercredits(self, ctx, credits: int):
@@ -677,7 +677,7 @@ class Economy:
         self.settings[server.id]["REGISTER_CREDITS"] = credits
         await self.bot.say("amu cand iti faci cont primesti {} banuti."
                            "".format(credits))
-        dataIO.save_json(self.file_path, self.settings)
+        await dataIO.save_json_async(self.file_path, self.settings)
 
     # What would I ever do without stackoverflow?
     def display_time(self, seconds, granularity=2):
@@ -720,9 +720,18 @@ def check_files():
         dataIO.save_json(f, {})
 
 
+def prepare():
+    dataIO.prefetch("data/economy/bank.json", "data/economy/settings.json")
+
+
 def setup(bot):
     global logger
+    dataIO.set_format("data/economy/bank.json", COMPACT)
     check_folders()
+    bank = "data/economy/bank.json"
+    # The first storage that's enabled is used
+    if not (dataIO.use_sqlite(bank, depth=2) or dataIO.use_shards(bank)):
+        dataIO.use_journal(bank, depth=2)
     check_files()
     logger = logging.getLogger("red.economy")
     if logger.level == 0:
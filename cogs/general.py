@@ -43,6 +43,7 @@ class General:
                      "Iti zic m-ai tarziu", "M-ai bine nu zic", "Mie lene sa raspund", "Formuleaza diferit intrebarea",
                      "Nu cred", "Eo sunt sigur ca nu", "Sursele mele spun nu", "Meh,NU.", "NU MA"]
         self.poll_sessions = []
+        self.poll_channels = set()  # Where the message stage listens
 
     @commands.command(hidden=True)
     async def ping(self):
@@ -343,6 +344,7 @@ class General:
             p = NewPoll(message, " ".join(text), self)
             if p.valid:
                 self.poll_sessions.append(p)
+                self.poll_channels.add(message.channel.id)
                 await p.start()
             else:
                 await self.bot.say("Intrebarea;Raspuns1;Raspuns2 (...)")
@@ -365,10 +367,14 @@ class General:
                 return poll
         return False
 
-    async def check_poll_votes(self, message):
-        if message.author.id != self.bot.user.id:
-            if self.getPollByChannel(message):
-                    self.getPollByChannel(message).checkAnswer(message)
+    async def check_poll_votes(self, info):
+        """Message stage: channels with a poll"""
+        poll = self.getPollByChannel(info.message)
+        if poll:
+            poll.checkAnswer(info.message)
+
+    def __unload(self):
+        self.bot.pipeline.remove_stage("poll")
 
     def fetch_joined_at(self, user, server):
         """Just a special case for someone special :^)"""
@@ -383,6 +389,7 @@ class NewPoll():
         self.author = message.author.id
         self.client = main.bot
         self.poll_sessions = main.poll_sessions
+        self.poll_channels = main.poll_channels
         msg = [ans.strip() for ans in text.split(";")]
         if len(msg) < 2: # Needs at least one question and 2 choices
             self.valid = False
@@ -415,6 +422,7 @@ class NewPoll():
             msg += "*{}* - {} votes\n".format(data["ANSWER"], str(data["VOTES"]))
         await self.client.send_message(self.channel, msg)
         self.poll_sessions.remove(self)
+        self.poll_channels.discard(self.channel.id)
 
     def checkAnswer(self, message):
         try:
@@ -430,5 +438,6 @@ class NewPoll():
 
 def setup(bot):
     n = General(bot)
-    bot.add_listener(n.check_poll_votes, "on_message")
     bot.add_cog(n)
+    bot.pipeline.add_stage("poll", n.check_poll_votes,
+                           channels=n.poll_channels)
@@ -1,6 +1,6 @@
 import discord
 from discord.ext import commands
-from .utils.dataIO import dataIO
+from .utils.dataIO import dataIO, COMPACT
 from .utils import checks
 from __main__ import send_cmd_help, settings
 from datetime import datetime
@@ -11,6 +11,8 @@ import re
 import logging
 import asyncio
 
+LAZY_LOAD = False  # Bot.user_allowed reads its ignore list
+
 
 ACTIONS_REPR = {
     "BAN"     : ("Ban", "\N{HAMMER}"),
@@ -95,6 +97,7 @@ class Mod:
     def __init__(self, bot):
         self.bot = bot
         self.ignore_list = dataIO.load_json("data/mod/ignorelist.json")
+        self.bot.allow_policy.set_ignore_list(self.ignore_list)
         self.filter = dataIO.load_json("data/mod/filter.json")
         self.past_names = dataIO.load_json("data/mod/past_names.json")
         self.past_nicknames = dataIO.load_json("data/mod/past_nicknames.json")
@@ -106,6 +109,9 @@ class Mod:
         self.temp_cache = TempCache(bot)
         perms_cache = dataIO.load_json("data/mod/perms_cache.json")
         self._perms_cache = defaultdict(dict, perms_cache)
+        self.moderated_servers = set()  # Where the message stage listens
+        for sid in set(self.filter) | set(self.settings):
+            self.update_moderated(sid)
 
     @commands.group(pass_context=True, no_pm=True)
     @checks.serverowner_or_permissions(administrator=True)
@@ -159,7 +165,7 @@ class Mod:
                 return
             self.settings[server.id]["mod-log"] = None
             await self.bot.say("Mod log deactivated.")
-        dataIO.save_json("data/mod/settings.json", self.settings)
+        await dataIO.save_json_async("data/mod/settings.json", self.settings)
 
     @modset.command(pass_context=True, no_pm=True)
     async def banmentionspam(self, ctx, max_mentions : int=False):
@@ -181,7 +187,8 @@ class Mod:
                 return
             self.settings[server.id]["ban_mention_spam"] = False
             await self.bot.say("Autoban for mention spam disabled.")
-        dataIO.save_json("data/mod/settings.json", self.settings)
+        self.update_moderated(server.id)
+        await dataIO.save_json_async("data/mod/settings.json", self.settings)
 
     @modset.command(pass_context=True, no_pm=True)
     async def deleterepeats(self, ctx):
@@ -194,14 +201,15 @@ class Mod:
         else:
             self.settings[server.id]["delete_repeats"] = False
             await self.bot.say("Repeated messages will be ignored.")
-        dataIO.save_json("data/mod/settings.json", self.settings)
+        self.update_moderated(server.id)
+        await dataIO.save_json_async("data/mod/settings.json", self.settings)
 
     @modset.command(pass_context=True, no_pm=True)
     async def resetcases(self, ctx):
         """Resets modlog's cases"""
         server = ctx.message.server
         self.cases[server.id] = {}
-        dataIO.save_json("data/mod/modlog.json", self.cases)
+        await dataIO.save_json_async("data/mod/modlog.json", self.cases)
         await self.bot.say("Cases have been reset.")
 
     @modset.command(pass_context=True, no_pm=True)
@@ -219,7 +227,7 @@ class Mod:
             else:
                 await self.bot.say("Delete delay set to {}"
                                    " seconds.".format(time))
-            dataIO.save_json("data/mod/settings.json", self.settings)
+            await dataIO.save_json_async("data/mod/settings.json", self.settings)
         else:
             try:
                 delay = self.settings[server.id]["delete_delay"]
@@ -273,7 +281,7 @@ class Mod:
                                                  default_settings[action])
             if value != enabled:
                 self.settings[server.id][action] = enabled
-                dataIO.save_json("data/mod/settings.json", self.settings)
+                await dataIO.save_json_async("data/mod/settings.json", self.settings)
             msg = ('Case creation for %s actions %s %s.' %
                    (name.lower(),
                     'was already' if enabled == value else 'is now',
@@ -296,7 +304,7 @@ class Mod:
             self.settings[server.id]["respect_hierarchy"] = False
             await self.bot.say("Role hierarchy will be ignored when "
                                "moderation commands are issued.")
-        dataIO.save_json("data/mod/settings.json", self.settings)
+        await dataIO.save_json_async("data/mod/settings.json", self.settings)
 
     @commands.command(no_pm=True, pass_context=True)
     @checks.admin_or_permissions(kick_members=True)
@@ -531,7 +539,7 @@ class Mod:
                                "permission and the user I'm muting must be "
                                "lower than myself in the role hierarchy.")
         else:
-            dataIO.save_json("data/mod/perms_cache.json", self._perms_cache)
+            await dataIO.save_json_async("data/mod/perms_cache.json", self._perms_cache)
             await self.new_case(server,
                                 action="CMUTE",
                                 channel=channel,
@@ -576,7 +584,7 @@ class Mod:
             await self.bot.say("Acel membru deja are mute.")
             return
         self._perms_cache[user.id] = register
-        dataIO.save_json("data/mod/perms_cache.json", self._perms_cache)
+        await dataIO.save_json_async("data/mod/perms_cache.json", self._perms_cache)
         await self.new_case(server,
                             action="SMUTE",
                             mod=author,
@@ -635,7 +643,7 @@ class Mod:
                 pass
             if user.id in self._perms_cache and not self._perms_cache[user.id]:
                 del self._perms_cache[user.id]  # cleanup
-            dataIO.save_json("data/mod/perms_cache.json", self._perms_cache)
+            await dataIO.save_json_async("data/mod/perms_cache.json", self._perms_cache)
             await self.bot.say("User has been unmuted in this channel.")
 
     @checks.mod_or_permissions(administrator=True)
@@ -682,7 +690,7 @@ class Mod:
                     await asyncio.sleep(0.1)
         if user.id in self._perms_cache and not self._perms_cache[user.id]:
             del self._perms_cache[user.id]  # cleanup
-        dataIO.save_json("data/mod/perms_cache.json", self._perms_cache)
+        await dataIO.save_json_async("data/mod/perms_cache.json", self._perms_cache)
         await self.bot.say("User has been unmuted in this server.")
 
     @commands.group(pass_context=True)
@@ -876,27 +884,16 @@ class Mod:
         is_bot = self.bot.user.bot
         has_permissions = channel.permissions_for(server.me).manage_messages
 
-        prefixes = self.bot.command_prefix
-        if isinstance(prefixes, str):
-            prefixes = [prefixes]
-        elif callable(prefixes):
-            if asyncio.iscoroutine(prefixes):
-                await self.bot.say('Coroutine prefixes not yet implemented.')
-                return
-            prefixes = prefixes(self.bot, ctx.message)
-
-        # In case some idiot sets a null prefix
-        if '' in prefixes:
-            prefixes.pop('')
+        matcher = self.bot.settings.get_prefix_matcher(server)
 
         def check(m):
             if m.author.id == self.bot.user.id:
                 return True
             elif m == ctx.message:
                 return True
-            p = discord.utils.find(m.content.startswith, prefixes)
-            if p and len(p) > 0:
-                return m.content[len(p):].startswith(tuple(self.bot.commands))
+            p, rest = matcher.match(m.content)
+            if p:  # In case some idiot sets a null prefix
+                return rest.startswith(tuple(self.bot.commands))
             return False
 
         to_delete = [ctx.message]
@@ -1059,14 +1056,14 @@ class Mod:
         if not channel:
             if current_ch.id not in self.ignore_list["CHANNELS"]:
                 self.ignore_list["CHANNELS"].append(current_ch.id)
-                dataIO.save_json("data/mod/ignorelist.json", self.ignore_list)
+                await self.save_ignore_list()
                 await self.bot.say("Channel added to ignore list.")
             else:
                 await self.bot.say("Channel already in ignore list.")
         else:
             if channel.id not in self.ignore_list["CHANNELS"]:
                 self.ignore_list["CHANNELS"].append(channel.id)
-                dataIO.save_json("data/mod/ignorelist.json", self.ignore_list)
+                await self.save_ignore_list()
                 await self.bot.say("Channel added to ignore list.")
             else:
                 await self.bot.say("Channel already in ignore list.")
@@ -1077,7 +1074,7 @@ class Mod:
         server = ctx.message.server
         if server.id not in self.ignore_list["SERVERS"]:
             self.ignore_list["SERVERS"].append(server.id)
-            dataIO.save_json("data/mod/ignorelist.json", self.ignore_list)
+            await self.save_ignore_list()
             await self.bot.say("This server has been added to the ignore list.")
         else:
             await self.bot.say("This server is already being ignored.")
@@ -1099,14 +1096,14 @@ class Mod:
         if not channel:
             if current_ch.id in self.ignore_list["CHANNELS"]:
                 self.ignore_list["CHANNELS"].remove(current_ch.id)
-                dataIO.save_json("data/mod/ignorelist.json", self.ignore_list)
+                await self.save_ignore_list()
                 await self.bot.say("This channel has been removed from the ignore list.")
             else:
                 await self.bot.say("This channel is not in the ignore list.")
         else:
             if channel.id in self.ignore_list["CHANNELS"]:
                 self.ignore_list["CHANNELS"].remove(channel.id)
-                dataIO.save_json("data/mod/ignorelist.json", self.ignore_list)
+                await self.save_ignore_list()
                 await self.bot.say("Channel removed from ignore list.")
             else:
                 await self.bot.say("That channel is not in the ignore list.")
@@ -1117,11 +1114,30 @@ class Mod:
         server = ctx.message.server
         if server.id in self.ignore_list["SERVERS"]:
             self.ignore_list["SERVERS"].remove(server.id)
-            dataIO.save_json("data/mod/ignorelist.json", self.ignore_list)
+            await self.save_ignore_list()
             await self.bot.say("This server has been removed from the ignore list.")
         else:
             await self.bot.say("This server is not in the ignore list.")
 
+    async def save_ignore_list(self):
+        self.bot.allow_policy.set_ignore_list(self.ignore_list)
+        await dataIO.save_json_async("data/mod/ignorelist.json",
+                                     self.ignore_list)
+
+    def __unload(self):
+        self.bot.allow_policy.set_ignore_list(None)
+        self.bot.pipeline.remove_stage("mod")
+
+    def update_moderated(self, server_id):
+        """Adds or removes the server from the ones whose messages go
+        through the filter, repeats and mention spam checks"""
+        settings = self.settings.get(server_id, {})
+        if (server_id in self.filter or settings.get("delete_repeats") or
+                settings.get("ban_mention_spam")):
+            self.moderated_servers.add(server_id)
+        else:
+            self.moderated_servers.discard(server_id)
+
     def count_ignored(self):
         msg = "```Currently ignoring:\n"
         msg += str(len(self.ignore_list["CHANNELS"])) + " channels\n"
@@ -1163,14 +1179,16 @@ class Mod:
             return
         server = ctx.message.server
         added = 0
-        if server.id not in self.filter.keys():
-            self.filter[server.id] = []
+        word_list = list(self.filter.get(server.id, []))
         for w in words:
-            if w.lower() not in self.filter[server.id] and w != "":
-                self.filter[server.id].append(w.lower())
+            if w.lower() not in word_list and w != "":
+                word_list.append(w.lower())
                 added += 1
+        # Assigned, since changes inside a list aren't seen by sharded files
+        self.filter[server.id] = word_list
+        self.update_moderated(server.id)
         if added:
-            dataIO.save_json("data/mod/filter.json", self.filter)
+            await dataIO.save_json_async("data/mod/filter.json", self.filter)
             await self.bot.say("Words added to filter.")
         else:
             await self.bot.say("Words already in the filter.")
@@ -1191,12 +1209,14 @@ class Mod:
         if server.id not in self.filter.keys():
             await self.bot.say("There are no filtered words in this server.")
             return
+        word_list = list(self.filter[server.id])
         for w in words:
-            if w.lower() in self.filter[server.id]:
-                self.filter[server.id].remove(w.lower())
+            if w.lower() in word_list:
+                word_list.remove(w.lower())
                 removed += 1
         if removed:
-            dataIO.save_json("data/mod/filter.json", self.filter)
+            self.filter[server.id] = word_list
+            await dataIO.save_json_async("data/mod/filter.json", self.filter)
             await self.bot.say("Words removed from filter.")
         else:
             await self.bot.say("Those words weren't in the filter.")
@@ -1315,10 +1335,7 @@ class Mod:
 
         if user.id == settings.owner:
             return True
-        elif discord.utils.get(user.roles, name=admin_role):
-            return True
-        else:
-            return False
+        return checks.has_role_named(user, (admin_role,))
 
     def is_mod_or_superior(self, obj):
         if isinstance(obj, discord.Message):
@@ -1339,12 +1356,7 @@ class Mod:
 
         if user.id == settings.owner:
             return True
-        elif discord.utils.get(user.roles, name=admin_role):
-            return True
-        elif discord.utils.get(user.roles, name=mod_role):
-            return True
-        else:
-            return False
+        return checks.has_role_named(user, (admin_role, mod_role))
 
     def is_allowed_by_hierarchy(self, server, mod, user):
         toggled = self.settings[server.id].get("respect_hierarchy",
@@ -1402,7 +1414,7 @@ class Mod:
         if mod:
             self.last_case[server.id][mod.id] = case_n
 
-        dataIO.save_json("data/mod/modlog.json", self.cases)
+        dataIO.mark_dirty("data/mod/modlog.json", self.cases)
 
         return case_n
 
@@ -1435,7 +1447,7 @@ class Mod:
 
         case_msg = self.format_case_msg(case)
 
-        dataIO.save_json("data/mod/modlog.json", self.cases)
+        dataIO.mark_dirty("data/mod/modlog.json", self.cases)
 
         if case["message"] is None:  # The case's message was never sent
             raise CaseMessageNotFound()
@@ -1586,15 +1598,14 @@ class Mod:
         await asyncio.sleep(delay)
         await _delete_helper(self.bot, message)
 
-    async def on_message(self, message):
+    async def moderate(self, info):
+        """Message stage: messages from users in moderated servers"""
+        message = info.message
         author = message.author
-        if message.server is None or self.bot.user == author:
-            return
 
-        valid_user = isinstance(author, discord.Member) and not author.bot
-
-        #  Bots and mods or superior are ignored from the filter
-        if not valid_user or self.is_mod_or_superior(message):
+        #  Mods or superior are ignored from the filter
+        if not isinstance(author, discord.Member) or \
+                self.is_mod_or_superior(message):
             return
 
         deleted = await self.check_filter(message)
@@ -1637,7 +1648,7 @@ class Mod:
                     names = deque(self.past_names[before.id], maxlen=20)
                     names.append(after.name)
                     self.past_names[before.id] = list(names)
-            dataIO.save_json("data/mod/past_names.json", self.past_names)
+            dataIO.mark_dirty("data/mod/past_names.json", self.past_names)
 
         if before.nick != after.nick and after.nick is not None:
             server = before.server
@@ -1651,8 +1662,8 @@ class Mod:
             if after.nick not in nicks:
                 nicks.append(after.nick)
                 self.past_nicknames[server.id][before.id] = list(nicks)
-                dataIO.save_json("data/mod/past_nicknames.json",
-                                 self.past_nicknames)
+                dataIO.mark_dirty("data/mod/past_nicknames.json",
+                                  self.past_nicknames)
 
     def are_overwrites_empty(self, overwrites):
         """There is currently no cleaner way to check if a
@@ -1705,14 +1716,31 @@ def check_files():
     }
 
     for filename, value in files.items():
-        if not os.path.isfile("data/mod/{}".format(filename)):
+        # Not isfile: sharded and SQLite stored files have no json file
+        if not dataIO.is_valid_json("data/mod/{}".format(filename)):
             print("Creating empty {}".format(filename))
             dataIO.save_json("data/mod/{}".format(filename), value)
 
 
+def prepare():
+    dataIO.prefetch(*("data/mod/" + f for f in (
+        "ignorelist.json", "filter.json", "past_names.json",
+        "past_nicknames.json", "settings.json", "modlog.json",
+        "perms_cache.json")))
+
+
 def setup(bot):
     global logger
+    for filename in ("modlog.json", "past_names.json", "past_nicknames.json"):
+        dataIO.set_format("data/mod/" + filename, COMPACT)
     check_folders()
+    if not dataIO.use_sqlite("data/mod/modlog.json", depth=2):  # Row per case
+        dataIO.use_shards("data/mod/modlog.json")
+    dataIO.use_shards("data/mod/filter.json")
+    if not dataIO.use_sqlite("data/mod/past_names.json", depth=1):
+        dataIO.use_journal("data/mod/past_names.json", depth=1)
+    if not dataIO.use_sqlite("data/mod/past_nicknames.json", depth=2):
+        dataIO.use_journal("data/mod/past_nicknames.json", depth=2)
     check_files()
     logger = logging.getLogger("mod")
     # Prevents the logger from being loaded again in case of module reload
@@ -1726,3 +1754,5 @@ def setup(bot):
     n = Mod(bot)
     bot.add_listener(n.check_names, "on_member_update")
     bot.add_cog(n)
+    bot.pipeline.add_stage("mod", n.moderate, server_only=True,
+                           ignore_bots=True, servers=n.moderated_servers)
@@ -5,6 +5,7 @@ from cogs.utils.converters import GlobalUser
 from __main__ import set_cog
 from .utils.dataIO import dataIO
 from .utils.chat_formatting import pagify, box
+from .utils import eventloop
 
 import importlib
 import traceback
@@ -47,6 +48,7 @@ class Owner:
         self.setowner_lock = False
         self.disabled_commands = dataIO.load_json("data/red/disabled_commands.json")
         self.global_ignores = dataIO.load_json("data/red/global_ignores.json")
+        self.bot.allow_policy.set_global_ignores(self.global_ignores)
         self.session = aiohttp.ClientSession(loop=self.bot.loop)
 
     def __unload(self):
@@ -653,6 +655,62 @@ class Owner:
             pass
         await self.bot.shutdown(restart=True)
 
+    @commands.command()
+    @checks.is_owner()
+    async def looplag(self, minutes: int=60, stalls: bool=False):
+        """Shows how late the event loop has been running
+
+        Covers the last minutes (up to 60). If stalls is yes, also shows
+        the stack of the code behind the last times the loop was blocked"""
+        monitor = self.bot.loop_monitor
+        minutes = max(1, min(minutes, 60))
+        msg = ("Event loop lag, last {} minutes:\n\n{}"
+               "".format(minutes, monitor.format_histogram(minutes)))
+        await self.bot.say(box(msg))
+        if not stalls:
+            return
+        if not monitor.stalls:
+            await self.bot.say("The loop hasn't been blocked for longer "
+                               "than {}s.".format(monitor.threshold))
+            return
+        for stall in reversed(monitor.stalls):
+            when = datetime.datetime.utcfromtimestamp(stall.started)
+            msg = "{} UTC, blocked for {:.2f}s\n\n{}".format(
+                when.strftime("%Y-%m-%d %H:%M:%S"), stall.duration,
+                stall.stack)
+            for page in pagify(msg, ["\n"], shorten_by=16):
+                await self.bot.say(box(page, lang="py"))
+
+    @commands.command()
+    @checks.is_owner()
+    async def metrics(self, by: str="command"):
+        """Shows command latencies and other metrics
+
+        by can be command, cog or stage (message stages)"""
+        by = by.lower()
+        names = {"command": "command_latency_seconds",
+                 "cog": "cog_latency_seconds",
+                 "stage": "stage_latency_seconds"}
+        if by not in names:
+            await self.bot.say("by must be command, cog or stage.")
+            return
+        metrics = self.bot.metrics
+
+        def ms(value):
+            return "-" if value is None else "{:.0f}".format(value * 1000)
+
+        rows = metrics.latency_table(names[by], by)
+        msg = "{:<24} {:>7} {:>7} {:>7} {:>7}\n".format(
+            by.capitalize(), "Count", "p50 ms", "p95 ms", "p99 ms")
+        for name, count, p50, p95, p99 in rows:
+            msg += "{:<24} {:>7} {:>7} {:>7} {:>7}\n".format(
+                str(name)[:24], count, ms(p50), ms(p95), ms(p99))
+        if not rows:
+            msg += "Nothing timed yet\n"
+        msg += "\n" + metrics.summary_line().replace(" ", "\n")
+        for page in pagify(msg, ["\n"], shorten_by=16):
+            await self.bot.say(box(page))
+
     @commands.group(name="command", pass_context=True)
     @checks.is_owner()
     async def command_disabler(self, ctx):
@@ -872,6 +930,20 @@ class Owner:
         embed.add_field(name="Instance owned by", value=str(owner))
         embed.add_field(name="Python", value=py_version)
         embed.add_field(name="discord.py", value=dpy_version)
+        embed.add_field(name="Event loop",
+                        value=eventloop.describe(self.bot.settings.event_loop))
+        shard_stats = dataIO.shard_stats()
+        if shard_stats:
+            resident = "\n".join("{}: {}/{}".format(os.path.basename(name),
+                                                    loaded, total)
+                                 for name, (loaded, total)
+                                 in sorted(shard_stats.items()))
+            embed.add_field(name="Servers in memory", value=resident)
+        outbound = self.bot.outbound.stats()
+        embed.add_field(name="Outbound queue",
+                        value="{queued} queued (max {max_queued}), {sent} sent,"
+                              " {merged} merged, {rate_limit_waits} rate limit"
+                              " waits".format(**outbound))
         embed.add_field(name="About Red", value=about, inline=False)
         embed.set_footer(text="Bringing joy since 02 Jan 2016 (over "
                          "{} days ago!)".format(days_since))
@@ -1052,6 +1124,7 @@ class Owner:
         return fmt.format(d=days, h=hours, m=minutes, s=seconds)
 
     def save_global_ignores(self):
+        self.bot.allow_policy.set_global_ignores(self.global_ignores)
         dataIO.save_json("data/red/global_ignores.json", self.global_ignores)
 
     def save_disabled_commands(self):
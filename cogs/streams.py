@@ -13,6 +13,8 @@ import asyncio
 import logging
 import json
 
+LAZY_LOAD = False  # stream_checker has to run from the start
+
 
 class StreamsError(Exception):
     pass
@@ -161,7 +163,7 @@ class Streams:
         else:
             await self.bot.say("Alert has been removed from this channel.")
 
-        dataIO.save_json("data/streams/twitch.json", self.twitch_streams)
+        await dataIO.save_json_async("data/streams/twitch.json", self.twitch_streams)
 
     @streamalert.command(name="hitbox", pass_context=True)
     async def hitbox_alert(self, ctx, stream: str):
@@ -191,7 +193,7 @@ class Streams:
         else:
             await self.bot.say("Alert has been removed from this channel.")
 
-        dataIO.save_json("data/streams/hitbox.json", self.hitbox_streams)
+        await dataIO.save_json_async("data/streams/hitbox.json", self.hitbox_streams)
 
     @streamalert.command(name="mixer", pass_context=True)
     async def mixer_alert(self, ctx, stream: str):
@@ -221,7 +223,7 @@ class Streams:
         else:
             await self.bot.say("Alert has been removed from this channel.")
 
-        dataIO.save_json("data/streams/beam.json", self.mixer_streams)
+        await dataIO.save_json_async("data/streams/beam.json", self.mixer_streams)
 
     @streamalert.command(name="picarto", pass_context=True)
     async def picarto_alert(self, ctx, stream: str):
@@ -251,7 +253,7 @@ class Streams:
         else:
             await self.bot.say("Alert has been removed from this channel.")
 
-        dataIO.save_json("data/streams/picarto.json", self.picarto_streams)
+        await dataIO.save_json_async("data/streams/picarto.json", self.picarto_streams)
 
     @streamalert.command(name="stop", pass_context=True)
     async def stop_alert(self, ctx):
@@ -277,10 +279,10 @@ class Streams:
             for s in to_delete:
                 stream_type.remove(s)
 
-        dataIO.save_json("data/streams/twitch.json", self.twitch_streams)
-        dataIO.save_json("data/streams/hitbox.json", self.hitbox_streams)
-        dataIO.save_json("data/streams/beam.json", self.mixer_streams)
-        dataIO.save_json("data/streams/picarto.json", self.picarto_streams)
+        await dataIO.save_json_async("data/streams/twitch.json", self.twitch_streams)
+        await dataIO.save_json_async("data/streams/hitbox.json", self.hitbox_streams)
+        await dataIO.save_json_async("data/streams/beam.json", self.mixer_streams)
+        await dataIO.save_json_async("data/streams/picarto.json", self.picarto_streams)
 
         await self.bot.say("There will be no more stream alerts in this "
                            "channel.")
@@ -298,7 +300,7 @@ class Streams:
 
         https://blog.twitch.tv/client-id-required-for-kraken-api-calls-afbb8e95f843"""
         self.settings["TWITCH_TOKEN"] = token
-        dataIO.save_json("data/streams/settings.json", self.settings)
+        await dataIO.save_json_async("data/streams/settings.json", self.settings)
         await self.bot.say('Twitch Client-ID set.')
 
     @streamset.command(pass_context=True, no_pm=True)
@@ -320,7 +322,7 @@ class Streams:
         else:
             await self.bot.send_cmd_help(ctx)
 
-        dataIO.save_json("data/streams/settings.json", self.settings)
+        await dataIO.save_json_async("data/streams/settings.json", self.settings)
 
     @streamset.command(pass_context=True, no_pm=True)
     @checks.admin()
@@ -336,7 +338,7 @@ class Streams:
         else:
             await self.bot.say("Notifications won't be deleted anymore.")
 
-        dataIO.save_json("data/streams/settings.json", self.settings)
+        await dataIO.save_json_async("data/streams/settings.json", self.settings)
 
     async def hitbox_online(self, stream):
         url = "https://api.hitbox.tv/media/live/" + stream
@@ -593,7 +595,7 @@ class Streams:
                             continue
                         save = True
                         stream["ALREADY_ONLINE"] = True
-                        messages_sent = []
+                        pending = []
                         for channel_id in stream["CHANNELS"]:
                             channel = self.bot.get_channel(channel_id)
                             if channel is None:
@@ -602,17 +604,19 @@ class Streams:
                             can_speak = channel.permissions_for(channel.server.me).send_messages
                             message = mention + " {} is live!".format(stream["NAME"])
                             if channel and can_speak:
-                                m = await self.bot.send_message(channel, message, embed=embed)
-                                messages_sent.append(m)
-                        self.messages_cache[key] = messages_sent
+                                pending.append(self.bot.queue_message(channel, message, embed=embed))
+                        # Sent side by side, each channel has its own rate limit
+                        results = await asyncio.gather(*pending, return_exceptions=True)
+                        self.messages_cache[key] = [m for m in results
+                                                    if isinstance(m, discord.Message)]
 
                     await asyncio.sleep(0.5)
 
             if save:
-                dataIO.save_json("data/streams/twitch.json", self.twitch_streams)
-                dataIO.save_json("data/streams/hitbox.json", self.hitbox_streams)
-                dataIO.save_json("data/streams/beam.json", self.mixer_streams)
-                dataIO.save_json("data/streams/picarto.json", self.picarto_streams)
+                dataIO.mark_dirty("data/streams/twitch.json", self.twitch_streams)
+                dataIO.mark_dirty("data/streams/hitbox.json", self.hitbox_streams)
+                dataIO.mark_dirty("data/streams/beam.json", self.mixer_streams)
+                dataIO.mark_dirty("data/streams/picarto.json", self.picarto_streams)
 
             await asyncio.sleep(CHECK_DELAY)
 
@@ -653,7 +657,7 @@ class Streams:
         # We might as well delete the invalid / renamed ones
         self.twitch_streams = [s for s in self.twitch_streams if "ID" in s]
 
-        dataIO.save_json("data/streams/twitch.json", self.twitch_streams)
+        await dataIO.save_json_async("data/streams/twitch.json", self.twitch_streams)
 
 
 def check_folders():
@@ -681,6 +685,12 @@ def check_files():
         dataIO.save_json(f, {})
 
 
+def prepare():
+    dataIO.prefetch(*("data/streams/" + f for f in (
+        "twitch.json", "hitbox.json", "beam.json", "picarto.json",
+        "settings.json")))
+
+
 def setup(bot):
     logger = logging.getLogger('aiohttp.client')
     logger.setLevel(50)  # Stops warning spam
@@ -24,6 +24,7 @@ class Trivia:
     def __init__(self, bot):
         self.bot = bot
         self.trivia_sessions = []
+        self.trivia_channels = set()  # Where the message stage listens
         self.file_path = "data/trivia/settings.json"
         settings = dataIO.load_json(self.file_path)
         self.settings = defaultdict(lambda: DEFAULTS.copy(), settings)
@@ -107,6 +108,7 @@ class Trivia:
                 settings = self.settings[server.id]
                 t = TriviaSession(self.bot, trivia_list, message, settings)
                 self.trivia_sessions.append(t)
+                self.trivia_channels.add(message.channel.id)
                 await t.new_question()
         else:
             await self.bot.say("Deja este un trivia pornit.")
@@ -188,15 +190,20 @@ class Trivia:
                 return t
         return None
 
-    async def on_message(self, message):
-        if message.author != self.bot.user:
-            session = self.get_trivia_by_channel(message.channel)
-            if session:
-                await session.check_answer(message)
+    async def check_answers(self, info):
+        """Message stage: channels with a trivia session"""
+        session = self.get_trivia_by_channel(info.message.channel)
+        if session:
+            await session.check_answer(info.message)
 
     async def on_trivia_end(self, instance):
         if instance in self.trivia_sessions:
             self.trivia_sessions.remove(instance)
+        if self.get_trivia_by_channel(instance.channel) is None:
+            self.trivia_channels.discard(instance.channel.id)
+
+    def __unload(self):
+        self.bot.pipeline.remove_stage("trivia")
 
     def save_settings(self):
         dataIO.save_json(self.file_path, self.settings)
@@ -329,5 +336,8 @@ def check_files():
 def setup(bot):
     check_folders()
     check_files()
-    bot.add_cog(Trivia(bot))
+    n = Trivia(bot)
+    bot.add_cog(n)
+    bot.pipeline.add_stage("trivia", n.check_answers,
+                           channels=n.trivia_channels)
 web: node index.js
@@ -0,0 +1,55 @@
+#
+# What Bot.user_allowed checks for every command, alias and custom command.
+#
+# The owner's blacklist / whitelist and mod's ignore list are kept here as
+# frozensets. The cogs that own them push a new copy whenever their
+# commands change them, so a check is a few set lookups.
+#
+
+
+class AllowPolicy:
+    def __init__(self, settings):
+        self.settings = settings
+        self.blacklist = frozenset()
+        self.whitelist = frozenset()
+        self.ignored_servers = frozenset()
+        self.ignored_channels = frozenset()
+
+    def set_global_ignores(self, global_ignores):
+        """Takes the owner's blacklist and whitelist"""
+        self.blacklist = frozenset(global_ignores["blacklist"])
+        self.whitelist = frozenset(global_ignores["whitelist"])
+
+    def set_ignore_list(self, ignore_list):
+        """Takes mod's ignore list, or None once mod is unloaded"""
+        if ignore_list is None:
+            self.ignored_servers = self.ignored_channels = frozenset()
+        else:
+            self.ignored_servers = frozenset(ignore_list["SERVERS"])
+            self.ignored_channels = frozenset(ignore_list["CHANNELS"])
+
+    def allowed(self, message):
+        author = message.author
+
+        if self.settings.owner == author.id:
+            return True
+
+        if author.id in self.blacklist:
+            return False
+
+        if self.whitelist and author.id not in self.whitelist:
+            return False
+
+        if not message.channel.is_private:
+            # Admins and mods are never ignored
+            staff_roles = self.settings.get_staff_roles(message.server)
+            if any(r.name in staff_roles for r in author.roles):
+                return True
+
+            if message.server.id in self.ignored_servers:
+                return False
+
+            if message.channel.id in self.ignored_channels:
+                return False
+
+        return True
@@ -1,5 +1,7 @@
 from discord.ext import commands
 import discord.utils
+import itertools
+from collections import OrderedDict
 from __main__ import settings
 
 #
@@ -9,6 +11,88 @@ from __main__ import settings
 #          https://github.com/Rapptz/RoboDanny/tree/async
 #
 
+# Resolving a member's permissions or looking for a role by name is done on
+# every check, and mod does it for every message. The results are cached
+# under their server's generation number, which is bumped by every event
+# that can change them in that server, so a cached result is never stale
+# and a change in one server leaves the others' results alone. Role lookups
+# are keyed on the role names too, so changing the admin / mod role in the
+# settings doesn't need a bump.
+
+class ResolutionCache:
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.generations = {}  # Server id: generation
+        self._next_generation = itertools.count(1)
+        self._cache = OrderedDict()  # Least recently used first
+
+    def get(self, sid, key, resolve):
+        key = (sid, self.generations.get(sid, 0)) + key
+        try:
+            value = self._cache[key]
+        except KeyError:
+            value = self._cache[key] = resolve()
+            if len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        else:
+            self._cache.move_to_end(key)
+        return value
+
+    def bump(self, sid):
+        """Makes the results cached for the server sid stale
+
+        They're no longer looked up and age out of the cache"""
+        self.generations[sid] = next(self._next_generation)
+
+resolution_cache = ResolutionCache()
+
+def _server_id(obj):
+    server = getattr(obj, "server", None)  # Private channels have none
+    return server.id if server is not None else None
+
+async def _removed(obj):
+    resolution_cache.bump(_server_id(obj))
+
+async def _updated(before, after):
+    resolution_cache.bump(_server_id(after))
+
+async def _server_updated(before, after):
+    resolution_cache.bump(after.id)
+
+async def _member_updated(before, after):
+    if before.roles != after.roles:  # Not a presence update
+        resolution_cache.bump(after.server.id)
+
+def register_invalidation(bot):
+    """Bumps the generation of a server on the events that change roles
+    or permissions in it"""
+    bot.add_listener(_member_updated, "on_member_update")
+    bot.add_listener(_server_updated, "on_server_update")
+    for event in ("on_server_role_update", "on_channel_update"):
+        bot.add_listener(_updated, event)
+    for event in ("on_member_remove", "on_server_role_delete",
+                  "on_channel_delete"):
+        bot.add_listener(_removed, event)
+
+def resolve_permissions(channel, member):
+    return resolution_cache.get(_server_id(channel),
+                                ("perms", channel.id, member.id),
+                                lambda: channel.permissions_for(member))
+
+def has_role_named(member, names, *, ignore_case=False):
+    """Returns True if the member has a role named one of names"""
+    names = frozenset(n.lower() for n in names) if ignore_case \
+        else frozenset(names)
+
+    def resolve():
+        if ignore_case:
+            return any(r.name.lower() in names for r in member.roles)
+        return any(r.name in names for r in member.roles)
+
+    return resolution_cache.get(member.server.id,
+                                ("role", member.id, names, ignore_case),
+                                resolve)
+
 def is_owner_check(ctx):
     _id = ctx.message.author.id
     return _id == settings.owner or _id in ctx.bot.settings.co_owners
@@ -34,7 +118,7 @@ def check_permissions(ctx, perms):
 
     ch = ctx.message.channel
     author = ctx.message.author
-    resolved = ch.permissions_for(author)
+    resolved = resolve_permissions(ch, author)
     return all(getattr(resolved, name, None) == value for name, value in perms.items())
 
 def role_or_permissions(ctx, check, **perms):
@@ -49,20 +133,30 @@ def role_or_permissions(ctx, check, **perms):
     role = discord.utils.find(check, author.roles)
     return role is not None
 
+def role_names_or_permissions(ctx, names, **perms):
+    """role_or_permissions with a cached, case insensitive role lookup"""
+    if check_permissions(ctx, perms):
+        return True
+
+    if ctx.message.channel.is_private:
+        return False # can't have roles in PMs
+
+    return has_role_named(ctx.message.author, names, ignore_case=True)
+
 def mod_or_permissions(**perms):
     def predicate(ctx):
         server = ctx.message.server
-        mod_role = settings.get_server_mod(server).lower()
-        admin_role = settings.get_server_admin(server).lower()
-        return role_or_permissions(ctx, lambda r: r.name.lower() in (mod_role,admin_role), **perms)
+        names = (settings.get_server_mod(server),
+                 settings.get_server_admin(server))
+        return role_names_or_permissions(ctx, names, **perms)
 
     return commands.check(predicate)
 
 def admin_or_permissions(**perms):
     def predicate(ctx):
         server = ctx.message.server
-        admin_role = settings.get_server_admin(server)
-        return role_or_permissions(ctx, lambda r: r.name.lower() == admin_role.lower(), **perms)
+        names = (settings.get_server_admin(server),)
+        return role_names_or_permissions(ctx, names, **perms)
 
     return commands.check(predicate)
 
@@ -1,7 +1,29 @@
 import json
 import os
 import logging
+import asyncio
+import functools
+import threading
+import time
+import zlib
+import weakref
+import argparse
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 from random import randint
+from .jsoncodecs import get_codec
+from .journal import Journal
+from .shards import ShardedDict, shard_folder, split
+from .tracking import MISSING
+
+_MISSING = object()
+CHECKSUM_EXT = ".crc"
+
+# On-disk formats. Pretty output is meant for files people edit by hand,
+# compact output for large files that are rewritten often.
+PRETTY = "pretty"
+COMPACT = "compact"
+
 
 class InvalidFileIO(Exception):
     pass
@@ -9,31 +31,311 @@ class InvalidFileIO(Exception):
 class DataIO():
     def __init__(self):
         self.logger = logging.getLogger("red")
+        self.codec = get_codec()
+        self.write_behind_delay = 0.25
+        self.max_io_workers = 4
+        self.fsync = False
+        self._formats = {}
+        self._store = None
+        self.journal_compact_every = 1000
+        self._journals = {}
+        self.sharding = False
+        self.shard_max_resident = None
+        self.shard_idle_timeout = None
+        self._shards = {}
+        self._views = weakref.WeakValueDictionary()
+        self._prefetched = {}
+        self._load_clock = threading.local()
+        self._dirty = {}
+        self._dirty_lock = threading.Lock()
+        self._flush_handle = None
+        self._evict_handle = None
+        self._executor = None
+        self._path_locks = {}
+        self._write_seq = {}
+        self._written_seq = {}
 
     def save_json(self, filename, data):
         """Atomically saves json file"""
-        rnd = randint(1000, 9999)
-        path, ext = os.path.splitext(filename)
-        tmp_file = "{}-{}.tmp".format(path, rnd)
-        self._save_json(tmp_file, data)
-        try:
-            self._read_json(tmp_file)
-        except json.decoder.JSONDecodeError:
-            self.logger.exception("Attempted to write file {} but JSON "
-                                  "integrity check on tmp file has failed. "
-                                  "The original file is unaltered."
-                                  "".format(filename))
-            return False
-        os.replace(tmp_file, filename)
-        return True
+        name = self._routed_name(filename)
+        if name is not None:
+            # Applied by the store's thread like async saves, so it can't
+            # get ahead of an older one still queued
+            return self._store.executor.submit(
+                self._store.apply, name,
+                self._store.changes(name, data)).result()
+        folder = self._shards.get(os.path.normpath(filename))
+        if folder is not None:
+            return self._write_snapshots(
+                self._shard_snapshots(filename, folder, data))
+        journal = self._journals.get(os.path.normpath(filename))
+        if journal is not None:
+            if journal.append(data) and not self._should_compact(journal):
+                return True
+            return self._compact(filename, journal, data)
+        text, seq = self._snapshot(filename, data)
+        return self._write_snapshot(filename, text, seq)
+
+    def save_json_async(self, filename, data):
+        """Atomically saves json file in the IO thread pool
+
+        Returns an awaitable. data is serialized before this returns, so
+        it can be modified right away. Saves to the same file are never
+        applied out of order: an older snapshot will not overwrite a
+        newer one."""
+        with self._dirty_lock:
+            self._dirty.pop(filename, None)  # Superseded by this save
+        loop = asyncio.get_event_loop()
+        name = self._routed_name(filename)
+        if name is not None:
+            return loop.run_in_executor(self._store.executor,
+                                        self._store.apply, name,
+                                        self._store.changes(name, data))
+        folder = self._shards.get(os.path.normpath(filename))
+        if folder is not None:
+            return loop.run_in_executor(
+                self._get_executor(), self._write_snapshots,
+                self._shard_snapshots(filename, folder, data))
+        journal = self._journals.get(os.path.normpath(filename))
+        if journal is not None:
+            if journal.append(data) and not self._should_compact(journal):
+                fut = loop.create_future()
+                fut.set_result(True)
+                return fut
+            generation = journal.rotate()
+            text, seq = self._snapshot(filename, data)
+            fut = loop.run_in_executor(self._get_executor(),
+                                       self._write_snapshot, filename,
+                                       text, seq)
+            fut.add_done_callback(lambda f: journal.finish_compaction(
+                not f.cancelled() and f.exception() is None and f.result(),
+                generation))
+            return fut
+        text, seq = self._snapshot(filename, data)
+        return loop.run_in_executor(self._get_executor(),
+                                    self._write_snapshot, filename, text, seq)
 
     def load_json(self, filename):
         """Loads json file"""
+        if filename in self._dirty:
+            self.flush(filename)
+        name = self._routed_name(filename)
+        if name is not None:
+            return self._store.load(name)
+        folder = self._shards.get(os.path.normpath(filename))
+        if folder is not None:
+            view = ShardedDict(folder, self._read_json,
+                               max_resident=self.shard_max_resident,
+                               idle_timeout=self.shard_idle_timeout,
+                               is_pending=self._is_pending_write,
+                               flush=functools.partial(self._flush_shards,
+                                                       filename))
+            self._views[os.path.normpath(filename)] = view
+            self._schedule_eviction()
+            return view
+        journal = self._journals.get(os.path.normpath(filename))
+        if journal is not None:
+            return journal.load(self._read_json(filename))
         return self._read_json(filename)
 
+    def load_json_async(self, filename):
+        """Loads json file in the IO thread pool
+
+        Returns an awaitable"""
+        name = self._routed_name(filename)
+        if name is not None:
+            if filename in self._dirty:
+                self.flush(filename)
+            loop = asyncio.get_event_loop()
+            return loop.run_in_executor(self._store.executor,
+                                        self._store.load, name)
+        name = os.path.normpath(filename)
+        if name in self._journals or name in self._shards:
+            # Nothing is read until it's used
+            fut = asyncio.get_event_loop().create_future()
+            fut.set_result(self.load_json(filename))
+            return fut
+        with self._dirty_lock:
+            pending = self._dirty.pop(filename, _MISSING)
+        if pending is not _MISSING:
+            pending = self._snapshot(filename, pending)
+
+        def load():
+            if pending is not _MISSING:
+                self._write_snapshot(filename, *pending)
+            return self._read_json(filename)
+
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(self._get_executor(), load)
+
+    def mark_dirty(self, filename, data):
+        """Schedules a write-behind save of data to filename
+
+        Every save to the same file made within write_behind_delay seconds
+        is coalesced into a single atomic write of the latest data.
+        Outside of a running event loop the file is saved right away."""
+        try:
+            loop = asyncio.get_event_loop()
+        except RuntimeError:  # Not the main thread
+            loop = None
+
+        if loop is None or not loop.is_running():
+            with self._dirty_lock:
+                self._dirty.pop(filename, None)
+            return self.save_json(filename, data)
+
+        with self._dirty_lock:
+            self._dirty[filename] = data
+            if self._flush_handle is None:
+                self._flush_handle = loop.call_later(self.write_behind_delay,
+                                                     self._scheduled_flush)
+        return True
+
+    def flush(self, filename=None):
+        """Writes pending write-behind saves to disk
+
+        If filename is passed only that file is flushed, otherwise
+        journals are compacted as well"""
+        for fn, data in self._take_dirty(filename).items():
+            self.save_json(fn, data)
+        if filename is None:
+            for journal in self._journals.values():
+                if journal.doc.root is not None and journal.records:
+                    self._compact(journal.filename, journal, journal.doc.root)
+
+    def use_journal(self, filename, depth):
+        """Saves filename by appending its changes to a journal
+
+        Only the values found depth keys deep that have changed are
+        written, to filename + ".journal". The journal is folded back into
+        filename every journal_compact_every records and on flush.
+        Returns False if filename is stored in SQLite or sharded instead"""
+        name = os.path.normpath(filename)
+        if self._routed_name(filename) is not None or name in self._shards:
+            return False
+        if name not in self._journals:
+            self._journals[name] = Journal(filename, depth)
+        return True
+
+    def enable_sqlite(self, path):
+        """Enables the SQLite store. See use_sqlite"""
+        from .sqlitestore import SQLiteStore
+        if self._store is None:
+            self._store = SQLiteStore(path)
+
+    def use_sqlite(self, filename, depth):
+        """Stores filename in the SQLite store, if it is enabled
+
+        The document is stored as one row per value found depth keys
+        deep, so saving it only rewrites the rows that have changed.
+        It is imported from filename the first time. Returns True if
+        the document is now served by the store"""
+        if self._store is None:
+            return False
+        name = os.path.normpath(filename)
+        if not self._store.route(name, depth) and os.path.isfile(filename):
+            self._store.import_data(name, depth, self._read_json(filename))
+            self.logger.info("Imported {} into the SQLite store"
+                             "".format(filename))
+        return True
+
+    def use_shards(self, filename):
+        """Stores filename as one json file per top level key, if sharding
+        is enabled
+
+        data/economy/bank.json is stored in data/economy/bank/, one file
+        per server, so saving it only rewrites the servers that have
+        changed. load_json returns a dict-like ShardedDict that reads each
+        server's file the first time it's used. filename is split the
+        first time and left as it is. Returns True if the document is now
+        sharded
+
+        Only changes made through dicts are tracked: a list changed in
+        place must be assigned back to its key to be saved"""
+        if not self.sharding or self._routed_name(filename) is not None:
+            return False
+        folder = shard_folder(filename)
+        if not os.path.isdir(folder):
+            # Split in a side folder, so that a crash can't leave half
+            # of the document behind
+            tmp_folder = folder + "-split"
+            if os.path.isdir(tmp_folder):
+                shutil.rmtree(tmp_folder)
+            shards = split(self, filename, tmp_folder)
+            self._write_snapshots(
+                self._shard_snapshots(filename, tmp_folder, shards))
+            os.replace(tmp_folder, folder)
+            self.logger.info("Split {} into {} files in {}"
+                             "".format(filename, len(shards), folder))
+        self._shards[os.path.normpath(filename)] = folder
+        return True
+
+    def prefetch(self, *filenames):
+        """Reads and parses files ahead of their first load
+
+        Meant for startup, where cogs can do this in worker threads. The
+        next read of each file gets the parsed data if the file hasn't
+        changed since. Missing and invalid files are skipped"""
+        for filename in filenames:
+            name = os.path.normpath(filename)
+            if self.sharding and os.path.isdir(shard_folder(filename)):
+                continue  # Won't be read from the json file
+            if self._store and self._store.stored_depth(name) is not None:
+                continue
+            try:
+                stat = os.stat(filename)
+                data = self._read_json(filename)
+            except (OSError, ValueError):
+                continue
+            with self._dirty_lock:
+                self._prefetched[name] = ((stat.st_mtime_ns, stat.st_size),
+                                          data)
+
+    def clear_prefetched(self):
+        """Drops the prefetched data that hasn't been used"""
+        with self._dirty_lock:
+            self._prefetched.clear()
+
+    def load_time(self):
+        """Seconds the current thread has spent reading json files"""
+        return getattr(self._load_clock, "seconds", 0.0)
+
+    def shard_stats(self):
+        """Returns {filename: (resident, total)} for the loaded sharded
+        documents"""
+        return {name: (view.resident, len(view))
+                for name, view in list(self._views.items())}
+
+    def set_format(self, filename, fmt):
+        """Sets the format used when saving filename
+
+        PRETTY (the default) or COMPACT"""
+        if fmt not in (PRETTY, COMPACT):
+            raise ValueError("Unknown json format: {}".format(fmt))
+        self._formats[os.path.normpath(filename)] = fmt
+
+    def get_format(self, filename):
+        return self._formats.get(os.path.normpath(filename), PRETTY)
+
+    def convert(self, filename, fmt):
+        """Rewrites an existing json file in the given format"""
+        data = self.load_json(filename)
+        text, seq = self._snapshot(filename, data, fmt)
+        return self._write_snapshot(filename, text, seq)
+
     def is_valid_json(self, filename):
-        """Verifies if json file exists / is readable"""
+        """Verifies if json file exists / is readable
+
+        Files whose checksum sidecar matches are not parsed again"""
+        name = self._routed_name(filename)
+        if name is not None and self._store.stored_depth(name) is not None:
+            return True
+        folder = self._shards.get(os.path.normpath(filename))
+        if folder is not None:
+            return os.path.isdir(folder)
         try:
+            if self._checksum_matches(filename):
+                return True
             self._read_json(filename)
             return True
         except FileNotFoundError:
@@ -41,16 +343,252 @@ class DataIO():
         except json.decoder.JSONDecodeError:
             return False
 
+    def _routed_name(self, filename):
+        if self._store is None:
+            return None
+        name = os.path.normpath(filename)
+        return name if self._store.is_routed(name) else None
+
+    def _should_compact(self, journal):
+        return (journal.records >= self.journal_compact_every and
+                not journal.compacting)
+
+    def _compact(self, filename, journal, data):
+        generation = journal.rotate()
+        saved = False
+        try:
+            text, seq = self._snapshot(filename, data)
+            saved = self._write_snapshot(filename, text, seq)
+        finally:
+            journal.finish_compaction(saved, generation)
+        return saved
+
+    def _take_dirty(self, filename=None):
+        with self._dirty_lock:
+            if filename is None:
+                pending = self._dirty
+                self._dirty = {}
+            elif filename in self._dirty:
+                pending = {filename: self._dirty.pop(filename)}
+            else:
+                pending = {}
+            if not self._dirty and self._flush_handle is not None:
+                self._flush_handle.cancel()
+                self._flush_handle = None
+        return pending
+
+    def _scheduled_flush(self):
+        with self._dirty_lock:
+            self._flush_handle = None
+        for fn, data in self._take_dirty().items():
+            fut = self.save_json_async(fn, data)
+            fut.add_done_callback(self._log_failed_save(fn))
+            if isinstance(data, ShardedDict):
+                # Drops the idle shards that were only kept to be written
+                fut.add_done_callback(lambda fut, view=data: view.evict())
+
+    def _flush_shards(self, filename, view):
+        """Saves the unsaved shards a view wants to drop"""
+        if self.mark_dirty(filename, view) and filename not in self._dirty:
+            view.evict()  # Saved right away, outside of the event loop
+
+    def _schedule_eviction(self):
+        """Drops idle shards every so often, even if nothing is used"""
+        if not self.shard_idle_timeout or self._evict_handle is not None:
+            return
+        try:
+            loop = asyncio.get_event_loop()
+        except RuntimeError:  # Not the main thread
+            return
+        if loop.is_running():
+            self._evict_handle = loop.call_later(self.shard_idle_timeout / 2,
+                                                 self._scheduled_evict)
+
+    def _scheduled_evict(self):
+        self._evict_handle = None
+        for view in list(self._views.values()):
+            view.evict()
+        if len(self._views):
+            self._schedule_eviction()
+
+    def _log_failed_save(self, filename):
+        def callback(fut):
+            if not fut.cancelled() and fut.exception() is not None:
+                self.logger.error("Write-behind save of {} has failed."
+                                  "".format(filename),
+                                  exc_info=fut.exception())
+        return callback
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_io_workers)
+        return self._executor
+
+    def _snapshot(self, filename, data, fmt=None):
+        """Serializes data and tags it with the file's next write number"""
+        text = self._dump_json(data, fmt or self.get_format(filename))
+        return text, self._next_seq(filename)
+
+    def _next_seq(self, filename):
+        with self._dirty_lock:
+            seq = self._write_seq.get(filename, 0) + 1
+            self._write_seq[filename] = seq
+        return seq
+
+    def _is_pending_write(self, filename):
+        with self._dirty_lock:
+            return (self._write_seq.get(filename, 0) >
+                    self._written_seq.get(filename, 0))
+
+    def _shard_snapshots(self, filename, folder, data):
+        """Serializes the shards to write as (path, text, seq)
+
+        text is None for shards to delete. If data is not a view of the
+        folder, every shard is replaced"""
+        if isinstance(data, ShardedDict) and data.folder == folder:
+            changes = data.changes()
+        else:
+            current = ShardedDict(folder, self._read_json)
+            changes = [(current.shard_path(k), MISSING)
+                       for k in current if k not in data]
+            changes.extend((current.shard_path(k), v)
+                           for k, v in data.items())
+        fmt = self.get_format(filename)
+        snapshots = []
+        for path, value in changes:
+            if value is MISSING:
+                snapshots.append((path, None, self._next_seq(path)))
+            else:
+                snapshots.append((path,) + self._snapshot(path, value, fmt))
+        return snapshots
+
+    def _write_snapshots(self, snapshots):
+        saved = True
+        for path, text, seq in snapshots:
+            saved = self._write_snapshot(path, text, seq) and saved
+        return saved
+
+    def _write_snapshot(self, filename, text, seq):
+        """Writes text to filename, or deletes it if text is None"""
+        with self._dirty_lock:
+            lock = self._path_locks.setdefault(filename, threading.Lock())
+        with lock:
+            if seq < self._written_seq.get(filename, 0):
+                return True  # A newer snapshot is already on disk
+            if text is None:
+                for path in (filename, filename + CHECKSUM_EXT):
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                self._written_seq[filename] = seq
+                return True
+            saved = self._atomic_write(filename, text)
+            if saved:
+                self._written_seq[filename] = seq
+            return saved
+
+    def _atomic_write(self, filename, text):
+        """Writes the serialized text through a tmp file
+
+        The text comes straight from json.dumps, so the tmp file isn't
+        read back and parsed again: the checksum of the bytes in memory is
+        what's stored in the sidecar file, and loads check the file
+        against it. The sidecar is removed before the file is replaced and
+        written through a tmp file too, so a crash can leave the file
+        without one but never with a stale one"""
+        raw = text.encode("utf-8")
+        checksum = self._checksum(raw)
+        if self._prefetched:
+            with self._dirty_lock:
+                self._prefetched.pop(os.path.normpath(filename), None)
+        tmp_file = self._tmp_name(filename)
+        with open(tmp_file, mode="wb") as f:
+            written = f.write(raw)
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        if written != len(raw):
+            self.logger.error("Attempted to write file {} but only {} of {} "
+                              "bytes were written to the tmp file. The "
+                              "original file is unaltered."
+                              "".format(filename, written, len(raw)))
+            os.remove(tmp_file)
+            return False
+        try:
+            os.remove(filename + CHECKSUM_EXT)
+        except FileNotFoundError:
+            pass
+        os.replace(tmp_file, filename)
+        tmp_file = self._tmp_name(filename + CHECKSUM_EXT)
+        with open(tmp_file, encoding="utf-8", mode="w") as f:
+            f.write(checksum)
+        os.replace(tmp_file, filename + CHECKSUM_EXT)
+        return True
+
+    def _tmp_name(self, filename):
+        rnd = randint(1000, 9999)
+        path, ext = os.path.splitext(filename)
+        return "{}-{}.tmp".format(path, rnd)
+
     def _read_json(self, filename):
-        with open(filename, encoding='utf-8', mode="r") as f:
-            data = json.load(f)
-        return data
+        if self._prefetched:
+            data = self._take_prefetched(filename)
+            if data is not _MISSING:
+                return data
+        start = time.perf_counter()
+        try:
+            with open(filename, mode="rb") as f:
+                raw = f.read()
+            try:
+                return self.codec.loads(raw)
+            except ValueError:
+                if self._stored_checksum(filename) not in (None,
+                                                          self._checksum(raw)):
+                    self.logger.error("{} has been modified or corrupted "
+                                      "since it was last saved."
+                                      "".format(filename))
+                raise
+        finally:
+            self._load_clock.seconds = (self.load_time() +
+                                        time.perf_counter() - start)
 
-    def _save_json(self, filename, data):
-        with open(filename, encoding='utf-8', mode="w") as f:
-            json.dump(data, f, indent=4,sort_keys=True,
-                separators=(',',' : '))
-        return data
+    def _take_prefetched(self, filename):
+        with self._dirty_lock:
+            entry = self._prefetched.pop(os.path.normpath(filename), None)
+        if entry is None:
+            return _MISSING
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return _MISSING
+        if entry[0] != (stat.st_mtime_ns, stat.st_size):
+            return _MISSING  # Changed since
+        return entry[1]
+
+    def _checksum(self, raw):
+        return "{:08x} {}".format(zlib.crc32(raw) & 0xffffffff, len(raw))
+
+    def _stored_checksum(self, filename):
+        try:
+            with open(filename + CHECKSUM_EXT, encoding="utf-8") as f:
+                return f.read().strip()
+        except OSError:
+            return None
+
+    def _checksum_matches(self, filename):
+        stored = self._stored_checksum(filename)
+        if stored is None:
+            return False
+        with open(filename, mode="rb") as f:
+            return self._checksum(f.read()) == stored
+
+    def _dump_json(self, data, fmt=PRETTY):
+        if fmt == COMPACT:
+            return self.codec.dumps_compact(data)
+        return json.dumps(data, indent=4, sort_keys=True,
+                          separators=(',', ' : '))
 
     def _legacy_fileio(self, filename, IO, data=None):
         """Old fileIO provided for backwards compatibility"""
@@ -77,3 +615,21 @@ def set_value(filename, key, value):
 
 dataIO = DataIO()
 fileIO = dataIO._legacy_fileio # backwards compatibility
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Converts Red's json data "
+                                                 "files between formats")
+    parser.add_argument("format", choices=(PRETTY, COMPACT))
+    parser.add_argument("files", nargs="+", metavar="file")
+    args = parser.parse_args()
+
+    for filename in args.files:
+        before = os.path.getsize(filename)
+        dataIO.convert(filename, args.format)
+        after = os.path.getsize(filename)
+        print("{}: {} -> {} bytes".format(filename, before, after))
+
+
+if __name__ == "__main__":
+    main()
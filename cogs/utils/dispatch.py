@@ -0,0 +1,127 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+#
+# Routing of incoming messages to the core and to cogs.
+#
+# Each message is classified once (private or not, from a bot or not,
+# which prefix it starts with) and only handed to the stages that want
+# that kind of message. Instead of an on_message listener, a cog adds a
+# stage and says what it wants:
+#
+#     bot.pipeline.add_stage("alias", self.on_alias, prefixed=True,
+#                            server_only=True)
+#
+# channels and servers take a container of ids, like the set of channels
+# with a trivia session going on, that the cog keeps up to date. Stages
+# run as separate tasks, like listeners do.
+#
+
+log = logging.getLogger("red.dispatch")
+
+
+class MessageInfo:
+    """What the pipeline knows about a message"""
+
+    __slots__ = ("message", "private", "from_bot", "from_self", "server_id",
+                 "channel_id", "prefix", "rest", "received", "_bot",
+                 "_allowed")
+
+    def __init__(self, bot, message):
+        self.message = message
+        self.received = time.monotonic()
+        self.private = message.channel.is_private
+        self.from_self = message.author == bot.user
+        self.from_bot = message.author.bot
+        self.server_id = None if self.private else message.server.id
+        self.channel_id = message.channel.id
+        self.prefix, self.rest = bot.settings.match_prefix(message.server,
+                                                           message.content)
+        self._bot = bot
+        self._allowed = None
+
+    @property
+    def allowed(self):
+        """Bot.user_allowed, computed the first time it's needed"""
+        if self._allowed is None:
+            self._allowed = self._bot.user_allowed(self.message)
+        return self._allowed
+
+
+class Stage:
+    def __init__(self, name, callback, *, prefixed=False, server_only=False,
+                 ignore_self=True, ignore_bots=False, allowed_only=False,
+                 channels=None, servers=None):
+        self.name = name
+        self.callback = callback
+        self.prefixed = prefixed
+        self.server_only = server_only
+        self.ignore_self = ignore_self
+        self.ignore_bots = ignore_bots
+        self.allowed_only = allowed_only
+        self.channels = channels
+        self.servers = servers
+
+    def wants(self, info):
+        if self.prefixed and not info.prefix:
+            return False
+        if self.server_only and info.private:
+            return False
+        if self.ignore_self and info.from_self:
+            return False
+        if self.ignore_bots and info.from_bot:
+            return False
+        if self.channels is not None and info.channel_id not in self.channels:
+            return False
+        if self.servers is not None and info.server_id not in self.servers:
+            return False
+        if self.allowed_only and not info.allowed:
+            return False  # Checked last, it's the most expensive
+        return True
+
+
+class MessagePipeline:
+    def __init__(self, bot):
+        self.bot = bot
+        self.stages = OrderedDict()
+
+    def add_stage(self, name, callback, **interest):
+        """Adds a stage, replacing the one called name if any
+
+        callback is a coroutine function taking the message's
+        MessageInfo. See Stage for what it can ask for"""
+        self.stages[name] = Stage(name, callback, **interest)
+
+    def remove_stage(self, name):
+        self.stages.pop(name, None)
+
+    def dispatch(self, message, only=None):
+        """Hands message to the stages that want it
+
+        only limits it to the stages with those names. Returns the number
+        of stages it was handed to"""
+        info = MessageInfo(self.bot, message)
+        handed = 0
+        for stage in list(self.stages.values()):
+            if only is not None and stage.name not in only:
+                continue
+            if stage.wants(info):
+                self.bot.loop.create_task(self._run(stage, info))
+                handed += 1
+        return handed
+
+    async def _run(self, stage, info):
+        start = time.monotonic()
+        try:
+            await stage.callback(info)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.bot.metrics.inc("stage_errors", stage=stage.name)
+            log.exception("Error in the {} message stage".format(stage.name))
+        finally:
+            self.bot.metrics.observe("stage_latency_seconds",
+                                     time.monotonic() - start,
+                                     stage=stage.name)
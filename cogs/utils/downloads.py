@@ -0,0 +1,445 @@
+import asyncio
+import collections
+import functools
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+try:
+    import youtube_dl
+    from youtube_dl.utils import DownloadError
+except ImportError:
+    youtube_dl = None
+
+    class DownloadError(Exception):
+        """Stands in for youtube_dl's, which nothing can raise then"""
+
+#
+# youtube_dl lookups and downloads for the audio cog, off the event loop.
+#
+# Nothing here needs discord, so it can be used and tested on its own.
+#
+
+log = logging.getLogger("red.audio")
+
+
+youtube_dl_options = {
+    'source_address': '0.0.0.0',
+    'format': 'best',
+    'extractaudio': True,
+    'audioformat': "mp3",
+    'nocheckcertificate': True,
+    'ignoreerrors': False,
+    'quiet': True,
+    'no_warnings': True,
+    'outtmpl': "data/audio/cache/%(id)s",
+    'default_search': 'auto',
+    'encoding': 'utf-8'
+}
+
+
+class MaximumLength(Exception):
+    def __init__(self, m):
+        self.message = m
+
+    def __str__(self):
+        return self.message
+    
+
+class YouTubeDlError(Exception):
+    def __init__(self, m):
+        self.message = m
+
+    def __str__(self):
+        return self.message
+    
+
+class DownloadTimeout(YouTubeDlError):
+    pass
+
+
+class DownloadCancelled(Exception):
+    pass
+
+
+class Song:
+    def __init__(self, **kwargs):
+        self.__dict__ = kwargs
+        self.title = kwargs.pop('title', None)
+        self.id = kwargs.pop('id', None)
+        self.url = kwargs.pop('url', None)
+        self.webpage_url = kwargs.pop('webpage_url', "")
+        self.duration = kwargs.pop('duration', 60)
+        self.start_time = kwargs.pop('start_time', None)
+        self.end_time = kwargs.pop('end_time', None)
+        self.thumbnail = kwargs.pop('thumbnail', None)
+        self.view_count = kwargs.pop('view_count', None)
+        self.rating = kwargs.pop('average_rating', None)
+        self.song_start_time = None
+
+
+def duration_check(song, max_duration):
+    log.debug("duration {} for songid {}".format(song.duration, song.id))
+    if max_duration and song.duration > max_duration:
+        log.debug("songid {} too long".format(song.id))
+        raise MaximumLength("songid {} has duration {} > {}".format(
+            song.id, song.duration, max_duration))
+
+
+class DownloadJob:
+    """Lookup of a URL's info, and download of its audio if asked for"""
+
+    def __init__(self, url, download):
+        self.url = url
+        self.download = download
+        self.song = None  # As soon as the info is known
+        self.task = None
+        self.servers = collections.Counter()  # Requests by server
+
+    def done(self):
+        return self.task.done()
+
+    async def wait(self, timeout=None):
+        """Waits at most timeout seconds for the Song
+
+        Raises DownloadTimeout when it takes longer, DownloadCancelled if
+        the job gets cancelled. Giving up doesn't cancel the job, others
+        may be waiting for it too"""
+        try:
+            return await asyncio.wait_for(asyncio.shield(self.task), timeout)
+        except asyncio.TimeoutError:
+            raise DownloadTimeout("Timed out after {}s".format(timeout))
+        except asyncio.CancelledError:
+            if self.task.cancelled():
+                raise DownloadCancelled(self.url)
+            raise
+
+
+# What Song and the now playing embed use from youtube_dl's info
+METADATA_FIELDS = ("id", "title", "url", "webpage_url", "duration",
+                   "start_time", "end_time", "thumbnail", "view_count",
+                   "average_rating", "creator", "uploader", "extractor")
+
+
+def normalize_url(url):
+    """Makes the different ways of writing a song's URL the same key"""
+    parts = urlparse(url.strip().strip("<>"))
+    netloc = parts.netloc.lower()
+    for prefix in ("www.", "m."):
+        if netloc.startswith(prefix):
+            netloc = netloc[len(prefix):]
+    path = parts.path
+    query = urllib.parse.parse_qsl(parts.query)
+    if netloc == "youtu.be":
+        netloc, path = "youtube.com", "/watch"
+        query.append(("v", parts.path.lstrip("/")))
+    query = sorted((k, v) for k, v in query
+                   if k != "feature" and not k.startswith("utm_"))
+    return urllib.parse.urlunparse(("https", netloc, path.rstrip("/"), "",
+                                    urllib.parse.urlencode(query), ""))
+
+
+class MetadataCache:
+    """youtube_dl info of songs by URL, and the URL found by searches
+
+    The most recently used entries are kept in memory, all of them in a
+    SQLite file. Entries older than ttl seconds are looked up again.
+    Used from the event loop, the file is only ever read and written by
+    a thread of its own: lookups that miss the memory wait for it, writes
+    are queued behind the memory and don't."""
+
+    def __init__(self, loop, path, ttl, max_memory=1000):
+        self.loop = loop
+        self.path = path
+        self.ttl = ttl
+        self.max_memory = max_memory
+        self.memory = collections.OrderedDict()  # key: (time, info)
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.db = None  # Opened, used and closed by the executor's thread
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self._write(self._open)
+
+    @staticmethod
+    def url_key(url):
+        return "url:" + normalize_url(url)
+
+    @staticmethod
+    def search_key(terms):
+        return "search:" + " ".join(terms.lower().split())
+
+    async def get(self, key):
+        now = time.time()
+        entry = self.memory.get(key)
+        if entry is not None:
+            if now - entry[0] < self.ttl:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            del self.memory[key]
+        row = await self.loop.run_in_executor(self.executor, self._select,
+                                              key)
+        if row is None or now - row[0] >= self.ttl:
+            self.misses += 1
+            return None
+        self.disk_hits += 1
+        info = json.loads(row[1])
+        self._remember(key, row[0], info)
+        return info
+
+    def put(self, key, info):
+        now = time.time()
+        self._remember(key, now, info)
+        self._write(self._insert, key, now, json.dumps(info))
+
+    async def get_song_info(self, url):
+        """Returns (URL, info) of a URL or [SEARCH:] query, or None"""
+        if "[SEARCH:]" in url:
+            found = await self.get(self.search_key(url[9:]))
+            if found is None:
+                return None
+            url = found["url"]
+        info = await self.get(self.url_key(url))
+        return None if info is None else (url, info)
+
+    def put_song_info(self, url, resolved, video):
+        """Remembers the info of a song, if it's one"""
+        if video.get("_type", "video") != "video" or "id" not in video:
+            return  # Playlists are looked up every time
+        info = {k: video[k] for k in METADATA_FIELDS if k in video}
+        self.put(self.url_key(resolved), info)
+        if "[SEARCH:]" in url:
+            self.put(self.search_key(url[9:]), {"url": resolved})
+
+    def prune(self):
+        """Deletes the expired entries"""
+        self._write(self._delete, "WHERE cached < ?",
+                    (time.time() - self.ttl,))
+
+    def clear(self):
+        self.memory.clear()
+        self._write(self._delete, "", ())
+
+    def close(self):
+        """Waits for the pending writes and closes the file"""
+        self._write(self._close)
+        self.executor.shutdown(wait=True)
+
+    async def stats(self):
+        stored = await self.loop.run_in_executor(self.executor, self._count)
+        lookups = self.hits + self.disk_hits + self.misses
+        return {"memory": len(self.memory), "stored": stored,
+                "hits": self.hits, "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.disk_hits) / lookups
+                            if lookups else 0.0}
+
+    def _remember(self, key, cached, info):
+        self.memory[key] = (cached, info)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory:
+            self.memory.popitem(last=False)
+
+    def _write(self, func, *args):
+        # A single thread runs them in order, so a lookup made after a
+        # write sees it
+        future = self.executor.submit(func, *args)
+        future.add_done_callback(self._written)
+
+    @staticmethod
+    def _written(future):
+        if future.exception() is not None:
+            log.error("Couldn't write to the song info cache",
+                      exc_info=future.exception())
+
+    # What follows runs in the executor's thread
+
+    def _open(self):
+        self.db = sqlite3.connect(self.path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS metadata (key TEXT "
+                        "PRIMARY KEY, cached REAL, info TEXT)")
+        self._delete("WHERE cached < ?", (time.time() - self.ttl,))
+
+    def _close(self):
+        self.db.close()
+
+    def _select(self, key):
+        return self.db.execute("SELECT cached, info FROM metadata WHERE "
+                               "key = ?", (key,)).fetchone()
+
+    def _count(self):
+        return self.db.execute("SELECT COUNT(*) FROM metadata").fetchone()[0]
+
+    def _insert(self, key, cached, info):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO metadata VALUES "
+                            "(?, ?, ?)", (key, cached, info))
+
+    def _delete(self, where, args):
+        with self.db:
+            self.db.execute("DELETE FROM metadata " + where, args)
+
+
+class DownloadService:
+    """Runs youtube_dl on a bounded pool of threads
+
+    At most workers jobs run at once, and at most per_server of them for
+    the same server. Jobs asked for without a server id only wait for
+    the pool. Asking for a URL that's already being looked up, or
+    downloaded with the same maximum duration, gets the job in
+    progress."""
+
+    def __init__(self, loop, workers=4, per_server=2,
+                 cache_path="data/audio/cache", metadata=None, index=None):
+        self.loop = loop
+        self.per_server = per_server
+        self.cache_path = cache_path
+        self.metadata = metadata
+        self.index = index
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self._jobs = {}  # (url, download, max_duration): job
+        self._server_limits = {}  # sid: [semaphore, jobs using it]
+        self._local = threading.local()  # A YoutubeDL per thread
+
+    def info(self, url, sid=None):
+        return self._job(url, False, sid, None)
+
+    def download(self, url, sid=None, max_duration=None):
+        return self._job(url, True, sid, max_duration)
+
+    def cancel(self, sid):
+        """Cancels the jobs nobody but sid asked for
+
+        A youtube_dl call already running in the pool can't be
+        interrupted, its result is dropped"""
+        for job in list(self._jobs.values()):
+            job.servers.pop(sid, None)
+            if not job.servers:
+                job.task.cancel()
+
+    def release(self, job, sid):
+        """Withdraws one request of sid for job, which is cancelled if
+        nobody wants it anymore"""
+        job.servers[sid] -= 1
+        if job.servers[sid] <= 0:
+            del job.servers[sid]
+        if not job.servers and not job.done():
+            job.task.cancel()
+
+    def close(self):
+        for job in list(self._jobs.values()):
+            job.task.cancel()
+        self.executor.shutdown(wait=False)
+
+    def _job(self, url, download, sid, max_duration):
+        # A job checks the duration of the first request only, so
+        # requests with another limit get a job of their own
+        key = (url, download, max_duration)
+        job = self._jobs.get(key)
+        if job is None:
+            job = DownloadJob(url, download)
+            job.task = self.loop.create_task(self._run(job, sid,
+                                                       max_duration))
+            job.task.add_done_callback(
+                functools.partial(self._finished, key, job))
+            self._jobs[key] = job
+        job.servers[sid] += 1
+        return job
+
+    def _finished(self, key, job, task):
+        if self._jobs.get(key) is job:
+            del self._jobs[key]
+        if not task.cancelled():
+            task.exception()  # Retrieved, even if nobody waited for it
+
+    async def _run(self, job, sid, max_duration):
+        known = None
+        if self.metadata is not None:
+            known = await self.metadata.get_song_info(job.url)
+        if known is not None:  # No need to ask youtube_dl
+            job.song = Song(**known[1])
+            if not job.download:
+                return job.song
+            duration_check(job.song, max_duration)
+            if self._is_cached(job.song.id):
+                return job.song
+
+        if sid is None:
+            url, video, song = await self.loop.run_in_executor(
+                self.executor, self._extract, job, max_duration, known)
+        else:
+            limit = self._server_limits.setdefault(
+                sid, [asyncio.Semaphore(self.per_server), 0])
+            limit[1] += 1
+            try:
+                async with limit[0]:
+                    url, video, song = await self.loop.run_in_executor(
+                        self.executor, self._extract, job, max_duration,
+                        known)
+            finally:
+                limit[1] -= 1
+                if not limit[1]:  # Idle servers don't keep one
+                    del self._server_limits[sid]
+        if video is not None and self.metadata is not None:
+            self.metadata.put_song_info(job.url, url, video)
+        if job.download and self.index is not None:
+            self.index.add(song.id)
+        return song
+
+    def _is_cached(self, name):
+        if self.index is not None:
+            return name in self.index
+        return os.path.isfile(os.path.join(self.cache_path, name))
+
+    def _youtube_dl(self):
+        yt = getattr(self._local, "yt", None)
+        if yt is None:
+            yt = self._local.yt = youtube_dl.YoutubeDL(youtube_dl_options)
+        return yt
+
+    def _extract(self, job, max_duration, known=None):
+        """Runs in the pool. Returns the URL, the info looked up, if it
+        wasn't known, and the Song"""
+        yt = self._youtube_dl()
+        video = None
+        try:
+            if known is not None:
+                url, song = known[0], job.song
+            else:
+                url, video = self._get_info(yt, job.url)
+                song = job.song = Song(**video)
+            if job.download:
+                duration_check(song, max_duration)
+                if not os.path.isfile(os.path.join(self.cache_path,
+                                                   song.id)):
+                    song = Song(**yt.extract_info(url))
+                    job.song = song
+        except DownloadError as e:
+            raise YouTubeDlError(str(e))
+        except OSError as e:
+            log.warning("An operating system error occurred while "
+                        "downloading URL '{}':\n'{}'".format(job.url, str(e)))
+            raise YouTubeDlError(str(e))
+        return url, video, song
+
+    def _get_info(self, yt, url):
+        """Returns the URL to download, search results resolved, and its
+        info"""
+        if "[SEARCH:]" in url:
+            yt_id = yt.extract_info(
+                url[9:], download=False)["entries"][0]["id"]
+            # Should handle errors here ^
+            url = "https://youtube.com/watch?v={}".format(yt_id)
+        video = yt.extract_info(url, download=False, process=False)
+        if video is None:
+            raise YouTubeDlError("No information found for {}".format(url))
+        return url, video
@@ -0,0 +1,56 @@
+import asyncio
+import logging
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+#
+# Choice of the event loop (--event-loop).
+#
+# It has to be made before the first loop is created, which is why
+# Settings.parse_cmd_arguments does it: Bot creates its loop right after
+# parsing the arguments.
+#
+
+CHOICES = ("asyncio", "uvloop", "auto")
+
+log = logging.getLogger("red.eventloop")
+
+
+def available():
+    """Names of the event loops that can be used here"""
+    names = ["asyncio"]
+    if uvloop is not None:
+        names.append("uvloop")
+    return names
+
+
+def new_event_loop(name):
+    """Creates a loop of the given kind, for benchmarks"""
+    if name == "uvloop":
+        return uvloop.new_event_loop()
+    return asyncio.new_event_loop()
+
+
+def use_event_loop(name):
+    """Sets the event loop policy for name, one of CHOICES
+
+    "auto" picks uvloop when it's installed. Falls back to asyncio's loop
+    if the one asked for isn't available. Returns the name of the loop
+    that will be used"""
+    if name in ("uvloop", "auto"):
+        if uvloop is not None:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+            return "uvloop"
+        if name == "uvloop":
+            log.warning("uvloop is not installed, using asyncio's event loop")
+    return "asyncio"
+
+
+def describe(name):
+    """name with the version of the library providing it"""
+    if name == "uvloop" and uvloop is not None:
+        return "uvloop {}".format(getattr(uvloop, "__version__", ""))
+    return "asyncio"
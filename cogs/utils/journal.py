@@ -0,0 +1,145 @@
+import json
+import os
+import threading
+from .tracking import Document, MISSING
+
+#
+# Append-only journals for json files that change often.
+#
+# Instead of rewriting the whole file, each save appends one line per
+# changed row to <file>.journal: [path, value] when a row is set, [path]
+# when it is deleted. Every so often the journal is compacted: the whole
+# document is written to the json file and the journal is started over.
+#
+# Compaction first moves the journal to <file>.journal.1, so that saves
+# made while the json file is being written go to a new journal. The
+# moved journal is deleted once the json file has been replaced. Loading
+# replays the json file, then .journal.1, then .journal. Records set or
+# delete absolute paths, so replaying one that is already part of the json
+# file is harmless.
+#
+
+JOURNAL_EXT = ".journal"
+
+
+def apply_record(data, record):
+    path = record[0]
+    if not path:
+        return record[1] if len(record) > 1 else {}
+    parent = data
+    for key in path[:-1]:
+        parent = parent.setdefault(key, {})
+    if len(record) > 1:
+        parent[path[-1]] = record[1]
+    else:
+        parent.pop(path[-1], None)
+    return data
+
+
+class Journal:
+    def __init__(self, filename, depth):
+        self.filename = filename
+        self.path = filename + JOURNAL_EXT
+        self.folding_path = self.path + ".1"
+        self.doc = Document(depth)
+        self.records = 0
+        self.generation = 0
+        self.compacting = False
+        self.lock = threading.Lock()
+        self._file = None
+
+    def load(self, data):
+        """Replays the journal over the json file's data
+
+        Returns the tracked document"""
+        records = 0
+        for path in (self.folding_path, self.path):
+            try:
+                f = open(path, encoding="utf-8")
+            except FileNotFoundError:
+                continue
+            with f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # Partly written at a crash
+                    data = apply_record(data, record)
+                    records += 1
+        self.records = records
+        self.doc.dirty.clear()
+        self.doc.root = self.doc.wrap(data, ())
+        return self.doc.root
+
+    def append(self, data):
+        """Appends the rows of data changed since the last save
+
+        Returns False if data is not the loaded document, in which case
+        it can only be saved by a compaction"""
+        if data is not self.doc.root:
+            return False
+        lines = []
+        for path in self.doc.changed_paths():
+            value = self.doc.lookup(path)
+            record = [list(path)] if value is MISSING else [list(path), value]
+            lines.append(json.dumps(record, separators=(',', ':')) + "\n")
+        if not lines:
+            return True
+        with self.lock:
+            if self._file is None:
+                self._file = self._open()
+            self._file.write("".join(lines))
+            self._file.flush()
+            self.records += len(lines)
+        return True
+
+    def _open(self):
+        try:
+            with open(self.path, mode="rb") as f:
+                f.seek(-1, os.SEEK_END)
+                torn = f.read(1) != b"\n"
+        except (FileNotFoundError, OSError):  # Missing or empty
+            torn = False
+        f = open(self.path, encoding="utf-8", mode="a")
+        if torn:  # Don't glue the next record to a partly written one
+            f.write("\n")
+        return f
+
+    def rotate(self):
+        """Moves the journal aside before a compaction
+
+        Everything appended so far will be in the json file written by
+        the compaction. Returns the generation to pass to
+        finish_compaction once that file has been written"""
+        with self.lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if os.path.isfile(self.folding_path):
+                # A previous compaction failed. Its records come first
+                if os.path.isfile(self.path):
+                    with open(self.path, encoding="utf-8") as src, \
+                            open(self.folding_path, encoding="utf-8",
+                                 mode="a") as dst:
+                        dst.write("\n" + src.read())
+                    os.remove(self.path)
+            elif os.path.isfile(self.path):
+                os.replace(self.path, self.folding_path)
+            self.records = 0
+            self.compacting = True
+            self.generation += 1
+            return self.generation
+
+    def finish_compaction(self, saved, generation):
+        with self.lock:
+            if generation != self.generation:
+                return  # A later compaction also needs the moved journal
+            if saved and os.path.isfile(self.folding_path):
+                os.remove(self.folding_path)
+            self.compacting = False
+
+    def close(self):
+        with self.lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
@@ -0,0 +1,210 @@
+import json
+import os
+import re
+import time
+import tempfile
+import argparse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+#
+# Codecs used by dataIO to parse json files and to write compact ones.
+# Pretty files are always written by the stdlib json module: none of the
+# faster libraries can reproduce its indent / separators layout.
+#
+# Compact output is pure ASCII whichever codec writes it, like the stdlib's
+# default ensure_ascii=True, so files don't change when the codec does.
+#
+
+_NON_ASCII = re.compile(r"[^\x00-\x7f]")
+# What str.encode("ascii", "backslashreplace") writes differently from
+# json: \xe9 for \u00e9, and \U0001f4a9 instead of a surrogate pair
+_REPLACED = re.compile(r"\\x[0-9a-f]{2}|\\U[0-9a-f]{8}")
+_AMBIGUOUS = re.compile(r"\\\\[xU]")
+_MAX_REPLACED = 16  # Distinct ones fixed with str.replace, one pass each
+
+
+def _json_escape(char):
+    n = ord(char)
+    if n < 0x10000:
+        return "\\u{:04x}".format(n)
+    n -= 0x10000  # Written as a surrogate pair, like the stdlib does
+    return "\\u{:04x}\\u{:04x}".format(0xd800 | (n >> 10),
+                                       0xdc00 | (n & 0x3ff))
+
+
+def _fix_replaced(token):
+    return _json_escape(chr(int(token[2:], 16)))
+
+
+def ascii_escape(text):
+    """Escapes the non-ASCII characters of json text the way
+    json.dumps(ensure_ascii=True) does"""
+    escaped = text.encode("ascii", "backslashreplace").decode("ascii")
+    if _AMBIGUOUS.search(escaped):
+        # Maybe an escaped backslash followed by x or U, which can't be
+        # told apart from what backslashreplace wrote. Done one by one
+        return _NON_ASCII.sub(lambda m: _json_escape(m.group()), text)
+    tokens = set(_REPLACED.findall(escaped))
+    if len(tokens) > _MAX_REPLACED:
+        return _REPLACED.sub(lambda m: _fix_replaced(m.group()), escaped)
+    for token in tokens:
+        escaped = escaped.replace(token, _fix_replaced(token))
+    return escaped
+
+
+class JsonCodec:
+    """Stdlib json. Always available"""
+    name = "json"
+
+    def loads(self, raw):
+        return json.loads(raw.decode("utf-8"))
+
+    def dumps_compact(self, data):
+        return json.dumps(data, separators=(',', ':'))
+
+
+class OrjsonCodec(JsonCodec):
+    name = "orjson"
+
+    def loads(self, raw):
+        try:
+            return orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            # The stdlib writes NaN and Infinity, orjson won't read them.
+            # Raises json.JSONDecodeError if the file is really invalid
+            return json.loads(raw.decode("utf-8"))
+
+    def dumps_compact(self, data):
+        # orjson can only write UTF-8. Outside of strings json is ASCII,
+        # so escaping every other character is enough. Most files are
+        # already ASCII: then the text is as long as the bytes.
+        # Unlike the stdlib, orjson writes NaN and Infinity as null
+        raw = orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+        text = raw.decode()
+        if len(text) == len(raw):
+            return text
+        return ascii_escape(text)
+
+
+class UjsonCodec(JsonCodec):
+    name = "ujson"
+
+    def loads(self, raw):
+        try:
+            return ujson.loads(raw)
+        except ValueError as e:
+            # dataIO callers expect the stdlib exception
+            raise json.JSONDecodeError(str(e), raw.decode("utf-8", "replace"),
+                                       0)
+
+    def dumps_compact(self, data):
+        return ujson.dumps(data, ensure_ascii=True,
+                           escape_forward_slashes=False)
+
+
+def available_codecs():
+    """Returns the usable codecs, fastest first"""
+    codecs = []
+    if orjson is not None:
+        codecs.append(OrjsonCodec())
+    if ujson is not None:
+        codecs.append(UjsonCodec())
+    codecs.append(JsonCodec())
+    return codecs
+
+
+def get_codec(name=None):
+    """Returns the fastest available codec, or the one called name"""
+    codecs = available_codecs()
+    if name is None:
+        return codecs[0]
+    for codec in codecs:
+        if codec.name == name:
+            return codec
+    raise ValueError("The {} json codec is not available".format(name))
+
+
+def _bank_fixture(servers=50, users=400):
+    return {str(10**17 + s): {
+        str(2 * 10**17 + u): {"name": "user{}".format(u),
+                              "balance": u * 37,
+                              "created_at": "2017-06-01 12:00:00"}
+        for u in range(users)} for s in range(servers)}
+
+
+def _modlog_fixture(servers=50, cases=300):
+    return {str(10**17 + s): {
+        str(c): {"case": c, "created": 1496318400.0 + c, "modified": None,
+                 "action": "BAN", "channel": None,
+                 "user": "Someone#{:04}".format(c),
+                 "user_id": str(3 * 10**17 + c),
+                 "reason": "Spamming \N{PILE OF POO} in #general",
+                 "moderator": "Mod#0001", "moderator_id": str(10**17),
+                 "amended_by": None, "amended_id": None,
+                 "message": str(4 * 10**17 + c), "until": None}
+        for c in range(1, cases + 1)} for s in range(servers)}
+
+
+def _settings_fixture():
+    return {"TOKEN": None, "EMAIL": None, "PASSWORD": None,
+            "OWNER": str(10**17), "PREFIXES": ["!"],
+            "default": {"ADMIN_ROLE": "Transistor", "MOD_ROLE": "Process",
+                        "PREFIXES": []}}
+
+
+def benchmark(rounds=20):
+    """Times dataIO loads and saves of sample data files with each codec"""
+    from .dataIO import DataIO, PRETTY, COMPACT
+
+    fixtures = (("bank.json", _bank_fixture(), COMPACT),
+                ("modlog.json", _modlog_fixture(), COMPACT),
+                ("settings.json", _settings_fixture(), PRETTY))
+    results = []
+
+    with tempfile.TemporaryDirectory() as folder:
+        for codec in available_codecs():
+            io = DataIO()
+            io.codec = codec
+            for filename, data, fmt in fixtures:
+                path = os.path.join(folder, codec.name + "-" + filename)
+                io.set_format(path, fmt)
+
+                start = time.perf_counter()
+                for i in range(rounds):
+                    io.save_json(path, data)
+                save_time = (time.perf_counter() - start) / rounds
+
+                start = time.perf_counter()
+                for i in range(rounds):
+                    io.load_json(path)
+                load_time = (time.perf_counter() - start) / rounds
+
+                results.append((codec.name, filename, os.path.getsize(path),
+                                save_time, load_time))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the json codecs "
+                                                 "available to dataIO")
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    print("{:<8} {:<14} {:>10} {:>10} {:>10}".format(
+        "codec", "file", "bytes", "save ms", "load ms"))
+    for name, filename, size, save, load in benchmark(args.rounds):
+        print("{:<8} {:<14} {:>10} {:>10.2f} {:>10.2f}".format(
+            name, filename, size, save * 1000, load * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+import ast
+import asyncio
+import importlib
+import logging
+import os
+from discord.ext import commands
+from .dataIO import dataIO
+
+#
+# Lazy cog activation (--lazy-cogs).
+#
+# Instead of importing every enabled cog at startup, red.py registers stub
+# commands, listeners and message stages taken from a manifest of each
+# cog. The first time one of them is used the real cog is loaded, the
+# stubs are removed and the message or event is handed to the real cog.
+#
+# A stub stage wants the messages the cog's stage says it wants, as far as
+# can be told without loading it: the literal arguments of add_stage. A
+# channels container, like the channels with a trivia session or a poll
+# going on, is taken to be empty, since it's filled by the cog's commands.
+# A servers container comes from the cog's data, so any server matches.
+#
+# The manifest is built by parsing the cog's source, so nothing is
+# imported to build it. It is rebuilt whenever the cog file's mtime
+# changes. Cogs that must run from the start, like streams which polls for
+# stream alerts, opt out with a module level LAZY_LOAD = False.
+#
+
+MANIFEST_PATH = "data/red/cog_manifest.json"
+MANIFEST_VERSION = 2  # Entries of older versions are rebuilt
+
+_UNKNOWN = object()
+
+log = logging.getLogger("red.lazycogs")
+
+
+def _literal(node, default=None):
+    try:
+        return ast.literal_eval(node)
+    except ValueError:
+        return default
+
+
+def _command_from(deco, func):
+    """Returns the manifest entry of a @commands.command/group decorator"""
+    call = deco if isinstance(deco, ast.Call) else None
+    target = call.func if call else deco
+    if not (isinstance(target, ast.Attribute) and
+            target.attr in ("command", "group") and
+            isinstance(target.value, ast.Name) and
+            target.value.id == "commands"):
+        return None  # Subcommands are loaded along with their group
+    kwargs = {k.arg: k.value for k in call.keywords} if call else {}
+    name = func.name
+    if "name" in kwargs:
+        name = _literal(kwargs["name"], name)
+    elif call and call.args:
+        name = _literal(call.args[0], name)
+    return {"name": name,
+            "aliases": list(_literal(kwargs.get("aliases"), []) or []),
+            "help": ast.get_docstring(func),
+            "hidden": bool(_literal(kwargs.get("hidden"), False))}
+
+
+def _stage_from(call):
+    """Returns the manifest entry of a pipeline.add_stage call"""
+    name = _literal(call.args[0]) if call.args else None
+    if not isinstance(name, str):
+        return None
+    interest = {}
+    for keyword in call.keywords:
+        value = _literal(keyword.value, _UNKNOWN)
+        if keyword.arg in ("channels", "servers"):
+            if value is _UNKNOWN:  # A container kept by the cog
+                if keyword.arg == "channels":
+                    interest["channels"] = []
+                continue
+            value = None if value is None else list(value)
+        elif value is _UNKNOWN:
+            continue
+        interest[keyword.arg] = value
+    return {"name": name, "interest": interest}
+
+
+def scan(path):
+    """Lists the top level commands, the listeners and the message stages
+    of a cog file"""
+    with open(path, encoding="utf-8") as f:
+        tree = ast.parse(f.read(), path)
+    entry = {"commands": [], "listeners": [], "stages": [], "lazy": True,
+             "version": MANIFEST_VERSION}
+    listeners = set()
+    functions = (ast.FunctionDef, ast.AsyncFunctionDef)
+    for node in tree.body:
+        if isinstance(node, ast.ClassDef):
+            for item in node.body:
+                if not isinstance(item, functions):
+                    continue
+                if item.name.startswith("on_"):  # Registered by add_cog
+                    listeners.add(item.name)
+                for deco in item.decorator_list:
+                    command = _command_from(deco, item)
+                    if command is not None:
+                        entry["commands"].append(command)
+        elif isinstance(node, ast.FunctionDef) and node.name == "setup":
+            for call in ast.walk(node):
+                if not (isinstance(call, ast.Call) and
+                        isinstance(call.func, ast.Attribute)):
+                    continue
+                if call.func.attr == "add_listener" and call.args:
+                    if len(call.args) > 1:
+                        listeners.add(_literal(call.args[1]))
+                    elif isinstance(call.args[0], ast.Attribute):
+                        listeners.add(call.args[0].attr)
+                elif call.func.attr == "add_stage":
+                    stage = _stage_from(call)
+                    if stage is not None:
+                        entry["stages"].append(stage)
+        elif isinstance(node, ast.Assign):
+            for target in node.targets:
+                if isinstance(target, ast.Name) and target.id == "LAZY_LOAD":
+                    entry["lazy"] = bool(_literal(node.value, True))
+    listeners.discard(None)
+    entry["listeners"] = sorted(listeners)
+    return entry
+
+
+class LazyCogs:
+    """Stubs of the cogs that haven't been loaded yet"""
+
+    def __init__(self, bot, path=MANIFEST_PATH):
+        self.bot = bot
+        self.path = path
+        self.manifest = None
+        self._stubs = {}  # extension: (commands, [(event, listener)],
+                         #              [(stage name, callback)])
+        self._activating = {}
+
+    def entry(self, extension):
+        """Returns the manifest entry of extension, rebuilt if its file
+        has changed"""
+        if self.manifest is None:
+            try:
+                self.manifest = dataIO.load_json(self.path)
+            except (FileNotFoundError, ValueError):
+                self.manifest = {}
+        filename = os.path.join(*extension.split(".")) + ".py"
+        mtime = os.path.getmtime(filename)
+        entry = self.manifest.get(extension)
+        if (entry is None or entry.get("mtime") != mtime or
+                entry.get("version") != MANIFEST_VERSION):
+            entry = scan(filename)
+            entry["mtime"] = mtime
+            self.manifest[extension] = entry
+            dataIO.save_json(self.path, self.manifest)
+        return entry
+
+    def is_stubbed(self, extension):
+        return extension in self._stubs
+
+    def stub(self, extension):
+        """Registers the stubs of extension
+
+        Returns False if the cog has to be loaded right away instead"""
+        try:
+            entry = self.entry(extension)
+        except (OSError, SyntaxError):
+            return False  # Loading it will report the error
+        if not entry["lazy"] or not (entry["commands"] or
+                                     entry["listeners"] or entry["stages"]):
+            return False
+
+        added = []
+        listeners = []
+        try:
+            for info in entry["commands"]:
+                command = self._command_stub(extension, info)
+                self.bot.add_command(command)
+                added.append(command)
+        except Exception:
+            for command in added:
+                self.bot.remove_command(command.name)
+            return False
+        for event in entry["listeners"]:
+            listener = self._listener_stub(extension, event)
+            self.bot.add_listener(listener, event)
+            listeners.append((event, listener))
+        stages = []
+        for info in entry["stages"]:
+            callback = self._stage_stub(extension, info["name"])
+            self.bot.pipeline.add_stage(info["name"], callback,
+                                        **info["interest"])
+            stages.append((info["name"], callback))
+        self._stubs[extension] = (added, listeners, stages)
+        return True
+
+    def discard(self, extension):
+        """Removes the stubs of extension, if any"""
+        added, listeners, stages = self._stubs.pop(extension, ((), (), ()))
+        for command in added:
+            if self.bot.commands.get(command.name) is command:
+                self.bot.remove_command(command.name)
+        for event, listener in listeners:
+            self.bot.remove_listener(listener, event)
+        for name, callback in stages:
+            stage = self.bot.pipeline.stages.get(name)
+            if stage is not None and stage.callback is callback:
+                self.bot.pipeline.remove_stage(name)
+
+    async def activate(self, extension):
+        """Loads the real cog. Returns True if it's loaded"""
+        if extension in self.bot.extensions:
+            return True
+        if extension in self._activating:
+            return await asyncio.shield(self._activating[extension])
+        future = self.bot.loop.create_future()
+        self._activating[extension] = future
+        try:
+            # The import is the slow part and doesn't need the loop
+            await self.bot.loop.run_in_executor(None, importlib.import_module,
+                                                extension)
+            self.bot.load_extension(extension)
+        except Exception:
+            log.exception("Error activating {}".format(extension))
+            self.discard(extension)
+            future.set_result(False)
+        else:
+            log.debug("Activated {}".format(extension))
+            future.set_result(True)
+        finally:
+            del self._activating[extension]
+        return future.result()
+
+    def _command_stub(self, extension, info):
+        async def stub(ctx):
+            if await self.activate(extension):
+                # The real command replaced this one
+                await self.bot.process_commands(ctx.message)
+
+        return commands.command(name=info["name"], aliases=info["aliases"],
+                                help=info["help"], hidden=info["hidden"],
+                                pass_context=True)(stub)
+
+    def _stage_stub(self, extension, name):
+        async def stub(info):
+            if await self.activate(extension):
+                # The cog's own stage replaced this one
+                self.bot.pipeline.dispatch(info.message, only=(name,))
+
+        return stub
+
+    def _listener_stub(self, extension, event):
+        async def stub(*args, **kwargs):
+            before = list(self.bot.extra_events.get(event, []))
+            stages = set(self.bot.pipeline.stages)
+            if not await self.activate(extension):
+                return
+            # The listeners the cog has just added missed this event
+            for listener in self.bot.extra_events.get(event, []):
+                if listener not in before:
+                    try:
+                        await listener(*args, **kwargs)
+                    except Exception:
+                        log.exception("Error in {} of {}"
+                                      "".format(event, extension))
+            if event == "on_message":  # And so did its message stages
+                new = [n for n in self.bot.pipeline.stages if n not in stages]
+                self.bot.pipeline.dispatch(args[0], only=new)
+
+        stub.__name__ = event
+        return stub
@@ -0,0 +1,97 @@
+import atexit
+import copy
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+#
+# Logging off the event loop.
+#
+# The loggers get a handler that only puts the record in a bounded queue.
+# A single background thread takes them out and hands them to the real
+# handlers, so formatting and writing to disk, rotation included, happen
+# there. When the queue is full records are dropped and counted instead of
+# making the caller wait, and the next record written is preceded by a
+# warning saying how many were lost.
+#
+#     log_queue = LogQueue()
+#     log_queue.attach(logging.getLogger("red"), file_handler, stdout_handler)
+#     log_queue.start()
+#
+
+log = logging.getLogger("red.logqueue")
+
+
+class _QueueHandler(QueueHandler):
+    def __init__(self, log_queue, handlers):
+        super().__init__(log_queue.queue)
+        self.log_queue = log_queue
+        self.handlers = handlers
+
+    def prepare(self, record):
+        # Only the message is built here, in case its arguments change
+        # later. The formatting is left to the listener
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        record.red_handlers = self.handlers
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.log_queue.dropped += 1
+
+
+class _QueueListener(QueueListener):
+    def __init__(self, log_queue):
+        super().__init__(log_queue.queue)
+        self.log_queue = log_queue
+        self.reported = 0
+
+    def handle(self, record):
+        handlers = record.red_handlers
+        dropped = self.log_queue.dropped
+        if dropped > self.reported:
+            notice = logging.LogRecord(
+                log.name, logging.WARNING, __file__, 0,
+                "{} log records were dropped, the logging queue was full"
+                "".format(dropped - self.reported), None, None)
+            self.reported = dropped
+            self._emit(notice, handlers)
+        self._emit(record, handlers)
+
+    def _emit(self, record, handlers):
+        for handler in handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)  # Waits for room if it's full
+
+
+class LogQueue:
+    def __init__(self, maxsize=10000):
+        self.queue = queue.Queue(maxsize)
+        self.dropped = 0
+        self._listener = _QueueListener(self)
+        self._started = False
+
+    def attach(self, logger, *handlers):
+        """Makes logger write to handlers through the queue"""
+        handler = _QueueHandler(self, handlers)
+        logger.addHandler(handler)
+        return handler
+
+    def start(self):
+        if not self._started:
+            self._listener.start()
+            self._started = True
+            atexit.register(self.stop)
+
+    def stop(self):
+        """Writes the records left in the queue and stops the thread"""
+        if self._started:
+            self._started = False
+            self._listener.stop()
@@ -0,0 +1,147 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+#
+# Event loop lag monitor.
+#
+# A task wakes up every INTERVAL seconds and records how late it was woken
+# up: anything that keeps the loop busy shows up as lag. The samples go in
+# a histogram per minute, the last WINDOW minutes are kept.
+#
+# A watchdog thread checks that the task keeps ticking. When the loop has
+# been stuck for longer than the threshold it takes the stack of the loop's
+# thread, which is whatever is blocking it, and logs it once per stall.
+#
+
+INTERVAL = 0.25
+WINDOW = 60  # Minutes
+BOUNDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+log = logging.getLogger("red.loopmonitor")
+
+
+class Stall:
+    __slots__ = ("started", "duration", "stack")
+
+    def __init__(self, started, duration, stack):
+        self.started = started
+        self.duration = duration
+        self.stack = stack
+
+
+class LoopMonitor:
+    def __init__(self, loop, *, threshold=0.5, interval=INTERVAL):
+        self.loop = loop
+        self.threshold = threshold
+        self.interval = interval
+        self.minutes = deque(maxlen=WINDOW)  # (minute, counts, total, max)
+        self.stalls = deque(maxlen=10)
+        self._last_tick = time.monotonic()
+        self._loop_thread = None
+        self._task = None
+        self._watchdog = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        if self._task is not None:
+            return
+        self._stopped.clear()
+        self._last_tick = time.monotonic()
+        self._loop_thread = threading.get_ident()
+        self._task = self.loop.create_task(self._tick())
+        self._watchdog = threading.Thread(target=self._watch, daemon=True,
+                                          name="loop-watchdog")
+        self._watchdog.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def record(self, lag):
+        minute = int(time.time() // 60)
+        if not self.minutes or self.minutes[-1][0] != minute:
+            self.minutes.append([minute, [0] * (len(BOUNDS) + 1), 0, 0.0])
+        current = self.minutes[-1]
+        index = 0
+        while index < len(BOUNDS) and lag > BOUNDS[index]:
+            index += 1
+        current[1][index] += 1
+        current[2] += lag
+        current[3] = max(current[3], lag)
+
+    def histogram(self, minutes=WINDOW):
+        """Returns (counts per bucket, samples, mean, max) of the last
+        minutes"""
+        since = int(time.time() // 60) - minutes
+        counts = [0] * (len(BOUNDS) + 1)
+        total = 0.0
+        worst = 0.0
+        for minute, buckets, lag, peak in self.minutes:
+            if minute <= since:
+                continue
+            counts = [a + b for a, b in zip(counts, buckets)]
+            total += lag
+            worst = max(worst, peak)
+        samples = sum(counts)
+        return counts, samples, total / samples if samples else 0.0, worst
+
+    def format_histogram(self, minutes=WINDOW):
+        counts, samples, mean, worst = self.histogram(minutes)
+        if not samples:
+            return "No samples yet"
+        labels = ["<= {}ms".format(int(b * 1000)) for b in BOUNDS]
+        labels.append("> {}ms".format(int(BOUNDS[-1] * 1000)))
+        width = max(len(l) for l in labels)
+        top = max(counts)
+        lines = []
+        for label, count in zip(labels, counts):
+            if not count:
+                continue
+            bar = "#" * max(1, round(count / top * 30))
+            lines.append("{:>{}} {:>7} {}".format(label, width, count, bar))
+        lines.append("")
+        lines.append("{} samples, mean {:.1f}ms, max {:.1f}ms"
+                     "".format(samples, mean * 1000, worst * 1000))
+        return "\n".join(lines)
+
+    async def _tick(self):
+        try:
+            while True:
+                expected = time.monotonic() + self.interval
+                await asyncio.sleep(self.interval)
+                now = time.monotonic()
+                self._last_tick = now
+                self.record(max(0.0, now - expected))
+        except asyncio.CancelledError:
+            pass
+
+    def _watch(self):
+        stalled_since = None
+        stack = None
+        while not self._stopped.wait(self.interval):
+            stuck = time.monotonic() - self._last_tick - self.interval
+            if stuck > self.threshold:
+                if stalled_since is None:
+                    stalled_since = self._last_tick + self.interval
+                    stack = self._loop_stack()
+                    log.warning("The event loop is blocked:\n" + stack)
+            elif stalled_since is not None:
+                duration = self._last_tick - stalled_since
+                self.stalls.append(Stall(time.time() - duration, duration,
+                                         stack))
+                log.warning("The event loop was blocked for {:.2f}s"
+                            "".format(duration))
+                stalled_since = stack = None
+
+    def _loop_stack(self):
+        frame = sys._current_frames().get(self._loop_thread)
+        if frame is None:
+            return "(no stack)"
+        return "".join(traceback.format_stack(frame))
@@ -0,0 +1,220 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+try:
+    from aiohttp import web
+except ImportError:
+    web = None
+
+#
+# Counters, gauges and latency histograms.
+#
+#     bot.metrics.inc("commands", command="ping")
+#     bot.metrics.set("voice_clients", 3)
+#     bot.metrics.observe("command_latency_seconds", 0.2, command="ping")
+#
+# Histograms have fixed buckets for Prometheus and keep their last samples
+# for percentiles. Values computed on demand, like the outbound queue's
+# depth, come from collectors: callables returning (name, value, labels)
+# gauges, run when the metrics are read.
+#
+# The metrics can be read with [p]metrics, in a periodic log line, and
+# over HTTP in Prometheus' text format (--metrics-port).
+#
+
+BOUNDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+RESERVOIR = 1000
+
+log = logging.getLogger("red.metrics")
+
+
+def _key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _escape(value):
+    return (str(value).replace("\\", "\\\\").replace("\"", "\\\"")
+            .replace("\n", "\\n"))
+
+
+def _labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, _escape(v))
+                          for k, v in pairs) + "}"
+
+
+class Histogram:
+    def __init__(self, bounds=BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.recent = deque(maxlen=RESERVOIR)
+
+    def observe(self, value):
+        index = 0
+        while index < len(self.bounds) and value > self.bounds[index]:
+            index += 1
+        self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+        self.recent.append(value)
+
+    def percentile(self, p):
+        """p-th percentile of the recent samples, None without samples"""
+        if not self.recent:
+            return None
+        ordered = sorted(self.recent)
+        index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+        return ordered[index]
+
+
+class Metrics:
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.collectors = []
+        self.started = time.monotonic()
+        self._task = None
+        self._server = None
+
+    def inc(self, name, amount=1, **labels):
+        series = self.counters.setdefault(name, {})
+        key = _key(labels)
+        series[key] = series.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        self.gauges.setdefault(name, {})[_key(labels)] = value
+
+    def observe(self, name, value, **labels):
+        series = self.histograms.setdefault(name, {})
+        key = _key(labels)
+        if key not in series:
+            series[key] = Histogram()
+        series[key].observe(value)
+
+    def add_collector(self, func):
+        self.collectors.append(func)
+
+    def collect(self):
+        """Returns the gauges, with the ones from the collectors"""
+        gauges = {name: dict(series) for name, series in self.gauges.items()}
+        for collector in self.collectors:
+            try:
+                for name, value, labels in collector():
+                    gauges.setdefault(name, {})[_key(labels)] = value
+            except Exception:
+                log.exception("Error in a metrics collector")
+        return gauges
+
+    def total(self, name):
+        return sum(self.counters.get(name, {}).values())
+
+    def latency_table(self, name, label):
+        """Rows of (label value, count, p50, p95, p99) by count"""
+        rows = []
+        for key, histogram in self.histograms.get(name, {}).items():
+            value = dict(key).get(label)
+            rows.append((value, histogram.count, histogram.percentile(50),
+                         histogram.percentile(95), histogram.percentile(99)))
+        rows.sort(key=lambda r: r[1], reverse=True)
+        return rows
+
+    def summary_line(self):
+        parts = ["uptime={:.0f}s".format(time.monotonic() - self.started)]
+        for name in sorted(self.counters):
+            parts.append("{}={}".format(name, self.total(name)))
+        for name, series in sorted(self.collect().items()):
+            if len(series) == 1:
+                parts.append("{}={:g}".format(name, next(iter(series.values()))))
+        for name in sorted(self.histograms):
+            merged = Histogram()
+            for histogram in self.histograms[name].values():
+                merged.recent.extend(histogram.recent)
+            p95 = merged.percentile(95)
+            if p95 is not None:
+                parts.append("{}_p95={:.3f}".format(name, p95))
+        return " ".join(parts)
+
+    def prometheus(self, prefix="red_"):
+        """The metrics in Prometheus' text exposition format"""
+        lines = []
+        for name, series in sorted(self.counters.items()):
+            lines.append("# TYPE {}{}_total counter".format(prefix, name))
+            for key, value in series.items():
+                lines.append("{}{}_total{} {}".format(prefix, name,
+                                                      _labels(key), value))
+        for name, series in sorted(self.collect().items()):
+            lines.append("# TYPE {}{} gauge".format(prefix, name))
+            for key, value in series.items():
+                lines.append("{}{}{} {}".format(prefix, name, _labels(key),
+                                                value))
+        for name, series in sorted(self.histograms.items()):
+            lines.append("# TYPE {}{} histogram".format(prefix, name))
+            for key, histogram in series.items():
+                cumulative = 0
+                for bound, count in zip(histogram.bounds, histogram.counts):
+                    cumulative += count
+                    lines.append("{}{}_bucket{} {}".format(
+                        prefix, name, _labels(key, [("le", bound)]),
+                        cumulative))
+                lines.append("{}{}_bucket{} {}".format(
+                    prefix, name, _labels(key, [("le", "+Inf")]),
+                    histogram.count))
+                lines.append("{}{}_sum{} {}".format(prefix, name,
+                                                    _labels(key),
+                                                    histogram.sum))
+                lines.append("{}{}_count{} {}".format(prefix, name,
+                                                      _labels(key),
+                                                      histogram.count))
+        return "\n".join(lines) + "\n"
+
+    def start(self, loop, *, interval=300, port=None, host="127.0.0.1"):
+        """Starts logging a summary every interval seconds and, if port is
+        given, serving /metrics on it"""
+        if interval and self._task is None:
+            self._task = loop.create_task(self._log_every(interval))
+        if port and self._server is None:
+            loop.create_task(self._serve(loop, host, port))
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+
+    async def _log_every(self, interval):
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                log.info(self.summary_line())
+        except asyncio.CancelledError:
+            pass
+
+    async def _serve(self, loop, host, port):
+        if web is None:
+            log.warning("aiohttp.web is unavailable, not serving metrics")
+            return
+
+        async def handler(request):
+            return web.Response(text=self.prometheus(),
+                                content_type="text/plain")
+
+        app = web.Application(loop=loop)
+        app.router.add_route("GET", "/metrics", handler)
+        try:
+            self._server = await loop.create_server(app.make_handler(),
+                                                    host, port)
+        except OSError as e:
+            log.error("Couldn't serve metrics on {}:{}: {}"
+                      "".format(host, port, e))
+        else:
+            log.info("Serving metrics on http://{}:{}/metrics"
+                     "".format(host, port))
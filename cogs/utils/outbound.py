@@ -0,0 +1,191 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+#
+# Queue of outgoing messages, one per destination.
+#
+# Discord allows 5 messages per 5 seconds in a channel and about 50 requests
+# per second overall. Instead of sending right away and waiting out a 429,
+# each destination gets a queue and a token bucket, and a worker task sends
+# its messages as fast as the buckets allow. A burst to many channels only
+# waits on each channel's own bucket.
+#
+# Callers get a future of the sent message. Consecutive plain text
+# messages queued with merge=True are sent as one message when they fit.
+#
+
+MAX_LENGTH = 2000
+
+log = logging.getLogger("red.outbound")
+
+
+class RateBucket:
+    """Token bucket allowing rate sends per `per` seconds"""
+
+    def __init__(self, rate, per):
+        self.rate = rate
+        self.per = per
+        self.tokens = rate
+        self.updated = time.monotonic()
+
+    def delay(self):
+        """Takes a token and returns 0, or returns how long to wait for one"""
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens +
+                          (now - self.updated) * self.rate / self.per)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) * self.per / self.rate
+
+    def full(self):
+        """Whether it has refilled, and is the same as a new bucket"""
+        elapsed = time.monotonic() - self.updated
+        return self.tokens + elapsed * self.rate / self.per >= self.rate
+
+
+class Outgoing:
+    __slots__ = ("destination", "args", "kwargs", "future", "merge")
+
+    def __init__(self, destination, args, kwargs, future, merge):
+        self.destination = destination
+        self.args = args
+        self.kwargs = kwargs
+        self.future = future
+        self.merge = merge
+
+    @property
+    def content(self):
+        return self.args[0] if self.args else self.kwargs.get("content")
+
+    def mergeable(self):
+        return (self.merge and isinstance(self.content, str) and
+                len(self.args) + len(self.kwargs) == 1)  # Nothing but text
+
+
+class OutboundQueue:
+    def __init__(self, loop, sender, *, channel_rate=(5, 5),
+                 global_rate=(50, 1)):
+        self.loop = loop
+        self.sender = sender
+        self.channel_rate = channel_rate
+        self.global_bucket = RateBucket(*global_rate)
+        self._queues = {}
+        self._buckets = {}
+        self._workers = {}
+        self.sent = 0
+        self.merged = 0
+        self.waits = 0
+        self.max_depth = 0
+
+    def put(self, destination, args=(), kwargs=None, *, merge=False):
+        """Queues a send_message(destination, *args, **kwargs)
+
+        Returns a future of the sent message"""
+        future = self.loop.create_future()
+        key = destination.id
+        queue = self._queues.setdefault(key, deque())
+        queue.append(Outgoing(destination, args, kwargs or {}, future, merge))
+        self.max_depth = max(self.max_depth, self.depth())
+        if key not in self._workers:
+            self._workers[key] = self.loop.create_task(self._work(key))
+        return future
+
+    def depth(self):
+        """Number of messages waiting to be sent"""
+        return sum(len(q) for q in self._queues.values())
+
+    def stats(self):
+        deepest = sorted(self._queues.items(), key=lambda i: len(i[1]),
+                         reverse=True)[:5]
+        return {"queued": self.depth(),
+                "max_queued": self.max_depth,
+                "destinations": len(self._queues),
+                "buckets": len(self._buckets),
+                "sent": self.sent,
+                "merged": self.merged,
+                "rate_limit_waits": self.waits,
+                "deepest": [(k, len(q)) for k, q in deepest if q]}
+
+    async def drain(self, timeout=None):
+        """Waits until every queued message has been sent"""
+        workers = list(self._workers.values())
+        if workers:
+            await asyncio.wait(workers, timeout=timeout)
+
+    def _take(self, queue):
+        """Pops the next message, merged with the ones after it if allowed"""
+        first = queue.popleft()
+        batch = [first]
+        if first.mergeable():
+            length = len(first.content)
+            while queue and queue[0].mergeable():
+                nxt = queue[0]
+                if length + 1 + len(nxt.content) > MAX_LENGTH:
+                    break
+                length += 1 + len(nxt.content)
+                batch.append(queue.popleft())
+        return batch
+
+    async def _wait_for(self, bucket):
+        delay = bucket.delay()
+        while delay:
+            self.waits += 1
+            await asyncio.sleep(delay)
+            delay = bucket.delay()
+
+    def _prune(self, key):
+        # Idle destinations don't keep their bucket, or there would be one
+        # for every channel ever sent to
+        bucket = self._buckets.get(key)
+        if bucket is None or key in self._queues:
+            return
+        if bucket.full():
+            del self._buckets[key]
+        else:
+            self.loop.call_later(bucket.per, self._prune, key)
+
+    async def _work(self, key):
+        queue = self._queues[key]
+        try:
+            while queue:
+                batch = [o for o in self._take(queue) if not o.future.done()]
+                if not batch:
+                    continue  # Cancelled by their callers
+                await self._wait_for(self._buckets.setdefault(
+                    key, RateBucket(*self.channel_rate)))
+                await self._wait_for(self.global_bucket)
+
+                first = batch[0]
+                args, kwargs = first.args, first.kwargs
+                if len(batch) > 1:
+                    args = ("\n".join(o.content for o in batch),)
+                    kwargs = {}
+                    self.merged += len(batch) - 1
+                try:
+                    message = await self.sender(first.destination, *args,
+                                                **kwargs)
+                except Exception as e:
+                    for o in batch:
+                        if not o.future.done():
+                            o.future.set_exception(e)
+                else:
+                    self.sent += 1
+                    for o in batch:
+                        if not o.future.done():
+                            o.future.set_result(message)
+        except asyncio.CancelledError:
+            for o in queue:
+                o.future.cancel()
+            queue.clear()
+            raise
+        finally:
+            del self._workers[key]
+            if not queue:
+                del self._queues[key]
+                if key in self._buckets:
+                    self.loop.call_later(self._buckets[key].per,
+                                         self._prune, key)
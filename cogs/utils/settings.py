@@ -1,4 +1,5 @@
 from .dataIO import dataIO
+from . import eventloop
 from copy import deepcopy
 import discord
 import os
@@ -8,6 +9,31 @@ import argparse
 default_path = "data/red/settings.json"
 
 
+class PrefixMatcher:
+    """Finds which of a set of prefixes a message starts with
+
+    Prefixes are tried longest first, so that "!!" wins over "!", and only
+    the ones starting with the message's first character are tried"""
+
+    def __init__(self, prefixes):
+        self.prefixes = tuple(sorted(set(prefixes), key=len, reverse=True))
+        self._by_first = {}
+        for p in self.prefixes:
+            if p:
+                self._by_first.setdefault(p[0], []).append(p)
+        if "" in self.prefixes:  # Matches anything, after everything else
+            for candidates in self._by_first.values():
+                candidates.append("")
+        self._fallback = ("",) if "" in self.prefixes else ()
+
+    def match(self, content):
+        """Returns (prefix, rest of content), or (None, content)"""
+        for p in self._by_first.get(content[:1], self._fallback):
+            if content.startswith(p):
+                return p, content[len(p):]
+        return None, content
+
+
 class Settings:
 
     def __init__(self, path=default_path, parse_args=True):
@@ -24,6 +50,9 @@ class Settings:
                         "PREFIXES": []}
                         }
         self._memory_only = False
+        self._prefix_matchers = {}
+        self._staff_roles = {}
+        self.event_loop = "asyncio"
 
         if not dataIO.is_valid_json(self.path):
             self.bot_settings = deepcopy(self.default_settings)
@@ -87,6 +116,56 @@ class Settings:
         parser.add_argument("--debug",
                             action="store_true",
                             help="Enables debug mode")
+        parser.add_argument("--lazy-cogs",
+                            action="store_true",
+                            help="Loads each cog the first time one of its "
+                                 "commands or events is used")
+        parser.add_argument("--profile-startup",
+                            action="store_true",
+                            help="Prints how long each cog took to load")
+        parser.add_argument("--write-behind-delay", type=float, default=0.25,
+                            help="Seconds during which saves of frequently "
+                                 "updated data files are coalesced into a "
+                                 "single write")
+        parser.add_argument("--fsync-saves",
+                            action="store_true",
+                            help="Makes every data file save wait until "
+                                 "the data has reached the disk")
+        parser.add_argument("--sqlite-storage",
+                            action="store_true",
+                            help="Stores the bank, modlog, past names and "
+                                 "audio settings in an SQLite database "
+                                 "instead of json files. Existing files are "
+                                 "imported on first use")
+        parser.add_argument("--sharded-storage",
+                            action="store_true",
+                            help="Stores the bank, modlog, filter, aliases "
+                                 "and custom commands as one json file per "
+                                 "server, loaded when the server is first "
+                                 "used. Existing files are split on first "
+                                 "use")
+        parser.add_argument("--server-idle-timeout", type=float,
+                            default=1800,
+                            help="With --sharded-storage, seconds after "
+                                 "which an unused server's data is dropped "
+                                 "from memory. 0 keeps it loaded")
+        parser.add_argument("--max-resident-servers", type=int,
+                            help="With --sharded-storage, how many servers' "
+                                 "data each file keeps in memory at most")
+        parser.add_argument("--loop-stall-threshold", type=float, default=0.5,
+                            help="Seconds the event loop can be blocked for "
+                                 "before the blocking code's stack is logged")
+        parser.add_argument("--event-loop", choices=eventloop.CHOICES,
+                            default="asyncio",
+                            help="Event loop to run on. uvloop is faster but "
+                                 "has to be installed and doesn't run on "
+                                 "Windows. auto uses it when it can")
+        parser.add_argument("--metrics-interval", type=float, default=300,
+                            help="Seconds between the metrics summaries "
+                                 "in the log. 0 disables them")
+        parser.add_argument("--metrics-port", type=int,
+                            help="Serves the metrics in Prometheus' format "
+                                 "on http://127.0.0.1:<port>/metrics")
 
         args = parser.parse_args()
 
@@ -105,7 +184,22 @@ class Settings:
         self._no_cogs = args.no_cogs
         self.debug = args.debug
         self._dry_run = args.dry_run
+        self.profile_startup = args.profile_startup
+        self.lazy_cogs = args.lazy_cogs
+        self.loop_stall_threshold = args.loop_stall_threshold
+        self.metrics_interval = args.metrics_interval
+        self.metrics_port = args.metrics_port
+        # Bot creates its loop right after this
+        self.event_loop = eventloop.use_event_loop(args.event_loop)
         self.co_owners = args.co_owner
+        dataIO.write_behind_delay = args.write_behind_delay
+        dataIO.fsync = args.fsync_saves
+        if args.sqlite_storage:
+            dataIO.enable_sqlite(os.path.join(os.path.dirname(self.path),
+                                              "storage.sqlite3"))
+        dataIO.sharding = args.sharded_storage
+        dataIO.shard_idle_timeout = args.server_idle_timeout or None
+        dataIO.shard_max_resident = args.max_resident_servers
 
         self.save_settings()
 
@@ -200,6 +294,7 @@ class Settings:
     def prefixes(self, value):
         assert isinstance(value, list)
         self.bot_settings["PREFIXES"] = value
+        self._prefix_matchers.clear()  # Servers without prefixes use these
 
     @property
     def default_admin(self):
@@ -212,6 +307,7 @@ class Settings:
         if "default" not in self.bot_settings:
             self.update_old_settings()
         self.bot_settings["default"]["ADMIN_ROLE"] = value
+        self._staff_roles.clear()
 
     @property
     def default_mod(self):
@@ -224,6 +320,7 @@ class Settings:
         if "default" not in self.bot_settings:
             self.update_old_settings_v1()
         self.bot_settings["default"]["MOD_ROLE"] = value
+        self._staff_roles.clear()
 
     @property
     def servers(self):
@@ -256,6 +353,7 @@ class Settings:
         if server.id not in self.bot_settings:
             self.add_server(server.id)
         self.bot_settings[server.id]["ADMIN_ROLE"] = value
+        self._staff_roles.pop(server.id, None)
         self.save_settings()
 
     def get_server_mod(self, server):
@@ -273,8 +371,20 @@ class Settings:
         if server.id not in self.bot_settings:
             self.add_server(server.id)
         self.bot_settings[server.id]["MOD_ROLE"] = value
+        self._staff_roles.pop(server.id, None)
         self.save_settings()
 
+    def get_staff_roles(self, server):
+        """Returns the names of the server's admin and mod roles as a
+        frozenset"""
+        try:
+            return self._staff_roles[server.id]
+        except KeyError:
+            names = frozenset((self.get_server_admin(server),
+                               self.get_server_mod(server)))
+            self._staff_roles[server.id] = names
+            return names
+
     def get_server_prefixes(self, server):
         if server is None or server.id not in self.bot_settings:
             return self.prefixes
@@ -287,6 +397,7 @@ class Settings:
         if server.id not in self.bot_settings:
             self.add_server(server.id)
         self.bot_settings[server.id]["PREFIXES"] = prefixes
+        self._prefix_matchers.pop(server.id, None)
         self.save_settings()
 
     def get_prefixes(self, server):
@@ -294,6 +405,23 @@ class Settings:
         p = self.get_server_prefixes(server)
         return p if p else self.prefixes
 
+    def get_prefix_matcher(self, server):
+        """Returns the PrefixMatcher of the server's prefixes
+
+        Matchers are built once and rebuilt when the prefixes change"""
+        sid = server.id if server is not None else None
+        try:
+            return self._prefix_matchers[sid]
+        except KeyError:
+            matcher = PrefixMatcher(self.get_prefixes(server))
+            self._prefix_matchers[sid] = matcher
+            return matcher
+
+    def match_prefix(self, server, content):
+        """Returns (prefix, rest of content) if content starts with one
+        of the server's prefixes, otherwise (None, content)"""
+        return self.get_prefix_matcher(server).match(content)
+
     def add_server(self, sid):
         self.bot_settings[sid] = self.bot_settings["default"].copy()
         self.save_settings()
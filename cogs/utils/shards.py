@@ -0,0 +1,257 @@
+import argparse
+import json
+import logging
+import os
+import time
+import weakref
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from urllib.parse import quote, unquote
+from .journal import Journal
+from .tracking import Document, MISSING
+
+#
+# Documents keyed by server id, stored as one json file per top level key.
+#
+# data/economy/bank.json becomes data/economy/bank/<server id>.json, so a
+# change in one server only rewrites that server's file. Shards are read
+# the first time their key is used, and dropped from memory again when
+# they haven't been used for a while or when too many are loaded. Shards
+# with unsaved changes are kept until they have been written.
+#
+# Like the SQLite store, only dicts are tracked. A list changed in place
+# isn't seen as a change: assign it back (shards[sid] = word_list) for it
+# to be saved. Shards found with such a change when they're dropped from
+# memory are saved anyway, with a warning.
+#
+
+SHARD_EXT = ".json"
+
+log = logging.getLogger("red.shards")
+
+
+def shard_folder(filename):
+    return os.path.splitext(filename)[0]
+
+
+class ShardedDict(MutableMapping):
+    """dict-like view of a sharded document"""
+
+    def __init__(self, folder, reader, max_resident=None, idle_timeout=None,
+                 is_pending=None, flush=None):
+        self.folder = folder
+        self.max_resident = max_resident
+        self.idle_timeout = idle_timeout
+        self._reader = reader
+        self._is_pending = is_pending
+        self._flush = flush  # Called to save shards that are due to be dropped
+        self._doc = Document(depth=1)  # Every shard is a single row
+        self._loaded = OrderedDict()  # Least recently used first
+        self._last_used = {}
+        self._evicted = weakref.WeakValueDictionary()  # Dropped, still used
+        self._lists = {}  # key: lists of the shard when last saved or read
+        self._keys = set(unquote(f[:-len(SHARD_EXT)])
+                         for f in os.listdir(folder) if f.endswith(SHARD_EXT))
+
+    def shard_path(self, key):
+        return os.path.join(self.folder, quote(str(key), safe="") + SHARD_EXT)
+
+    @property
+    def resident(self):
+        """Number of shards in memory"""
+        return len(self._loaded)
+
+    def __getitem__(self, key):
+        try:
+            value = self._loaded[key]
+        except KeyError:
+            if key not in self._keys:
+                raise
+            # A dropped shard that's still referenced may have been
+            # changed through that reference, so it's taken back
+            value = self._evicted.pop(key, None)
+            if value is None:
+                value = self._doc.wrap(self._reader(self.shard_path(key)),
+                                       (key,))
+                self._remember_lists(key, value)
+            self._loaded[key] = value
+        self._used(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._loaded[key] = self._doc.wrap(value, (key,))
+        self._evicted.pop(key, None)
+        self._keys.add(key)
+        self._doc.dirty.add((key,))
+        self._used(key)
+
+    def __delitem__(self, key):
+        if key not in self._keys:
+            raise KeyError(key)
+        self._keys.discard(key)
+        self._loaded.pop(key, None)
+        self._last_used.pop(key, None)
+        self._evicted.pop(key, None)
+        self._lists.pop(key, None)
+        self._doc.dirty.add((key,))
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __iter__(self):
+        return iter(list(self._keys))
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _used(self, key):
+        now = time.monotonic()
+        self._loaded.move_to_end(key)
+        self._last_used[key] = now
+        if self.max_resident is not None or self.idle_timeout is not None:
+            self.evict(now, keep=key)
+
+    def evict(self, now=None, keep=None):
+        """Drops the least recently used shards from memory
+
+        Shards over max_resident or unused for idle_timeout seconds are
+        dropped. Those with changes that haven't been written yet are
+        handed to flush first and dropped once they've been written"""
+        now = now or time.monotonic()
+        over = 0
+        if self.max_resident is not None:
+            over = len(self._loaded) - self.max_resident
+        victims = []
+        unsaved = False
+        for key in self._loaded:
+            idle = (self.idle_timeout is not None and
+                    now - self._last_used[key] >= self.idle_timeout)
+            if key == keep or (over <= 0 and not idle):
+                break  # The rest have been used more recently
+            if (key,) in self._doc.dirty:
+                unsaved = True
+                continue
+            if self._is_pending and self._is_pending(self.shard_path(key)):
+                continue  # Reading it back now would get the old file
+            if self._lists_changed(key):
+                log.warning("A list in shard {} of {} has been changed "
+                            "without being assigned back. Saving it, but "
+                            "such changes can be lost".format(key,
+                                                              self.folder))
+                self._doc.dirty.add((key,))
+                unsaved = True
+                continue
+            victims.append(key)
+            over -= 1
+        for key in victims:
+            value = self._loaded.pop(key)
+            del self._last_used[key]
+            if isinstance(value, dict):
+                self._evicted[key] = value
+        if unsaved and self._flush is not None:
+            self._flush(self)
+        return len(victims)
+
+    def _remember_lists(self, key, value):
+        lists = _dump_lists(value)
+        if lists is None:
+            self._lists.pop(key, None)
+        else:
+            self._lists[key] = lists
+
+    def _lists_changed(self, key):
+        lists = self._lists.get(key)
+        return lists is not None and lists != _dump_lists(self._loaded[key])
+
+    def __repr__(self):
+        return "<ShardedDict {} ({}/{} loaded)>".format(
+            self.folder, len(self._loaded), len(self._keys))
+
+    def changes(self):
+        """Returns and clears the changed shards as (path, value) pairs
+
+        value is MISSING for shards that have been deleted"""
+        changes = []
+        for (key,) in self._doc.changed_paths():
+            if key not in self._keys:
+                changes.append((self.shard_path(key), MISSING))
+                continue
+            if key not in self._loaded:
+                # Changed through a reference kept after evict dropped it
+                value = self._evicted.pop(key, None)
+                if value is None:
+                    log.warning("Changes to shard {} of {} have been lost: "
+                                "it was changed after being dropped from "
+                                "memory".format(key, self.folder))
+                    continue
+                self._loaded[key] = value
+                self._last_used[key] = time.monotonic()
+            value = self._loaded[key]
+            self._remember_lists(key, value)
+            changes.append((self.shard_path(key), value))
+        return changes
+
+
+def _dump_lists(value, path=()):
+    """The lists in value as json, None if there are none"""
+    found = []
+    stack = [(path, value)]
+    while stack:
+        path, value = stack.pop()
+        if isinstance(value, list):
+            found.append((path, value))
+        elif isinstance(value, dict):
+            stack.extend((path + (k,), v) for k, v in value.items())
+    if not found:
+        return None
+    return json.dumps(sorted(found, key=lambda item: repr(item[0])),
+                      default=repr)
+
+
+def split(dataIO, filename, folder=None):
+    """Returns the content of filename as a new sharded document
+
+    Its shards are all changed and still have to be saved. filename
+    itself is left as it is"""
+    folder = folder or shard_folder(filename)
+    os.makedirs(folder)
+    data = {}
+    if dataIO.is_valid_json(filename):
+        data = dataIO._read_json(filename)
+        data = Journal(filename, depth=1).load(data)  # Unfolded changes
+    shards = ShardedDict(folder, dataIO._read_json)
+    for key, value in data.items():
+        shards[key] = value
+    return shards
+
+
+def join(dataIO, filename):
+    """Writes a sharded document back to filename"""
+    shards = ShardedDict(shard_folder(filename), dataIO._read_json)
+    data = {key: shards[key] for key in shards}
+    return dataIO.save_json(filename, data)
+
+
+def main():
+    from .dataIO import dataIO
+
+    parser = argparse.ArgumentParser(description="Converts Red's json data "
+                                                 "files to and from one file "
+                                                 "per server")
+    parser.add_argument("action", choices=("split", "join"))
+    parser.add_argument("files", nargs="+", metavar="file")
+    args = parser.parse_args()
+
+    for filename in args.files:
+        if args.action == "split":
+            shards = split(dataIO, filename)
+            for path, value in shards.changes():
+                dataIO.save_json(path, value)
+            print("Split {} into {} files".format(filename, len(shards)))
+        else:
+            join(dataIO, filename)
+            print("Joined {}".format(filename))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+import argparse
+import json
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from .tracking import Document, MISSING
+
+#
+# Optional SQLite storage for dataIO documents.
+#
+# A document is what would otherwise be a json file. It is stored as one
+# row per value found `depth` keys deep, plus one marker row per dict
+# above that depth. With depth 2 the bank is stored as one row per
+# account, so a deposit rewrites a single row instead of every server's
+# accounts.
+#
+# Loaded documents are made of TrackedDicts, which record the key paths
+# that have been changed. Saving a document only rewrites those rows.
+#
+
+SEP = "\x1f"
+SEP_END = "\x20"  # First character after SEP
+
+
+def encode_path(path):
+    return "".join(SEP + str(k) for k in path)
+
+
+def decode_path(encoded):
+    return tuple(encoded.split(SEP)[1:])
+
+
+class SQLDocument(Document):
+    def __init__(self, name, depth):
+        super().__init__(depth)
+        self.name = name
+
+    def rows(self, value, path=()):
+        """Yields the (path, json) rows of the value found at path
+
+        Dicts above the row depth get a marker row with a null value"""
+        if isinstance(value, dict) and len(path) < self.depth:
+            yield encode_path(path), None
+            for k, v in value.items():
+                yield from self.rows(v, path + (k,))
+        else:
+            yield encode_path(path), json.dumps(value, separators=(',', ':'))
+
+    def changes(self, data):
+        """Returns the rows to rewrite as a list of (path, rows)
+
+        If data is not the loaded document the whole document is
+        rewritten"""
+        if data is not self.root:
+            self.dirty.clear()
+            return [((), list(self.rows(data)))]
+
+        changes = []
+        for path in self.changed_paths():
+            value = self.lookup(path)
+            rows = [] if value is MISSING else list(self.rows(value, path))
+            changes.append((path, rows))
+        return changes
+
+
+class SQLiteStore:
+    def __init__(self, filename):
+        self.filename = filename
+        self.documents = {}
+        self.lock = threading.Lock()
+        # Writes are applied by a single thread, in the order they are made
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.conn = sqlite3.connect(filename, check_same_thread=False,
+                                    isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS documents ("
+                          "name TEXT PRIMARY KEY, depth INTEGER NOT NULL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS rows ("
+                          "doc TEXT NOT NULL, path TEXT NOT NULL, value TEXT, "
+                          "PRIMARY KEY (doc, path)) WITHOUT ROWID")
+
+    def names(self):
+        with self.lock:
+            cur = self.conn.execute("SELECT name FROM documents ORDER BY name")
+            return [row[0] for row in cur]
+
+    def stored_depth(self, name):
+        with self.lock:
+            cur = self.conn.execute("SELECT depth FROM documents WHERE name=?",
+                                    (name,))
+            row = cur.fetchone()
+        return row[0] if row else None
+
+    def is_routed(self, name):
+        return name in self.documents
+
+    def route(self, name, depth):
+        """Starts serving name from the store
+
+        Returns False if the document is not in the store yet"""
+        stored = self.stored_depth(name)
+        self.documents[name] = SQLDocument(name, depth)
+        if stored is not None and stored != depth:
+            self.import_data(name, depth, self.load_plain(name))
+        return stored is not None
+
+    def import_data(self, name, depth, data):
+        """Stores data as name, replacing what was there before"""
+        doc = self.documents.setdefault(name, SQLDocument(name, depth))
+        doc.depth = depth
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.execute("INSERT OR REPLACE INTO documents "
+                                  "VALUES (?, ?)", (name, depth))
+                self.conn.execute("DELETE FROM rows WHERE doc=?", (name,))
+                self.conn.executemany("INSERT INTO rows VALUES (?, ?, ?)",
+                                      ((name, p, v) for p, v in doc.rows(data)))
+            except:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def load_plain(self, name):
+        """Returns the document as plain dicts"""
+        with self.lock:
+            cur = self.conn.execute("SELECT path, value FROM rows WHERE doc=? "
+                                    "ORDER BY path", (name,))
+            rows = cur.fetchall()
+        if not rows:
+            raise FileNotFoundError("{} is not in {}".format(name,
+                                                             self.filename))
+        root = {}
+        for encoded, value in rows:
+            path = decode_path(encoded)
+            if not path:
+                if value is not None:
+                    return json.loads(value)
+                continue
+            parent = root
+            for key in path[:-1]:
+                parent = parent.setdefault(key, {})
+            if value is None:
+                parent.setdefault(path[-1], {})
+            else:
+                parent[path[-1]] = json.loads(value)
+        return root
+
+    def load(self, name):
+        doc = self.documents[name]
+        doc.dirty.clear()
+        doc.root = doc.wrap(self.load_plain(name), ())
+        return doc.root
+
+    def changes(self, name, data):
+        return self.documents[name].changes(data)
+
+    def apply(self, name, changes):
+        """Rewrites the rows under each changed path in one transaction"""
+        depth = self.documents[name].depth
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.execute("INSERT OR IGNORE INTO documents "
+                                  "VALUES (?, ?)", (name, depth))
+                for path, rows in changes:
+                    start = encode_path(path)
+                    self.conn.execute(
+                        "DELETE FROM rows WHERE doc=? AND "
+                        "(path=? OR (path>=? AND path<?))",
+                        (name, start, start + SEP, start + SEP_END))
+                    self.conn.executemany("INSERT INTO rows VALUES (?, ?, ?)",
+                                          ((name, p, v) for p, v in rows))
+            except:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+        return True
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.conn.close()
+
+
+def main():
+    from .dataIO import dataIO
+
+    parser = argparse.ArgumentParser(description="Moves Red's json data files "
+                                                 "in and out of the SQLite "
+                                                 "store")
+    parser.add_argument("--db", default="data/red/storage.sqlite3")
+    sub = parser.add_subparsers(dest="action")
+    importer = sub.add_parser("import", help="Copies json files into the "
+                                             "store, replacing stored ones")
+    importer.add_argument("--depth", type=int, default=1,
+                          help="How many keys deep each row is")
+    importer.add_argument("files", nargs="+", metavar="file")
+    exporter = sub.add_parser("export", help="Writes stored documents back "
+                                             "to their json files")
+    exporter.add_argument("names", nargs="*", metavar="file",
+                          help="Defaults to every stored document")
+    args = parser.parse_args()
+
+    if args.action is None:
+        parser.print_help()
+        return
+
+    store = SQLiteStore(args.db)
+    try:
+        if args.action == "import":
+            for filename in args.files:
+                name = os.path.normpath(filename)
+                store.import_data(name, args.depth, dataIO.load_json(filename))
+                print("Imported {}".format(name))
+        else:
+            for name in args.names or store.names():
+                dataIO.save_json(name, store.load_plain(os.path.normpath(name)))
+                print("Exported {}".format(name))
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
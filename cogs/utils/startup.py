@@ -0,0 +1,79 @@
+import importlib
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from .dataIO import dataIO
+
+#
+# Startup profiling and the thread pool half of cog loading.
+#
+# A cog module can define prepare(), which is called in a worker thread
+# before its setup(bot). It's meant for blocking work that doesn't touch
+# the bot, like probing binaries or prefetching data files, so that it
+# overlaps with the other cogs' imports. setup must not rely on it: it
+# isn't called when a cog is loaded with the load command.
+#
+
+PHASES = ("import", "prepare", "setup")
+
+
+class StartupProfiler:
+    """Records how long each cog takes to import, prepare and set up
+
+    Time spent reading json files is recorded separately as well"""
+
+    def __init__(self):
+        self.timings = OrderedDict()
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+
+    @contextmanager
+    def measure(self, name, phase):
+        start = time.perf_counter()
+        data_start = dataIO.load_time()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            data = dataIO.load_time() - data_start
+            with self.lock:
+                timing = self.timings.setdefault(
+                    name, dict.fromkeys(PHASES + ("data",), 0.0))
+                timing[phase] += elapsed
+                timing["data"] += data
+
+    def ranked(self):
+        """Returns (name, timing) pairs, slowest cog first"""
+        with self.lock:
+            items = list(self.timings.items())
+        return sorted(items, key=lambda i: sum(i[1][p] for p in PHASES),
+                      reverse=True)
+
+    def format_table(self):
+        header = "{:<24} {:>9} {:>9} {:>9} {:>9} {:>9}".format(
+            "cog", "import", "prepare", "setup", "data", "total")
+        lines = [header, "-" * len(header)]
+        for name, timing in self.ranked():
+            total = sum(timing[p] for p in PHASES)
+            lines.append("{:<24} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f}"
+                         "".format(name, *(timing[p] * 1000 for p in
+                                           PHASES + ("data",)), total * 1000))
+        lines.append("Times are in ms. Data is the json reading part of the "
+                     "other phases.")
+        lines.append("Loaded in {:.1f} ms"
+                     "".format((time.perf_counter() - self.started) * 1000))
+        return "\n".join(lines)
+
+
+def prepare_cog(name, profiler):
+    """Imports the cog module and runs its prepare()
+
+    Called in a worker thread"""
+    with profiler.measure(name, "import"):
+        module = importlib.import_module(name)
+    prepare = getattr(module, "prepare", None)
+    if prepare is not None:
+        with profiler.measure(name, "prepare"):
+            prepare()
+    return module
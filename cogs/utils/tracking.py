@@ -0,0 +1,122 @@
+from copy import deepcopy
+
+#
+# Dicts that record which of their keys have been changed, so that
+# storage backends can persist only the parts of a document that changed.
+#
+# Lists are not tracked: changing one in place is only picked up if its
+# row is changed some other way, so reassign them instead.
+#
+
+MISSING = object()
+
+
+class TrackedDict(dict):
+    """dict that reports its changes to the Document it belongs to"""
+
+    def __init__(self, doc, path, is_row):
+        super().__init__()
+        self._doc = doc
+        self._path = path
+        self._is_row = is_row
+
+    def _changed(self, key):
+        if self._is_row:
+            self._doc.dirty.add(self._path)
+        else:
+            self._doc.dirty.add(self._path + (key,))
+
+    def _wrap(self, key, value):
+        if self._is_row:
+            return self._doc.wrap(value, self._path, row=True)
+        return self._doc.wrap(value, self._path + (key,))
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, self._wrap(key, value))
+        self._changed(key)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._changed(key)
+
+    def pop(self, key, *default):
+        had_key = key in self
+        value = super().pop(key, *default)
+        if had_key:
+            self._changed(key)
+        return value
+
+    def popitem(self):
+        key, value = super().popitem()
+        self._changed(key)
+        return key, value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        keys = list(self)
+        super().clear()
+        for key in keys:
+            self._changed(key)
+
+    # Copies are plain dicts, not bound to the document
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return deepcopy(dict(self), memo)
+
+    def __reduce__(self):
+        return (dict, (dict(self),))
+
+
+class Document:
+    """A tree of TrackedDicts and the key paths changed in it
+
+    Dicts found depth keys deep are rows: a change anywhere inside a row
+    marks the row itself as changed"""
+
+    def __init__(self, depth):
+        self.depth = depth
+        self.root = None
+        self.dirty = set()
+
+    def wrap(self, value, path, *, row=False):
+        if not isinstance(value, dict):
+            return value
+        is_row = row or len(path) >= self.depth
+        tracked = TrackedDict(self, path, is_row)
+        for k, v in value.items():
+            child_path = path if is_row else path + (k,)
+            dict.__setitem__(tracked, k, self.wrap(v, child_path, row=is_row))
+        return tracked
+
+    def lookup(self, path):
+        value = self.root
+        for key in path:
+            if not isinstance(value, dict) or key not in value:
+                return MISSING
+            value = dict.__getitem__(value, key)
+        return value
+
+    def changed_paths(self):
+        """Returns and clears the changed paths, parents before children
+
+        Paths inside an already returned path are left out"""
+        dirty = sorted(self.dirty, key=len)
+        self.dirty.clear()
+        done = set()
+        paths = []
+        for path in dirty:
+            if any(path[:i] in done for i in range(len(path) + 1)):
+                continue
+            done.add(path)
+            paths.append(path)
+        return paths
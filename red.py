@@ -7,6 +7,7 @@ import logging.handlers
 import traceback
 import datetime
 import subprocess
+import time
 
 try:
     from discord.ext import commands
@@ -21,7 +22,16 @@ except ImportError:
 from cogs.utils.settings import Settings
 from cogs.utils.dataIO import dataIO
 from cogs.utils.chat_formatting import inline
-from collections import Counter
+from cogs.utils.startup import StartupProfiler, prepare_cog
+from cogs.utils.lazycogs import LazyCogs
+from cogs.utils.allowpolicy import AllowPolicy
+from cogs.utils.dispatch import MessagePipeline
+from cogs.utils.outbound import OutboundQueue
+from cogs.utils.loopmonitor import LoopMonitor
+from cogs.utils.metrics import Metrics
+from cogs.utils.logqueue import LogQueue
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from io import TextIOWrapper
 
 #
@@ -52,17 +62,21 @@ class Bot(commands.Bot):
             Requires a Bot instance and a Message object to be
             passed as arguments.
             """
-            return bot.settings.get_prefixes(message.server)
+            return bot.settings.get_prefix_matcher(message.server).prefixes
 
         self.counter = Counter()
+        self.metrics = Metrics()
         self.uptime = datetime.datetime.utcnow()  # Refreshed before login
         self._message_modifiers = []
         self.settings = Settings()
+        self.allow_policy = AllowPolicy(self.settings)
+        self.pipeline = MessagePipeline(self)
         self._intro_displayed = False
         self._shutdown_mode = None
         self.logger = set_logger(self)
         self._last_exception = None
         self.oauth_url = ""
+        self.lazy_cogs = LazyCogs(self)
         if 'self_bot' in kwargs:
             self.settings.self_bot = kwargs['self_bot']
         else:
@@ -70,26 +84,48 @@ class Bot(commands.Bot):
             if self.settings.self_bot:
                 kwargs['pm_help'] = False
         super().__init__(*args, command_prefix=prefix_manager, **kwargs)
+        self.outbound = OutboundQueue(self.loop, self._send_now)
+        self.loop_monitor = LoopMonitor(
+            self.loop, threshold=self.settings.loop_stall_threshold)
+        self.metrics.add_collector(self._collect_metrics)
 
     async def send_message(self, *args, **kwargs):
+        return await self.queue_message(*args, **kwargs)
+
+    def queue_message(self, destination, *args, merge=False, **kwargs):
+        """Queues a message and returns a future of the sent Message
+
+        Messages are sent in order per destination, as fast as Discord's
+        rate limits allow, without waiting for each other. If merge is
+        True, text only messages queued back to back to the same
+        destination may be sent as one message"""
         if self._message_modifiers:
             if "content" in kwargs:
                 pass
-            elif len(args) == 2:
-                args = list(args)
-                kwargs["content"] = args.pop()
-            else:
-                return await super().send_message(*args, **kwargs)
-
-            content = kwargs['content']
-            for m in self._message_modifiers:
-                try:
-                    content = str(m(content))
-                except:   # Faulty modifiers should not
-                    pass  # break send_message
-            kwargs['content'] = content
-
-        return await super().send_message(*args, **kwargs)
+            elif len(args) == 1:
+                kwargs["content"] = args[0]
+                args = ()
+            if "content" in kwargs:
+                content = kwargs['content']
+                for m in self._message_modifiers:
+                    try:
+                        content = str(m(content))
+                    except:   # Faulty modifiers should not
+                        pass  # break send_message
+                kwargs['content'] = content
+
+        return self.outbound.put(destination, args, kwargs, merge=merge)
+
+    def _send_now(self, *args, **kwargs):
+        return super().send_message(*args, **kwargs)
+
+    def _collect_metrics(self):
+        yield "outbound_queued", self.outbound.depth(), {}
+        yield "loop_lag_max_seconds", self.loop_monitor.histogram(1)[3], {}
+        yield "servers", len(self.servers), {}
+        yield "log_records_dropped", self.log_queue.dropped, {}
+        for event, count in self.counter.items():
+            yield "events", count, {"event": event}
 
     async def shutdown(self, *, restart=False):
         """Gracefully quits Red with exit code 0
@@ -97,8 +133,21 @@ class Bot(commands.Bot):
         If restart is True, the exit code will be 26 instead
         The launcher automatically restarts Red when that happens"""
         self._shutdown_mode = not restart
+        await self.outbound.drain(timeout=10)
+        self.loop_monitor.stop()
+        self.metrics.stop()
+        dataIO.flush()
         await self.logout()
 
+    def load_extension(self, name):
+        self.lazy_cogs.discard(name)  # The real commands replace the stubs
+        super().load_extension(name)
+
+    def unload_extension(self, name):
+        self.lazy_cogs.discard(name)
+        super().unload_extension(name)
+        dataIO.flush()  # Pending write-behind saves of the unloaded cog
+
     def add_message_modifier(self, func):
         """
         Adds a message modifier to the bot
@@ -149,39 +198,7 @@ class Bot(commands.Bot):
         if author == self.user:
             return self.settings.self_bot
 
-        mod_cog = self.get_cog('Mod')
-        global_ignores = self.get_cog('Owner').global_ignores
-
-        if self.settings.owner == author.id:
-            return True
-
-        if author.id in global_ignores["blacklist"]:
-            return False
-
-        if global_ignores["whitelist"]:
-            if author.id not in global_ignores["whitelist"]:
-                return False
-
-        if not message.channel.is_private:
-            server = message.server
-            names = (self.settings.get_server_admin(
-                server), self.settings.get_server_mod(server))
-            results = map(
-                lambda name: discord.utils.get(author.roles, name=name),
-                names)
-            for r in results:
-                if r is not None:
-                    return True
-
-        if mod_cog is not None:
-            if not message.channel.is_private:
-                if message.server.id in mod_cog.ignore_list["SERVERS"]:
-                    return False
-
-                if message.channel.id in mod_cog.ignore_list["CHANNELS"]:
-                    return False
-
-        return True
+        return self.allow_policy.allowed(message)
 
     async def pip_install(self, name, *, timeout=None):
         """
@@ -245,6 +262,9 @@ def initialize(bot_class=Bot, formatter_class=Formatter):
     __main__.user_allowed = bot.user_allowed    # compatibility
     __main__.settings = bot.settings            # sucks
 
+    from cogs.utils import checks  # Needs __main__.settings
+    checks.register_invalidation(bot)
+
     async def get_oauth_url():
         try:
             data = await bot.application_info()
@@ -335,18 +355,53 @@ def initialize(bot_class=Bot, formatter_class=Formatter):
     async def on_resumed():
         bot.counter["session_resumed"] += 1
 
+    # When the messages being processed as commands were received, to
+    # time them until the command completes or fails
+    received = OrderedDict()
+
+    def command_finished(ctx, error=None):
+        started = received.pop(ctx.message.id, None)
+        command = ctx.command
+        name = command.qualified_name if command else None
+        if error is not None:
+            bot.metrics.inc("command_errors", command=name,
+                            error=type(error).__name__)
+        if command is None or started is None:
+            return
+        elapsed = time.monotonic() - started
+        bot.metrics.observe("command_latency_seconds", elapsed, command=name)
+        bot.metrics.observe("cog_latency_seconds", elapsed,
+                            cog=command.cog_name or "None")
+
     @bot.event
     async def on_command(command, ctx):
         bot.counter["processed_commands"] += 1
+        bot.metrics.inc("commands", command=command.qualified_name,
+                        cog=command.cog_name or "None")
+
+    @bot.event
+    async def on_command_completion(command, ctx):
+        command_finished(ctx)
+
+    async def run_commands(info):
+        received[info.message.id] = info.received
+        while len(received) > 1000:  # Never finished
+            received.popitem(last=False)
+        await bot.process_commands(info.message)
+
+    # Self bots take commands from their own messages
+    bot.pipeline.add_stage("commands", run_commands, prefixed=True,
+                           ignore_self=False, allowed_only=True)
 
     @bot.event
     async def on_message(message):
         bot.counter["messages_read"] += 1
-        if bot.user_allowed(message):
-            await bot.process_commands(message)
+        bot.metrics.inc("messages")
+        bot.pipeline.dispatch(message)
 
     @bot.event
     async def on_command_error(error, ctx):
+        command_finished(ctx, error)
         channel = ctx.message.channel
         if isinstance(error, commands.MissingRequiredArgument):
             await bot.send_cmd_help(ctx)
@@ -489,22 +544,25 @@ def set_logger(bot):
         maxBytes=10**7, backupCount=5)
     fhandler.setFormatter(red_format)
 
-    logger.addHandler(fhandler)
-    logger.addHandler(stdout_handler)
+    # The handlers run on the log queue's thread, not on the event loop
+    bot.log_queue = LogQueue()
+    bot.log_queue.attach(logger, fhandler, stdout_handler)
 
     dpy_logger = logging.getLogger("discord")
     if bot.settings.debug:
         dpy_logger.setLevel(logging.DEBUG)
     else:
         dpy_logger.setLevel(logging.WARNING)
-    handler = logging.FileHandler(
-        filename='data/red/discord.log', encoding='utf-8', mode='a')
+    handler = logging.handlers.RotatingFileHandler(
+        filename='data/red/discord.log', encoding='utf-8', mode='a',
+        maxBytes=10**7, backupCount=5)
     handler.setFormatter(logging.Formatter(
         '%(asctime)s %(levelname)s %(module)s %(funcName)s %(lineno)d: '
         '%(message)s',
         datefmt="[%d/%m/%Y %H:%M]"))
-    dpy_logger.addHandler(handler)
+    bot.log_queue.attach(dpy_logger, handler)
 
+    bot.log_queue.start()
     return logger
 
 
@@ -541,7 +599,9 @@ def load_cogs(bot):
     except:
         registry = {}
 
-    bot.load_extension('cogs.owner')
+    profiler = StartupProfiler()
+    with profiler.measure("cogs.owner", "setup"):
+        bot.load_extension('cogs.owner')
     owner_cog = bot.get_cog('Owner')
     if owner_cog is None:
         print("The owner cog is missing. It contains core functions without "
@@ -561,24 +621,39 @@ def load_cogs(bot):
         for ext in defaults:
             registry["cogs." + ext] = True
 
-    for extension in extensions:
-        if extension.lower() == "cogs.owner":
-            continue
-        to_load = registry.get(extension, False)
-        if to_load:
+    to_load = [e for e in extensions
+               if e.lower() != "cogs.owner" and registry.get(e, False)]
+    if bot.settings.lazy_cogs:
+        # Loaded on first use instead
+        to_load = [e for e in to_load if not bot.lazy_cogs.stub(e)]
+
+    # Imports and prepare() run in the pool, setup() runs here in the
+    # usual order, as soon as the cog's own prepare() is done
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        jobs = [(e, executor.submit(prepare_cog, e, profiler))
+                for e in to_load]
+        for extension, job in jobs:
             try:
-                owner_cog._load_cog(extension)
+                job.result()
+                with profiler.measure(extension, "setup"):
+                    bot.load_extension(extension)
             except Exception as e:
                 print("{}: {}".format(e.__class__.__name__, str(e)))
                 bot.logger.exception(e)
                 failed.append(extension)
                 registry[extension] = False
 
+    dataIO.clear_prefetched()
     dataIO.save_json("data/red/cogs.json", registry)
 
     if failed:
         print("\nFailed to load: {}\n".format(" ".join(failed)))
 
+    if bot.settings.profile_startup:
+        print("\n" + profiler.format_table() + "\n")
+    else:
+        bot.logger.debug("Cogs loaded:\n" + profiler.format_table())
+
 
 def main(bot):
     check_folders()
@@ -593,6 +668,9 @@ def main(bot):
 
     print("Logging into Discord...")
     bot.uptime = datetime.datetime.utcnow()
+    bot.loop_monitor.start()
+    bot.metrics.start(bot.loop, interval=bot.settings.metrics_interval,
+                      port=bot.settings.metrics_port)
 
     if bot.settings.login_credentials:
         yield from bot.login(*bot.settings.login_credentials,
@@ -634,6 +712,7 @@ if __name__ == '__main__':
                              exc_info=e)
         loop.run_until_complete(bot.logout())
     finally:
+        dataIO.flush()
         loop.close()
         if bot._shutdown_mode is True:
             exit(0)
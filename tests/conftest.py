@@ -0,0 +1,10 @@
+import asyncio
+
+import pytest
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
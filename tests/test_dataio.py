@@ -0,0 +1,92 @@
+import asyncio
+import builtins
+import os
+
+from cogs.utils import dataIO as dataIO_module
+from cogs.utils.dataIO import DataIO
+
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path / "settings.json")
+    io = DataIO()
+    assert io.save_json(path, {"a": [1, 2], "b": "café"})
+    assert io.load_json(path) == {"a": [1, 2], "b": "café"}
+
+
+def test_short_write_keeps_the_original(tmp_path, monkeypatch):
+    path = str(tmp_path / "settings.json")
+    io = DataIO()
+    assert io.save_json(path, {"a": 1})
+
+    class DroppingFile:
+        """Loses the last byte written, like a disk that's full"""
+
+        def __init__(self, f):
+            self.f = f
+
+        def write(self, data):
+            return self.f.write(data[:-1])
+
+        def __getattr__(self, name):
+            return getattr(self.f, name)
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            return self.f.__exit__(*exc)
+
+    def dropping_open(file, mode="r", *args, **kwargs):
+        f = builtins.open(file, mode, *args, **kwargs)
+        return DroppingFile(f) if mode == "wb" else f
+
+    monkeypatch.setattr(dataIO_module, "open", dropping_open, raising=False)
+    assert not io.save_json(path, {"a": 2})
+    monkeypatch.undo()
+
+    assert io.load_json(path) == {"a": 1}
+    assert io._checksum_matches(path)
+    assert [f for f in os.listdir(str(tmp_path)) if f.endswith(".tmp")] == []
+
+
+def test_sidecar_is_the_checksum_of_the_saved_bytes(tmp_path, monkeypatch):
+    path = str(tmp_path / "settings.json")
+    io = DataIO()
+    reads = []
+    real_open = builtins.open
+
+    def counting_open(file, mode="r", *args, **kwargs):
+        if "r" in mode:
+            reads.append(file)
+        return real_open(file, mode, *args, **kwargs)
+
+    monkeypatch.setattr(dataIO_module, "open", counting_open, raising=False)
+    assert io.save_json(path, {"a": 1})
+    assert io.save_json(path, {"a": 2})
+    monkeypatch.undo()
+
+    assert reads == []  # Nothing is read back
+    assert io._checksum_matches(path)
+    assert sorted(os.listdir(str(tmp_path))) == ["settings.json",
+                                                 "settings.json.crc"]
+
+
+def test_idle_shards_are_dropped_without_being_used(tmp_path, loop):
+    path = str(tmp_path / "bank.json")
+    io = DataIO()
+    io.sharding = True
+    io.shard_idle_timeout = 0.05
+    io.write_behind_delay = 0.01
+    assert io.save_json(path, {"1": {"a": 1}, "2": {"b": 2}})
+    assert io.use_shards(path)
+
+    async def run():
+        bank = io.load_json(path)
+        bank["1"]["a"] = 10  # Unsaved when it goes idle
+        bank["2"]
+        await asyncio.sleep(0.3)
+        return bank
+
+    bank = loop.run_until_complete(run())
+    assert io.shard_stats() == {os.path.normpath(path): (0, 2)}
+    assert io._read_json(bank.shard_path("1")) == {"a": 10}
@@ -0,0 +1,228 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from cogs.utils.downloads import (DownloadService, DownloadTimeout,
+                                  DownloadCancelled, MetadataCache,
+                                  MaximumLength)
+
+EXTRACT_TIME = 0.2  # Seconds a fake youtube_dl call blocks its thread
+MAX_LAG = 0.1  # Seconds the loop may be late while they run
+
+
+class FakeYoutubeDL:
+    """Blocks like youtube_dl does while it talks to YouTube"""
+
+    def __init__(self, service):
+        self.service = service
+
+    def extract_info(self, url, download=True, process=True):
+        service = self.service
+        with service.lock:
+            service.calls.append(url)
+            service.running += 1
+            service.most_running = max(service.most_running, service.running)
+        try:
+            time.sleep(service.extract_time)
+        finally:
+            with service.lock:
+                service.running -= 1
+        return {"id": url.rsplit("=", 1)[-1], "title": url, "url": url,
+                "webpage_url": url, "duration": 60}
+
+
+class FakeDownloadService(DownloadService):
+    def __init__(self, *args, extract_time=EXTRACT_TIME, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.extract_time = extract_time
+        self.lock = threading.Lock()
+        self.calls = []
+        self.running = 0
+        self.most_running = 0
+
+    def _youtube_dl(self):
+        return FakeYoutubeDL(self)
+
+
+def song_url(n):
+    return "https://youtube.com/watch?v=song{}".format(n)
+
+
+async def lateness(loop, until, interval=0.01):
+    """Most the loop was late waking up a sleep, until until is done"""
+    worst = 0
+    while not until.done():
+        start = loop.time()
+        await asyncio.sleep(interval)
+        worst = max(worst, loop.time() - start - interval)
+    return worst
+
+
+def test_slow_extractions_dont_block_the_loop(loop, tmp_path):
+    service = FakeDownloadService(loop, workers=4, per_server=2,
+                                  cache_path=str(tmp_path))
+    servers = ["server{}".format(n) for n in range(6)]
+
+    async def run():
+        jobs = [service.info(song_url(i * 10 + n), sid)
+                for i, sid in enumerate(servers) for n in range(3)]
+        done = asyncio.ensure_future(
+            asyncio.gather(*(job.wait() for job in jobs)))
+        lag = await lateness(loop, done)
+        return lag, jobs, done.result()
+
+    try:
+        lag, jobs, songs = loop.run_until_complete(run())
+    finally:
+        service.close()
+    assert lag < MAX_LAG
+    assert [s.id for s in songs] == [job.url.rsplit("=", 1)[-1]
+                                    for job in jobs]
+    assert len(service.calls) == len(jobs)
+    assert service.most_running <= 4
+
+
+def test_same_url_is_looked_up_once(loop, tmp_path):
+    service = FakeDownloadService(loop, cache_path=str(tmp_path))
+
+    async def run():
+        jobs = [service.info(song_url(1), sid) for sid in ("a", "b", "c")]
+        return jobs, await asyncio.gather(*(job.wait() for job in jobs))
+
+    try:
+        jobs, songs = loop.run_until_complete(run())
+    finally:
+        service.close()
+    assert jobs[0] is jobs[1] is jobs[2]
+    assert service.calls == [song_url(1)]
+    assert songs[0].id == "song1"
+
+
+def test_per_server_limit(loop, tmp_path):
+    service = FakeDownloadService(loop, workers=4, per_server=2,
+                                  cache_path=str(tmp_path))
+
+    async def run(sid):
+        jobs = [service.info(song_url(n), sid) for n in range(6)]
+        await asyncio.gather(*(job.wait() for job in jobs))
+
+    try:
+        loop.run_until_complete(run("a"))
+        assert service.most_running == 2
+        assert service._server_limits == {}  # Dropped once idle
+        service.most_running = 0
+        loop.run_until_complete(run(None))  # Only limited by the pool
+        assert service.most_running == 4
+    finally:
+        service.close()
+
+
+def test_stricter_duration_limit_gets_its_own_job(loop, tmp_path):
+    service = FakeDownloadService(loop, cache_path=str(tmp_path))
+
+    async def run():
+        loose = service.download(song_url(1), "a", max_duration=120)
+        strict = service.download(song_url(1), "b", max_duration=30)
+        assert loose is not strict
+        with pytest.raises(MaximumLength):
+            await strict.wait()
+        return await loose.wait()
+
+    try:
+        song = loop.run_until_complete(run())
+    finally:
+        service.close()
+    assert song.id == "song1"
+
+
+def test_timeout_leaves_the_job_running(loop, tmp_path):
+    service = FakeDownloadService(loop, cache_path=str(tmp_path))
+
+    async def run():
+        job = service.info(song_url(1), "a")
+        with pytest.raises(DownloadTimeout):
+            await job.wait(timeout=0.05)
+        assert not job.done()
+        return await job.wait()
+
+    try:
+        song = loop.run_until_complete(run())
+    finally:
+        service.close()
+    assert song.id == "song1"
+
+
+def test_cancel_only_drops_the_servers_jobs(loop, tmp_path):
+    service = FakeDownloadService(loop, cache_path=str(tmp_path))
+
+    async def run():
+        alone = service.info(song_url(1), "a")
+        shared = service.info(song_url(2), "a")
+        service.info(song_url(2), "b")
+        await asyncio.sleep(0.01)  # Both are in the pool
+        service.cancel("a")
+        with pytest.raises(DownloadCancelled):
+            await alone.wait()
+        return await shared.wait()
+
+    try:
+        song = loop.run_until_complete(run())
+    finally:
+        service.close()
+    assert song.id == "song2"
+
+
+def test_release_cancels_unwanted_jobs(loop, tmp_path):
+    service = FakeDownloadService(loop, cache_path=str(tmp_path))
+
+    async def run():
+        job = service.info(song_url(1), "a")
+        service.release(job, "a")
+        with pytest.raises(DownloadCancelled):
+            await job.wait()
+
+    try:
+        loop.run_until_complete(run())
+    finally:
+        service.close()
+
+
+def test_known_songs_skip_youtube_dl(loop, tmp_path):
+    metadata = MetadataCache(loop, str(tmp_path / "metadata.sqlite3"),
+                             ttl=60)
+    service = FakeDownloadService(loop, cache_path=str(tmp_path),
+                                  metadata=metadata)
+
+    async def run():
+        first = await service.info(song_url(1), "a").wait()
+        again = await service.info(song_url(1), "b").wait()
+        return first, again
+
+    try:
+        first, again = loop.run_until_complete(run())
+    finally:
+        service.close()
+        metadata.close()
+    assert service.calls == [song_url(1)]
+    assert again.id == first.id == "song1"
+
+
+def test_metadata_is_written_behind_and_read_back(loop, tmp_path):
+    path = str(tmp_path / "metadata.sqlite3")
+    metadata = MetadataCache(loop, path, ttl=60)
+    metadata.put_song_info("[SEARCH:]some song", song_url(1),
+                           {"id": "song1", "title": "Some song"})
+    metadata.close()  # Waits for the writes
+
+    metadata = MetadataCache(loop, path, ttl=60)
+    try:
+        found = loop.run_until_complete(
+            metadata.get_song_info("[SEARCH:]Some  Song"))
+        stats = loop.run_until_complete(metadata.stats())
+    finally:
+        metadata.close()
+    assert found == (song_url(1), {"id": "song1", "title": "Some song"})
+    assert stats["stored"] == 2
+    assert stats["disk_hits"] == 2
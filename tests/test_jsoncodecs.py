@@ -0,0 +1,35 @@
+import json
+
+import pytest
+
+from cogs.utils.jsoncodecs import available_codecs, ascii_escape
+
+SAMPLE = {"reason": "Spamming \N{PILE OF POO} in #général",
+          "\N{SNOWMAN}": ["café", " ", "a\"b\\c/d", 1, 2.5, None],
+          "plain": {"nested": True}}
+
+
+@pytest.mark.parametrize("data", [
+    SAMPLE,
+    {"plain": "only ascii \\x41 \\U00012345"},
+    {"escaped backslash": "\\xe9 \\\N{PILE OF POO} \\U0001f4a9 é"},
+    {"many": "".join(chr(n) for n in range(0x80, 0x400))},
+    {"astral": "\U00012345 \N{PILE OF POO} \N{EURO SIGN} \xff"},
+])
+def test_ascii_escape_matches_the_stdlib(data):
+    text = json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+    assert ascii_escape(text) == json.dumps(data, separators=(',', ':'))
+
+
+def test_nan_written_by_the_stdlib_can_be_read():
+    raw = json.dumps({"x": float("inf")}).encode("utf-8")
+    for codec in available_codecs():
+        assert codec.loads(raw) == {"x": float("inf")}
+
+
+@pytest.mark.parametrize("codec", available_codecs(),
+                         ids=lambda codec: codec.name)
+def test_compact_output_is_the_same_for_every_codec(codec):
+    text = codec.dumps_compact(SAMPLE)
+    assert text == json.dumps(SAMPLE, separators=(',', ':'))
+    assert codec.loads(text.encode("utf-8")) == SAMPLE
@@ -0,0 +1,50 @@
+import asyncio
+
+from cogs.utils.outbound import OutboundQueue
+
+
+class FakeChannel:
+    def __init__(self, id):
+        self.id = id
+
+
+def test_idle_buckets_are_dropped(loop):
+    sent = []
+
+    async def sender(destination, content):
+        sent.append((destination.id, content))
+        return content
+
+    outbound = OutboundQueue(loop, sender, channel_rate=(2, 0.05))
+
+    async def run():
+        channels = [FakeChannel(str(n)) for n in range(3)]
+        futures = [outbound.put(c, ("hi",)) for c in channels for _ in "ab"]
+        await asyncio.gather(*futures)
+        assert outbound.stats()["buckets"] == 3
+        await asyncio.sleep(0.1)  # Long enough for them to refill
+        return outbound.stats()
+
+    stats = loop.run_until_complete(run())
+    assert len(sent) == 6
+    assert stats["buckets"] == 0
+    assert stats["destinations"] == 0
+
+
+def test_busy_destination_keeps_its_bucket(loop):
+    async def sender(destination, content):
+        return content
+
+    outbound = OutboundQueue(loop, sender, channel_rate=(1, 0.05))
+    channel = FakeChannel("1")
+
+    async def run():
+        await outbound.put(channel, ("a",))
+        second = outbound.put(channel, ("b",))  # Waits for a token
+        await asyncio.sleep(0.03)
+        assert "1" in outbound._buckets
+        await second
+        await asyncio.sleep(0.1)
+        return outbound.stats()
+
+    assert loop.run_until_complete(run())["buckets"] == 0
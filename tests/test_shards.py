@@ -0,0 +1,75 @@
+import json
+import logging
+import os
+import time
+
+from cogs.utils.shards import ShardedDict
+
+
+def make_shards(tmp_path, data, **kwargs):
+    for key, value in data.items():
+        with open(str(tmp_path / (key + ".json")), "w") as f:
+            json.dump(value, f)
+
+    def read(path):
+        with open(path) as f:
+            return json.load(f)
+
+    return ShardedDict(str(tmp_path), read, **kwargs)
+
+
+def saved(shards):
+    return {os.path.basename(path): value for path, value in shards.changes()}
+
+
+def test_change_to_evicted_shard_is_saved(tmp_path):
+    shards = make_shards(tmp_path, {"1": {"a": 1}, "2": {"b": 2}},
+                         max_resident=1)
+    first = shards["1"]
+    shards["2"]  # Drops "1" from memory
+    assert shards.resident == 1
+    first["a"] = 10
+    assert saved(shards) == {"1.json": {"a": 10}}
+    assert shards["1"] is first
+
+
+def test_evicted_shard_still_referenced_is_taken_back(tmp_path):
+    shards = make_shards(tmp_path, {"1": {"a": 1}, "2": {"b": 2}},
+                         max_resident=1)
+    first = shards["1"]
+    shards["2"]
+    first["a"] = 10
+    assert shards["1"]["a"] == 10
+
+
+def test_list_changed_in_place_is_saved_with_a_warning(tmp_path, caplog):
+    shards = make_shards(tmp_path, {"1": {"words": ["a"]}, "2": {}},
+                         max_resident=1)
+    shards["1"]["words"].append("b")
+    with caplog.at_level(logging.WARNING, logger="red.shards"):
+        shards["2"]
+    assert "without being assigned back" in caplog.text
+    assert shards.resident == 2  # Kept until it's saved
+    assert saved(shards) == {"1.json": {"words": ["a", "b"]}}
+
+
+def test_reassigned_lists_dont_warn(tmp_path, caplog):
+    shards = make_shards(tmp_path, {"1": ["a"], "2": []}, max_resident=1)
+    shards["1"] = shards["1"] + ["b"]
+    assert saved(shards) == {"1.json": ["a", "b"]}
+    with caplog.at_level(logging.WARNING, logger="red.shards"):
+        shards["2"]
+    assert caplog.text == ""
+    assert shards.resident == 1
+
+
+def test_idle_dirty_shard_is_flushed_then_dropped(tmp_path):
+    flushed = []
+    shards = make_shards(tmp_path, {"1": {"a": 1}}, idle_timeout=10,
+                         flush=flushed.append)
+    shards["1"]["a"] = 2
+    assert shards.evict(now=time.monotonic() + 20) == 0
+    assert flushed == [shards]  # Kept until it's been written
+    assert saved(shards) == {"1.json": {"a": 2}}
+    assert shards.evict(now=time.monotonic() + 20) == 1
+    assert shards.resident == 0
@@ -0,0 +1,34 @@
+import threading
+
+from cogs.utils.dataIO import DataIO
+
+
+def test_sync_save_waits_for_queued_async_saves(tmp_path):
+    filename = str(tmp_path / "bank.json")
+    io = DataIO()
+    io.enable_sqlite(str(tmp_path / "red.sqlite3"))
+    assert io.use_sqlite(filename, depth=2)
+    assert io.save_json(filename, {"1": {"a": {"balance": 0}}})
+    store = io._store
+    name = io._routed_name(filename)
+
+    bank = io.load_json(filename)
+    bank["1"]["a"]["balance"] = 10
+    older = store.changes(name, bank)  # What a write-behind save queues
+
+    release = threading.Event()
+    store.executor.submit(release.wait)  # Keeps the store's thread busy
+    store.executor.submit(store.apply, name, older)
+
+    bank["1"]["a"]["balance"] = 20
+    saver = threading.Thread(target=io.save_json, args=(filename, bank))
+    saver.start()
+    try:
+        saver.join(0.1)
+        assert saver.is_alive()  # Queued behind the older save
+    finally:
+        release.set()
+        saver.join()
+
+    assert store.load_plain(name) == {"1": {"a": {"balance": 20}}}
+    store.close()